@@ -0,0 +1,282 @@
+# %%
+import os
+import itertools
+import logging
+import warnings
+from time import strftime, gmtime
+from pathlib import Path
+import click
+import numpy as np
+import pandas as pd
+import yaml
+from dotenv import load_dotenv
+from joblib import Parallel, delayed
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.preprocessing import StandardScaler
+from dataloaders.split_manifest import get_split_indices
+from models.bag_of_words import BagOfWords, to_binary, get_training_profile
+from models.descriptor_store import extract_descriptors, FEATURE_DETECTION_ALGORITHMS
+from models.vocabulary import build_vocabulary, build_histograms, compute_idf, normalize_histograms
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# %%
+load_dotenv()
+DATA_FOLDER_PATH = os.getenv("DATA_FOLDER_PATH")
+DESCRIPTOR_STORE_PATH = os.path.join(DATA_FOLDER_PATH, 'descriptors')
+warnings.filterwarnings("ignore")
+
+BOW_CLASSIFIERS = ['XGBoost', 'RandomForest', 'SVM']
+
+# Values tried for each classifier, keys are the same as in the bag_of_words section of hyperparams.yaml
+BOW_SEARCH_SPACE = {
+    'XGBoost': {
+        'LR': [0.1, 0.3, 0.7],
+        'GAMMA': [0, 1],
+        'MAX_DEPTH': [3, None],
+        'MIN_CHILD_WEIGHT': [0, 1],
+    },
+    'RandomForest': {
+        'N_ESTIMATORS': [100, 300, 400],
+        'CRITERION': ['gini', 'entropy'],
+        'MAX_DEPTH': [None],
+        'MIN_SAMPLES_SPLIT': [2, 4],
+    },
+    'SVM': {
+        'C': [1, 10],
+        'KERNEL': ['rbf', 'sigmoid'],
+        'GAMMA': [0.001, 'auto'],
+    },
+}
+
+
+# %%
+def get_parameter_grid(classifier):
+    search_space = BOW_SEARCH_SPACE[classifier]
+    return [dict(zip(search_space.keys(), values)) for values in itertools.product(*search_space.values())]
+
+
+def build_features(train_descriptors, val_descriptors, k, vocabulary_params, histogram_params, random_state):
+    """Vocabulary of k words fitted on the training descriptors, and the scaled histograms of both splits as in BagOfWords."""
+    sparse = histogram_params.get('SPARSE', False)
+    normalization = histogram_params.get('NORMALIZATION')
+
+    voc = build_vocabulary(train_descriptors, k, vocabulary_params, random_state=random_state)
+
+    train_features = build_histograms(train_descriptors, voc, sparse=sparse)
+    val_features = build_histograms(val_descriptors, voc, sparse=sparse)
+
+    idf = compute_idf(train_features) if normalization == 'tfidf' else None
+    train_features = normalize_histograms(train_features, normalization, idf)
+    val_features = normalize_histograms(val_features, normalization, idf)
+
+    stdslr = StandardScaler(with_mean=not sparse).fit(train_features)
+
+    return stdslr.transform(train_features), stdslr.transform(val_features)
+
+
+def evaluate_combination(features, train_labels, val_labels, num_classes, feature_detection, classifier, k, parameters, profile):
+    """Fit one classifier on the cached training histograms and score it on the validation histograms."""
+    train_features, val_features = features
+
+    bow = BagOfWords(DATA_FOLDER_PATH, num_classes, feature_detection, classifier)
+    clf = bow.fit(pd.DataFrame({'Label': train_labels}), train_features, None, {**parameters, 'K': k}, profile)
+    pred = clf.predict(val_features)
+
+    return {
+        'feature_detection': feature_detection,
+        'classifier': classifier,
+        'K': k,
+        **parameters,
+        'accuracy': accuracy_score(val_labels, pred),
+        'F1_score': f1_score(val_labels, pred, average='weighted'),
+    }
+
+
+def format_yaml_value(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, str):
+        return f"'{value}'"
+    return str(value)
+
+
+def find_mapping_item(node, key):
+    for key_node, value_node in node.value:
+        if key_node.value == key:
+            return key_node, value_node
+    raise KeyError(key)
+
+
+def write_best_parameters(params_file, num_classes_key, best_results):
+    """
+    Replace the classifier blocks of the bag_of_words section of the hyperparameter file with the best results.
+
+    Only the lines of the replaced blocks are rewritten, so the rest of the file and its comments stay as they are.
+    """
+    with open(params_file, "r") as stream:
+        lines = stream.read().splitlines(keepends=True)
+
+    section = find_mapping_item(yaml.compose("".join(lines)), 'bag_of_words')[1]
+    section = find_mapping_item(section, num_classes_key)[1]
+
+    replacements = []
+    for result in best_results:
+        classifier = result['classifier']
+        key_node, block_node = find_mapping_item(find_mapping_item(section, result['feature_detection'])[1], classifier)
+
+        indent = " " * key_node.start_mark.column
+        block = [f"{indent}{classifier}: # accuracy ~{result['accuracy']:.2f}, f1 score ~{result['F1_score']:.2f}\n"]
+        for parameter in [*BOW_SEARCH_SPACE[classifier].keys(), 'K']:
+            block.append(f"{indent}  {parameter}: {format_yaml_value(result[parameter])}\n")
+
+        last_value_node = block_node.value[-1][1]
+        replacements.append((key_node.start_mark.line, last_value_node.end_mark.line, block))
+
+    # From the bottom up so that the line numbers of the remaining blocks stay valid
+    for start, end, block in sorted(replacements, key=lambda replacement: replacement[0], reverse=True):
+        lines[start:end + 1] = block
+
+    with open(params_file, "w") as stream:
+        stream.writelines(lines)
+
+    logger.info(f"Wrote the best parameters to {params_file}")
+
+
+# %%
+# Hyperparameter search
+@click.command()
+@click.option('-d', '--dataset', type=click.Choice(['plant', 'plant_golden', 'leaf'], case_sensitive=False), help='Already available dataset to use to train the model. Give either -d or -csv, not both.')
+@click.option('-csv', '--data-csv', type=str, help='Full file path to dataset CSV-file created during segmentation. Give either -d or -csv, not both.')
+@click.option('-b', '--binary', is_flag=True, show_default=True, default=False, help='Train binary classifier instead of multiclass classifier.')
+@click.option('-bl', '--binary-label', type=int, help='Binary label when dataset has more than two labels. Classification is done using one-vs-rest, where the binary label corresponds to the one compared to other labels.')
+@click.option('-fd', '--feature-detection', type=str, show_default=True, default='SIFT,ORB', help='Comma-separated list of feature detection algorithms to include in the search.')
+@click.option('-c', '--classifiers', type=str, show_default=True, default='XGBoost,RandomForest,SVM', help='Comma-separated list of classifiers to include in the search.')
+@click.option('-k', '--vocabulary-sizes', type=str, show_default=True, default='100,200,500', help='Comma-separated list of vocabulary sizes (K) to include in the search.')
+@click.option('-p', '--params-file', type=str, default="hyperparams.yaml", help='Full file path to hyperparameter-file. VOCABULARY, HISTOGRAM and the training profile are read from its bag_of_words section.')
+@click.option('-w', '--write', is_flag=True, show_default=True, default=False, help='Write the best parameters of each feature detection algorithm and classifier back to the hyperparameter-file.')
+@click.option('-j', '--n-jobs', type=int, show_default=True, default=-1, help='Number of processes used for descriptor extraction and for evaluating the combinations.')
+@click.option('-ob', '--objective_function', type=click.Choice(['F1_score', 'accuracy']), show_default=True, default='F1_score', help='What is the function the value of which we try to optimize.')
+@click.option('-v', '--verbose', is_flag=True, show_default=True, default=False, help='Print verbose logs.')
+def search_bow_hyperparameters(dataset, data_csv, binary, binary_label, feature_detection, classifiers, vocabulary_sizes, params_file, write, n_jobs, objective_function, verbose):
+
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    logger.info("Reading the data")
+
+    if (not dataset and not data_csv) or (dataset and data_csv):
+        raise ValueError("You must pass either -d (name of the available dataset) or -csv (path to data-CSV)")
+
+    if dataset:
+        if dataset == 'plant':
+            DATA_MASTER_PATH = os.path.join(DATA_FOLDER_PATH, "plant_data_split_master.csv")
+        elif dataset == 'leaf':
+            DATA_MASTER_PATH = os.path.join(DATA_FOLDER_PATH, "leaves_segmented_master.csv")
+        elif dataset == 'plant_golden':
+            DATA_MASTER_PATH = os.path.join(DATA_FOLDER_PATH, "plant_data_split_golden.csv")
+    else:
+        DATA_MASTER_PATH = data_csv
+        dataset = Path(data_csv).stem
+
+    FEATURE_DETECTIONS = [x.strip() for x in feature_detection.split(',')]
+    CLASSIFIERS = [x.strip() for x in classifiers.split(',')]
+    K_VALUES = [int(x) for x in vocabulary_sizes.split(',')]
+
+    for algorithm in FEATURE_DETECTIONS:
+        if algorithm not in FEATURE_DETECTION_ALGORITHMS:
+            raise ValueError(f"Unknown feature detection algorithm {algorithm}. Accepted values are {FEATURE_DETECTION_ALGORITHMS}.")
+    for classifier in CLASSIFIERS:
+        if classifier not in BOW_CLASSIFIERS:
+            raise ValueError(f"Unknown classifier {classifier}. Accepted values are {BOW_CLASSIFIERS}.")
+
+    with open(params_file, "r") as stream:
+        try:
+            params = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            logger.error(f"Error while reading YAML: {exc}")
+            raise exc
+
+    vocabulary_params = params['bag_of_words'].get('VOCABULARY', {})
+    histogram_params = params['bag_of_words'].get('HISTOGRAM', {})
+    # The combinations are already evaluated in parallel, so each classifier is trained with a single core
+    profile = {**get_training_profile(params['bag_of_words']), 'N_JOBS': 1}
+
+    df = pd.read_csv(DATA_MASTER_PATH)
+
+    if binary:
+        NUM_CLASSES = 2
+        num_classes_key = 'BINARY'
+        if df['Label'].nunique() > 2:
+            if binary_label is None:
+                raise ValueError("You must give also binary-label (-bl or --binary-label) argument when using binary classification and the dataset contains more than two labels.")
+            df['Label'] = df['Label'].apply(lambda x: to_binary(x, binary_label))
+    else:
+        NUM_CLASSES = df['Label'].nunique()
+        num_classes_key = 'MULTICLASS'
+
+    # The test split is kept unseen until the final model is trained with train.py
+    split_indices = get_split_indices(df, dataset)
+    train_df = df.iloc[split_indices['train']]
+    val_df = df.iloc[split_indices['val']]
+
+    # Histograms of every (feature detection, K) pair, computed once and shared by all classifier combinations
+    features = {}
+    labels = {}
+    for algorithm in FEATURE_DETECTIONS:
+        split_descriptors = {}
+        for split, split_df in [('train', train_df), ('val', val_df)]:
+            image_paths = [os.path.join(DATA_FOLDER_PATH, path) for path in split_df['Split masked image path']]
+            descriptors = extract_descriptors(image_paths, algorithm, DESCRIPTOR_STORE_PATH, n_jobs=n_jobs)
+            usable = [i for i, descriptor in enumerate(descriptors) if descriptor is not None]
+            logger.info(f"Using {len(usable)}/{len(descriptors)} {split} images with {algorithm} features")
+            split_descriptors[split] = [descriptors[i] for i in usable]
+            labels[algorithm, split] = np.array(split_df['Label'].iloc[usable])
+
+        for k in K_VALUES:
+            features[algorithm, k] = build_features(split_descriptors['train'], split_descriptors['val'], k, vocabulary_params, histogram_params, random_state=1337)
+
+    combinations = [
+        (algorithm, classifier, k, parameters)
+        for algorithm in FEATURE_DETECTIONS
+        for classifier in CLASSIFIERS
+        for k in K_VALUES
+        for parameters in get_parameter_grid(classifier)
+    ]
+
+    logger.info(f"Evaluating {len(combinations)} combinations")
+
+    # Large feature arrays are memory-mapped to the worker processes by joblib instead of being copied for every task
+    results = Parallel(n_jobs=n_jobs, verbose=10 if verbose else 0)(
+        delayed(evaluate_combination)(features[algorithm, k], labels[algorithm, 'train'], labels[algorithm, 'val'], NUM_CLASSES, algorithm, classifier, k, parameters, profile)
+        for algorithm, classifier, k, parameters in combinations
+    )
+
+    results_df = pd.DataFrame(results).sort_values(by=[objective_function], ascending=False)
+
+    if binary:
+        target_variable_type = "binary"
+    else:
+        target_variable_type = "multiclass"
+
+    timestamp = strftime("%Y-%m-%d %H%M%S", gmtime())
+    filename = os.path.join(DATA_FOLDER_PATH, f'bag_of_words_hyperparameter_search_results_{dataset}_{target_variable_type}_at_{timestamp}.csv')
+    results_df.to_csv(filename, index=False)
+    logger.info(f'Writing results to file {filename}')
+
+    # The result dicts keep the original parameter types, which are lost in the DataFrame columns (e.g. None to NaN)
+    best_results = {}
+    for result in sorted(results, key=lambda result: result[objective_function], reverse=True):
+        best_results.setdefault((result['feature_detection'], result['classifier']), result)
+    best_results = list(best_results.values())
+
+    for result in best_results:
+        logger.info(f"Best {result['feature_detection']} {result['classifier']}: {result}")
+
+    if write:
+        write_best_parameters(params_file, num_classes_key, best_results)
+
+
+if __name__ == "__main__":
+    search_bow_hyperparameters()
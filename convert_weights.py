@@ -0,0 +1,55 @@
+import os
+import click
+import logging
+from utils.model_registry import get_models, get_artifact_path
+from utils.model_utils import get_model_path, get_other_json
+from utils.weight_store import WEIGHTS_EXTENSION, convert_to_weights
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+@click.command()
+@click.option('-id', '--identifier', type=str, multiple=True, help='Id of a model to convert. Can be given multiple times.')
+@click.option('-a', '--all', 'convert_all', is_flag=True, show_default=True, default=False, help='Convert all PyTorch models that have no memory-mapped weights yet.')
+@click.option('-rm', '--remove-pickle', is_flag=True, show_default=True, default=False, help='Remove the pickled .pt file after converting it.')
+@click.option('-v', '--verbose', is_flag=True, show_default=True, default=False, help='Print verbose logs.')
+def convert_weights(identifier, convert_all, remove_pickle, verbose):
+    """
+    Convert the pickled weights of trained PyTorch models to memory-mapped .weights files.
+
+    Models with a .weights file are loaded without unpickling or copying the weights, and processes loading the same
+    model share its memory. The .weights file is used instead of the .pt file whenever it exists.
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    if convert_all:
+        models = get_models()
+        identifier = [
+            id for id, model_name in zip(models['id'], models['model_name'])
+            if model_name != 'bag_of_words' and get_artifact_path(id, WEIGHTS_EXTENSION) is None
+        ]
+
+    if len(identifier) == 0:
+        raise ValueError("Give the ids of the models to convert, or --all.")
+
+    for id in identifier:
+        model_path = get_model_path(id)
+
+        if model_path.endswith('.joblib'):
+            raise ValueError(f"Model with id {id} is a bag of words model, only PyTorch weights can be converted")
+
+        if 'ARTIFACT_FORMAT' in get_other_json(id):
+            logger.info(f"Skipping model {id}, it is stored as {get_other_json(id)['ARTIFACT_FORMAT']}")
+            continue
+
+        weights_path = convert_to_weights(model_path)
+        logger.info(f"Converted model {id} to {weights_path}")
+
+        if remove_pickle:
+            os.remove(model_path)
+            logger.debug(f"Removed {model_path}")
+
+if __name__ == '__main__':
+    convert_weights()
@@ -0,0 +1,94 @@
+import copy
+import hashlib
+import logging
+from typing import Dict, Sequence, Tuple
+import torch
+from torch.utils.data import Dataset, DataLoader, Subset
+from torchvision import transforms
+from dataloaders.csv_data_loader import CSVDataLoader
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Decoded evaluation splits of this process, reused by every epoch and by the trials of a hyperparameter search,
+# which run one after another in the process. Other processes, e.g. parallel training runs, decode their own copy.
+_TENSOR_STORE: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+
+
+def get_evaluation_transform(image_size: Tuple[int, int]) -> transforms.Compose:
+    """Deterministic counterpart of the training transform, without normalization and as uint8."""
+    return transforms.Compose([
+        transforms.ToPILImage(),
+        transforms.Pad(50),
+        transforms.Resize(image_size),
+        transforms.PILToTensor()
+    ])
+
+
+def _store_key(dataset: CSVDataLoader, indices: Sequence[int], image_size: Tuple[int, int]) -> str:
+    image_paths = dataset.df[dataset.image_path_col].iloc[list(indices)].astype(str)
+    key = hashlib.sha1()
+    key.update(f"{dataset.root_dir}|{tuple(image_size)}|".encode())
+    key.update("\n".join(image_paths).encode())
+    return key.hexdigest()
+
+
+def get_cached_tensors(dataset: CSVDataLoader, indices: Sequence[int], image_size: Tuple[int, int], num_workers: int = 4) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Decode the given rows of the dataset once per process into a uint8 image tensor.
+
+    Subsequent calls in the process with the same rows and image size return the already decoded tensors. The
+    tensors are moved to shared memory, so DataLoader worker processes read them without copying.
+    """
+    key = _store_key(dataset, indices, image_size)
+
+    if key in _TENSOR_STORE:
+        return _TENSOR_STORE[key]
+
+    logger.info(f"Caching {len(indices)} evaluation images of size {image_size} in memory")
+
+    evaluation_dataset = copy.copy(dataset)
+    evaluation_dataset.transform = get_evaluation_transform(image_size)
+    dataloader = DataLoader(Subset(evaluation_dataset, list(indices)), batch_size=64, shuffle=False, num_workers=num_workers)
+
+    images = []
+    labels = []
+    for batch in dataloader:
+        images.append(batch['image'])
+        labels.append(batch['label'])
+
+    images = torch.cat(images).share_memory_()
+    labels = torch.cat(labels).share_memory_()
+
+    _TENSOR_STORE[key] = (images, labels)
+    return images, labels
+
+
+class CachedTensorDataset(Dataset):
+    """Evaluation dataset served from the in-memory uint8 tensor store of the process."""
+
+    def __init__(self, dataset: CSVDataLoader, indices: Sequence[int], image_size: Tuple[int, int], mean, std, num_workers: int = 4):
+        """
+        Args:
+            dataset (CSVDataLoader): Dataset to read the images from. Its own transform is not used.
+            indices (sequence of int): Rows of the dataset to cache, e.g. validation or test split.
+            image_size (tuple): Size (height, width) the images are resized to.
+            mean, std: Per channel values used for normalization.
+            num_workers (int): Number of worker processes used while decoding the images.
+        """
+        self.images, self.labels = get_cached_tensors(dataset, indices, image_size, num_workers=num_workers)
+        self.normalize = transforms.Normalize(mean=mean, std=std)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        image = self.normalize(self.images[idx].float().div(255))
+
+        sample = {'image': image, 'label': self.labels[idx]}
+
+        return sample
@@ -3,7 +3,7 @@
 from multiprocessing.sharedctypes import Value
 import os
 from torch.utils.data import DataLoader
-from dataloaders.csv_data_loader import CSVDataLoader
+from dataloaders.virtual_crop_data_loader import get_csv_data_loader
 from dotenv import load_dotenv
 import numpy as np
 from torchvision import transforms
@@ -35,7 +35,7 @@ def get_normalization_mean_std(dataset: str = None, datasheet : str = None):
         transforms.ToTensor()
     ])
 
-    master_dataset = CSVDataLoader(
+    master_dataset = get_csv_data_loader(
         csv_file=MASTER_PATH,
         root_dir=DATA_FOLDER_PATH,
         image_path_col="Split masked image path",
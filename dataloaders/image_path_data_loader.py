@@ -0,0 +1,38 @@
+from torch.utils.data import Dataset
+import cv2
+import numpy as np
+import torch
+
+
+class ImagePathDataLoader(Dataset):
+    """Images of a list of paths for prediction, decoded as BGR by cv2.imread and resized to the model input size."""
+
+    def __init__(self, image_paths, image_size):
+        """
+        Args:
+            image_paths (list): Full paths of the images.
+            image_size (tuple): Size (width, height) the images are resized to, see utils.model_utils.get_image_size.
+        """
+        self.image_paths = image_paths
+        self.image_size = image_size
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        img_path = self.image_paths[idx]
+        image = cv2.imread(img_path)
+
+        # Unreadable images are returned as black images, so that a single file doesn't stop the whole batch
+        readable = image is not None
+        if readable:
+            image = cv2.resize(image, self.image_size)
+        else:
+            image = np.zeros((self.image_size[1], self.image_size[0], 3), np.uint8)
+
+        sample = {'image': torch.from_numpy(image), 'path': img_path, 'readable': readable}
+
+        return sample
@@ -0,0 +1,113 @@
+import os
+import hashlib
+import logging
+from typing import Dict, Iterable
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+load_dotenv()
+
+DATA_FOLDER_PATH = os.getenv("DATA_FOLDER_PATH")
+SPLITS_FOLDER = os.path.join(DATA_FOLDER_PATH, "splits")
+
+SPLIT_NAMES = ("train", "val", "test")
+
+
+def hash_image_paths(image_paths: Iterable[str]) -> np.ndarray:
+    """Stable 64-bit hashes of image paths, independent of the row order of the datasheet."""
+    hashes = [int.from_bytes(hashlib.blake2b(str(path).encode(), digest_size=8).digest(), "little") for path in image_paths]
+    return np.array(hashes, dtype=np.uint64)
+
+
+def get_split_manifest_path(dataset: str, split: str) -> str:
+    return os.path.join(SPLITS_FOLDER, f"{dataset}-{split}.npy")
+
+
+def _save_split(dataset: str, split: str, hashes: np.ndarray):
+    path = get_split_manifest_path(dataset, split)
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.sort(hashes))
+
+    os.replace(tmp_path, path)
+
+
+def create_split_manifest(image_hashes: np.ndarray, dataset: str) -> Dict[str, np.ndarray]:
+    """
+    Split the unique image hashes 80/10/10 to train, validation and test sets and write them to disk.
+
+    Hashes are ordered by value, which gives a pseudo-random permutation that doesn't depend on the row order.
+    """
+    unique_hashes = np.unique(image_hashes)
+
+    train_size = int(0.80 * len(unique_hashes))
+    val_size = (len(unique_hashes) - train_size) // 2
+
+    manifest = {
+        "train": unique_hashes[:train_size],
+        "val": unique_hashes[train_size:train_size + val_size],
+        "test": unique_hashes[train_size + val_size:],
+    }
+
+    if not os.path.exists(SPLITS_FOLDER):
+        os.makedirs(SPLITS_FOLDER)
+
+    for split, hashes in manifest.items():
+        _save_split(dataset, split, hashes)
+
+    logger.info(f"Wrote split manifest for dataset {dataset} to {SPLITS_FOLDER}")
+
+    return manifest
+
+
+def load_split_manifest(dataset: str) -> Dict[str, np.ndarray]:
+    """Memory-map the split manifest of the dataset. Returns None if the manifest has not been written yet."""
+    paths = {split: get_split_manifest_path(dataset, split) for split in SPLIT_NAMES}
+
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+
+    return {split: np.load(path, mmap_mode="r") for split, path in paths.items()}
+
+
+def get_split_indices(df: pd.DataFrame, dataset: str, image_path_col: str = "Split masked image path") -> Dict[str, np.ndarray]:
+    """
+    Row positions of the train, validation and test splits of the datasheet.
+
+    The manifest is created on the first call for the dataset. Images that have been added to the datasheet
+    afterwards are assigned to a split by their hash (80/10/10) and appended to the manifest, so existing
+    assignments never change.
+    """
+    image_hashes = hash_image_paths(df[image_path_col])
+
+    manifest = load_split_manifest(dataset)
+    if manifest is None:
+        manifest = create_split_manifest(image_hashes, dataset)
+
+    in_split = {split: np.isin(image_hashes, manifest[split]) for split in SPLIT_NAMES}
+
+    unassigned = ~(in_split["train"] | in_split["val"] | in_split["test"])
+    if unassigned.any():
+        new_hashes = np.unique(image_hashes[unassigned])
+        logger.info(f"Adding {len(new_hashes)} new images to the split manifest of dataset {dataset}")
+
+        buckets = new_hashes % np.uint64(10)
+        new_splits = {
+            "train": new_hashes[buckets < 8],
+            "val": new_hashes[buckets == 8],
+            "test": new_hashes[buckets == 9],
+        }
+
+        for split in SPLIT_NAMES:
+            if len(new_splits[split]) == 0:
+                continue
+            _save_split(dataset, split, np.concatenate([np.asarray(manifest[split]), new_splits[split]]))
+            in_split[split] |= np.isin(image_hashes, new_splits[split])
+
+    return {split: np.flatnonzero(in_split[split]) for split in SPLIT_NAMES}
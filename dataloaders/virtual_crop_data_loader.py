@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import cv2
+import pandas as pd
+import torch
+from dataloaders.csv_data_loader import CSVDataLoader
+from segmentation.region_index import load_region_index, crop_region
+
+REGION_INDEX_PATH_COLUMN = "Region index path"
+REGION_INDEX_COLUMN = "Region index"
+
+
+class VirtualCropDataLoader(CSVDataLoader):
+    """
+    CSV data loader for data segmented with segment.py --index-only.
+
+    Instead of reading crop files, each crop is cut and masked from its source image using the region index
+    written by the segmentation. Decoded source images are kept in a small LRU cache, so the crops of the same
+    tray or leaf image are cropped from a single decode when they are read consecutively.
+    """
+
+    def __init__(self, csv_file, root_dir, image_path_col: str = "Split masked image path", label_col: str = "Label", transform=None, cache_size: int = 8):
+        """
+        Args:
+            csv_file (string): Path to the csv file with annotations and region index columns.
+            root_dir (string): Directory with all the images.
+            image_path_col: Image path column name in CSV, decides whether crops are cut from the masked
+                or the original source images
+            label_col: Label column name in CSV for classification
+            transform (callable, optional): Optional transform to be applied
+                on a sample.
+            cache_size: Number of decoded source images kept in memory per worker.
+        """
+        super().__init__(csv_file, root_dir, image_path_col, label_col, transform)
+        self.is_masked = "original" not in image_path_col.lower()
+        self.cache_size = cache_size
+        self._images = OrderedDict()
+        self._indexes = {}
+
+    def get_index(self, index_path):
+        if index_path not in self._indexes:
+            self._indexes[index_path] = load_region_index(index_path)
+        return self._indexes[index_path]
+
+    def get_source_image(self, image_path):
+        if image_path in self._images:
+            self._images.move_to_end(image_path)
+            return self._images[image_path]
+
+        image = cv2.imread(image_path)
+        if image is None:
+            raise FileNotFoundError(f"Could not read source image {image_path}")
+
+        self._images[image_path] = image
+        if len(self._images) > self.cache_size:
+            self._images.popitem(last=False)
+
+        return image
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        row = self.df.loc[self.df.index[idx]]
+
+        region_index = int(row[REGION_INDEX_COLUMN])
+        if region_index < 0:
+            raise ValueError(f"No region for {row[self.image_path_col]}, the segmentation of its source image produced a wrong number of crops")
+
+        index = self.get_index(self.build_path(row[REGION_INDEX_PATH_COLUMN]))
+        source_image_path = index['masked_image_path'] if self.is_masked else index['original_image_path']
+        image = self.get_source_image(self.build_path(source_image_path))
+        image = crop_region(image, index['regions'][region_index], index['type'], self.is_masked)
+
+        label_tensor = torch.tensor(row[self.label_col], dtype=torch.int64)
+        if self.transform:
+            image = self.transform(image)
+
+        sample = {'image': image, 'label': label_tensor}
+
+        return sample
+
+
+def get_csv_data_loader(csv_file, root_dir, image_path_col: str = "Split masked image path", label_col: str = "Label", transform=None) -> CSVDataLoader:
+    """VirtualCropDataLoader for CSVs of data segmented with --index-only, CSVDataLoader for the rest."""
+    columns = pd.read_csv(csv_file, nrows=0).columns
+
+    if REGION_INDEX_PATH_COLUMN in columns:
+        return VirtualCropDataLoader(csv_file, root_dir, image_path_col, label_col, transform)
+
+    return CSVDataLoader(csv_file, root_dir, image_path_col, label_col, transform)
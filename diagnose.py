@@ -0,0 +1,250 @@
+import os
+import json
+import click
+import logging
+import cv2
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from joblib import Parallel, delayed
+from typing import Dict, List, Tuple
+from models.model_factory import get_predictor, get_fully_convolutional_predictor
+from segmentation.separate_to_plants import crop_plants, get_plant_regions, get_plant_mask
+from segmentation.separate_leaves import crop_leaves
+from utils.model_utils import AVAILABLE_MODELS, get_model_info, get_model_id, get_image_size
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+load_dotenv()
+DATA_FOLDER_PATH = os.getenv('DATA_FOLDER_PATH')
+# Number of input images segmented before their crops are run through the model, bounds the memory used by the crops
+DIAGNOSIS_CHUNK_SIZE = 16
+
+@click.command()
+@click.option('-t', '--type', required=True, type=click.Choice(['plant', 'leaf'], case_sensitive=False), help='Whether the given images are tray images of plants or scans of leaves.')
+@click.option('-mi', '--masked-image', type=str, multiple=True, help='Path to a masked input image. Can be given multiple times, in the same order as --original-image.')
+@click.option('-oi', '--original-image', type=str, multiple=True, help='Path to the un-masked original image of the masked image. Can be given multiple times.')
+@click.option('-e', '--excel-path', type=str, help='Full file path to an Excel-file with "Masked image path" and "Original image path" columns relative to the data folder, as given to segment.py.')
+@click.option('-id', '--identifier', type=str, help="Model id. You can print model info with help.py.")
+@click.option('-m', '--model', type=click.Choice(AVAILABLE_MODELS, case_sensitive=False), help='Model architechture.')
+@click.option('-n', '--num-classes', type=int, help='Number of classes (2 in binary case, 4 in multi-class case).')
+@click.option('-d', '--dataset', type=str, help='Name of the dataset model is trained on.')
+@click.option('-s', '--source', type=click.Choice(['masked', 'original'], case_sensitive=False), show_default=True, default='masked', help='Whether the crops of the masked or the original images are diagnosed. Models are trained on the masked crops by default.')
+@click.option('-ds', '--downscale', type=click.FloatRange(min=1), show_default=True, default=1, help='Find the plants from a copy of the tray image downscaled by this factor, see segment.py. Only used with plant images.')
+@click.option('-fc', '--fully-convolutional', is_flag=True, show_default=True, default=False, help='Classify each tray with a single pass of a fully convolutional copy of the model, and pool the result inside each plant, instead of classifying each plant crop. Only for resnet18 models and plant images.')
+@click.option('-ts', '--tray-scale', type=float, show_default=True, default=1, help='Factor the tray images are resized by before the fully convolutional pass, e.g. 0.5. Only used with --fully-convolutional.')
+@click.option('-b', '--batch-size', type=int, show_default=True, default=32, help='Number of crops run through the model at once.')
+@click.option('-w', '--workers', type=int, show_default=True, default=1, help='Number of threads used to segment the images. -1 uses all cores.')
+@click.option('-o', '--output', type=str, help='Path of the report, JSON or CSV by the file extension. The JSON report is printed if not given.')
+@click.option('-v', '--verbose', is_flag=True, show_default=True, default=False, help='Print verbose logs.')
+def diagnose(type, masked_image, original_image, excel_path, identifier, model, num_classes, dataset, source, downscale, fully_convolutional, tray_scale, batch_size, workers, output, verbose):
+    """
+    Diagnose raw masked and original images in a single pass: the images are segmented in memory, all crops are
+    classified with one loaded model, and only the final report is written.
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    if not identifier and (not all([model, num_classes, dataset])):
+        raise ValueError("You must provide either model id or model architechture and num of classes and dataset.")
+
+    if fully_convolutional and type != 'plant':
+        raise ValueError("Fully convolutional inference is supported only for plant images.")
+
+    image_paths = get_image_paths(masked_image, original_image, excel_path)
+
+    logger.info("Loading the model")
+
+    model_id = get_model_id(identifier, model, num_classes, dataset)
+    model_data = get_model_info(id=model_id)
+    model_name = model_data['model_name'].item()
+    labels = json.loads(model_data['other_json'].item())['LABELS']
+
+    logger.debug(f"Using the model with id: {model_id}")
+
+    if fully_convolutional:
+        predictor = get_fully_convolutional_predictor(model_id, scale=tray_scale)
+        report = diagnose_trays(predictor, image_paths, labels, source, downscale)
+    else:
+        predictor = get_predictor(model_id, batch_size=batch_size)
+        report = diagnose_images(predictor, image_paths, type, labels, get_image_size(model_name), source, downscale, workers)
+
+    if output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        write_report(report, output)
+        logger.info(f'Diagnosis report can be found from {output}')
+
+    return report
+
+def get_image_paths(masked_images, original_images, excel_path) -> List[Tuple[str, str]]:
+    if len(masked_images) != len(original_images):
+        raise ValueError("Give an original image for each masked image.")
+
+    image_paths = list(zip(masked_images, original_images))
+
+    if excel_path:
+        df = pd.read_excel(excel_path)
+        image_paths += [
+            (os.path.join(DATA_FOLDER_PATH, masked), os.path.join(DATA_FOLDER_PATH, original))
+            for masked, original in zip(df['Masked image path'], df['Original image path'])
+        ]
+
+    if len(image_paths) == 0:
+        raise ValueError("You must provide the images with --masked-image and --original-image or --excel-path.")
+
+    # Rows of the same images in the Excel-file would produce the same crops
+    return list(dict.fromkeys(image_paths))
+
+def get_crops(masked_image_path, original_image_path, image_type, crop_size, source='masked', downscale=1) -> List[np.ndarray]:
+    """
+    Crops of the plants or leaves of an image pair, resized to the input size of the model.
+
+    The crops are the same images predict.py reads from the crop files written by segment.py.
+    """
+    masked_image = cv2.imread(masked_image_path)
+    original_image = cv2.imread(original_image_path)
+
+    if masked_image is None or original_image is None:
+        raise ValueError(f"Could not read images {masked_image_path} and {original_image_path}")
+
+    if image_type == 'plant':
+        masked_crops, original_crops = crop_plants(masked_image, original_image, downscale)
+    else:
+        # Leaf crops are written from RGB images, so the crop files the models are trained on hold the RGB crops
+        masked_crops, original_crops = crop_leaves(cv2.cvtColor(masked_image, cv2.COLOR_BGR2RGB), cv2.cvtColor(original_image, cv2.COLOR_BGR2RGB))
+
+    crops = masked_crops if source == 'masked' else original_crops
+
+    return [cv2.resize(crop, crop_size) for crop in crops]
+
+def aggregate_probabilities(probabilities: np.ndarray, labels: List[str]) -> Dict:
+    """Mean probabilities over the crops of an image, leaving out the crops that could not be classified."""
+    usable = ~np.isnan(probabilities).any(axis=1)
+
+    if not usable.any():
+        return {'probabilities': None, 'prediction': None}
+
+    mean_probabilities = probabilities[usable].mean(axis=0)
+
+    return {
+        'probabilities': dict(zip(labels, mean_probabilities.tolist())),
+        'prediction': labels[int(np.argmax(mean_probabilities))],
+    }
+
+def diagnose_images(predictor, image_paths, image_type, labels, crop_size, source='masked', downscale=1, workers=1) -> List[Dict]:
+    """
+    Per-crop and per-image probabilities for (masked image path, original image path) pairs.
+
+    Crops of each chunk of images are classified together in batches with the already loaded predictor.
+    """
+    report = []
+
+    with Parallel(n_jobs=workers, prefer='threads') as parallel:
+        for start in range(0, len(image_paths), DIAGNOSIS_CHUNK_SIZE):
+            chunk = image_paths[start:start + DIAGNOSIS_CHUNK_SIZE]
+
+            logger.info(f'Segmenting images {start + 1}-{start + len(chunk)}/{len(image_paths)}')
+
+            # OpenCV releases the GIL, so the images are segmented in threads without copying them between processes
+            chunk_crops = parallel(
+                delayed(get_crops)(masked_image_path, original_image_path, image_type, crop_size, source, downscale)
+                for masked_image_path, original_image_path in chunk
+            )
+
+            crops = [crop for image_crops in chunk_crops for crop in image_crops]
+            logger.debug(f'Classifying {len(crops)} crops')
+            probabilities = predictor.predict_proba(crops) if len(crops) > 0 else np.empty((0, len(labels)))
+
+            offset = 0
+            for (masked_image_path, original_image_path), image_crops in zip(chunk, chunk_crops):
+                image_probabilities = probabilities[offset:offset + len(image_crops)].reshape(len(image_crops), len(labels))
+                offset += len(image_crops)
+
+                report.append(get_image_result(masked_image_path, original_image_path, image_probabilities, labels))
+
+    return report
+
+def diagnose_trays(predictor, image_paths, labels, source='masked', downscale=1) -> List[Dict]:
+    """
+    Per-plant and per-image probabilities for (masked image path, original image path) pairs of tray images,
+    classifying each tray with a single pass of a FullyConvolutionalPredictor.
+    """
+    report = []
+
+    for i, (masked_image_path, original_image_path) in enumerate(image_paths):
+        logger.info(f'Diagnosing tray {i + 1}/{len(image_paths)}')
+
+        masked_image = cv2.imread(masked_image_path)
+
+        if masked_image is None:
+            raise ValueError(f"Could not read image {masked_image_path}")
+
+        regions = get_plant_regions(masked_image, downscale)
+
+        if source == 'masked':
+            image = masked_image
+        else:
+            image = cv2.imread(original_image_path)
+
+            if image is None:
+                raise ValueError(f"Could not read image {original_image_path}")
+
+            # The original crops are masked with the plant masks, so everything outside the plants is left out here too
+            plant_mask = np.zeros(image.shape[:2], np.uint8)
+            for (x, y, w, h), contour in regions:
+                plant_mask[y:y+h, x:x+w] |= get_plant_mask(contour, (x, y, w, h))
+            image = cv2.bitwise_and(image, image, mask=plant_mask)
+
+        probabilities = predictor.predict_regions(image, regions).reshape(len(regions), len(labels))
+
+        report.append(get_image_result(masked_image_path, original_image_path, probabilities, labels))
+
+    return report
+
+def get_image_result(masked_image_path, original_image_path, probabilities: np.ndarray, labels: List[str]) -> Dict:
+    """Report entry of an image from the probabilities of its crops, rows of crops that could not be classified are NaN."""
+    crop_results = []
+    for i, crop_probabilities in enumerate(probabilities):
+        if np.isnan(crop_probabilities).any():
+            crop_results.append({'index': i, 'probabilities': None, 'prediction': None})
+        else:
+            crop_results.append({
+                'index': i,
+                'probabilities': dict(zip(labels, crop_probabilities.tolist())),
+                'prediction': labels[int(np.argmax(crop_probabilities))],
+            })
+
+    return {
+        'masked_image_path': masked_image_path,
+        'original_image_path': original_image_path,
+        'number_of_crops': len(probabilities),
+        **aggregate_probabilities(probabilities, labels),
+        'crops': crop_results,
+    }
+
+def write_report(report: List[Dict], output_path: str):
+    """JSON report as it is, or CSV report with a row per crop and the aggregated result of its image."""
+    if os.path.splitext(output_path)[1].lower() != '.csv':
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return
+
+    records = []
+    for image_result in report:
+        for crop_result in image_result['crops']:
+            records.append({
+                'Masked image path': image_result['masked_image_path'],
+                'Original image path': image_result['original_image_path'],
+                'Crop index': crop_result['index'],
+                **{f'Probability {label}': probability for label, probability in (crop_result['probabilities'] or {}).items()},
+                'Prediction': crop_result['prediction'],
+                'Image prediction': image_result['prediction'],
+            })
+
+    pd.DataFrame(records).to_csv(output_path, index=False)
+
+if __name__ == '__main__':
+    diagnose()
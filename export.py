@@ -0,0 +1,96 @@
+import click
+import logging
+import torch
+from models.model_factory import load_trained_model
+from models.fusion import optimize_for_inference
+from utils.model_utils import get_model_info, get_other_json, get_image_size, store_model_and_add_info_to_df
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+EXPORTABLE_MODELS = ['resnet18', 'inception_v3']
+# Largest accepted difference of the logits of the exported and the original model on random images, relative to
+# the largest logit. Folding changes the order of the floating point operations, so the logits aren't bit-exact.
+MAX_RELATIVE_DIFFERENCE = 1e-4
+
+@click.command()
+@click.option('-id', '--identifier', required=True, type=str, help="Id of the model to export. You can print model info with help.py.")
+@click.option('-t', '--tolerance', type=float, show_default=True, default=MAX_RELATIVE_DIFFERENCE, help='Largest accepted difference of the logits of the exported and the original model, relative to the largest logit.')
+@click.option('-s/-nos', '--save/--no-save', show_default=True, default=True, help='Save the exported model and add it to the model dataframe as a new model.')
+@click.option('-v', '--verbose', is_flag=True, show_default=True, default=False, help='Print verbose logs.')
+def export(identifier, tolerance, save, verbose):
+    """
+    Export a trained model for inference: the batch norms are folded into the convolutions before them and the
+    auxiliary classifier of Inception is dropped, so the model always returns plain logits.
+
+    The exported model is stored as TorchScript with a new id and can be used like any other model. The original
+    model is kept for training and for whole-tray inference.
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    model_info = get_model_info(identifier)
+
+    if len(model_info) == 0:
+        raise ValueError(f"Could not find model with id {identifier}")
+
+    model_name = model_info['model_name'].item()
+    num_classes = model_info['num_classes'].item()
+    other_json = get_other_json(identifier)
+
+    if model_name not in EXPORTABLE_MODELS:
+        raise ValueError(f"Export is supported for models {EXPORTABLE_MODELS}, model with id {identifier} is {model_name}")
+
+    if 'ARTIFACT_FORMAT' in other_json:
+        raise ValueError(f"Model with id {identifier} is already compiled to {other_json['ARTIFACT_FORMAT']}, export the original model instead")
+
+    logger.info("Loading the model")
+
+    model = load_trained_model(identifier, device='cpu')
+
+    width, height = get_image_size(model_name)
+    example_input = torch.randn(2, 3, height, width)
+
+    with torch.no_grad():
+        expected_output = model(example_input)
+
+        summary = optimize_for_inference(model)
+        logger.info(f"Folded {summary['folded_batch_norms']} batch norms" + (", stripped the auxiliary classifier" if summary.get('stripped_aux_logits') else ""))
+
+        exported_model = torch.jit.trace(model, example_input)
+        difference = ((exported_model(example_input) - expected_output).abs().max() / expected_output.abs().max()).item()
+
+    logger.info(f"Largest relative difference of the logits of the exported and the original model: {difference:.2e}")
+
+    if difference > tolerance:
+        raise ValueError(f"The exported model differs from the original model by {difference:.2e} relative to the largest logit, more than the tolerance {tolerance:.2e}")
+
+    if save:
+        logger.info("Saving the exported model")
+
+        metrics = ['precision', 'recall', 'train_accuracy', 'train_loss', 'validation_accuracy', 'validation_loss', 'test_accuracy', 'test_loss', 'f1_score']
+
+        model_id = store_model_and_add_info_to_df(
+            model = exported_model,
+            model_name = model_name,
+            description = f"Inference export of {identifier}",
+            dataset = model_info['dataset'].item(),
+            num_classes = num_classes,
+            # Folding doesn't change the predictions, so the results of the original model hold
+            **{metric: model_info[metric].item() for metric in metrics},
+            other_json = {
+                **other_json,
+                'ARTIFACT_FORMAT': 'torchscript',
+                'EXPORT': {
+                    'base_model_id': identifier,
+                    **summary,
+                    'max_relative_difference': difference,
+                },
+            },
+        )
+
+        logger.info(f"Exported model saved with id {model_id}")
+
+if __name__ == '__main__':
+    export()
@@ -1,9 +1,9 @@
 import click
 import pandas as pd
 from dotenv import load_dotenv
-import os
 import logging
 from tabulate import tabulate
+from utils.model_registry import MODELS_CSV, get_models, import_csv, export_csv
 
 logging.basicConfig() 
 logger = logging.getLogger(__name__)
@@ -11,21 +11,32 @@ logger.setLevel(logging.INFO)
 
 load_dotenv()
 
-DATA_FOLDER = os.getenv("DATA_FOLDER_PATH")
-MODELS_CSV = os.path.join(DATA_FOLDER, "models.csv")
-
 @click.command()
 @click.option('-l', '--list', is_flag=True, default=False, help='List available models.')
-def help(list):
+@click.option('-m', '--model', type=str, help='List only the models of this architecture, e.g. resnet18.')
+@click.option('-d', '--dataset', type=str, help='List only the models trained on this dataset.')
+@click.option('-i', '--import-csv', 'import_path', type=str, help=f'Add the models of a CSV-file in the format of models.csv to the model registry. The {MODELS_CSV} is imported automatically when the registry is created.')
+@click.option('-r', '--replace', is_flag=True, default=False, help='Replace models of the registry with the imported models of the same id.')
+@click.option('-e', '--export-csv', 'export_path', type=str, help='Write the model registry to a CSV-file in the format of models.csv.')
+def help(list, model, dataset, import_path, replace, export_path):
+  if import_path:
+    added = import_csv(import_path, replace=replace)
+    logger.info(f"Imported {added} models from {import_path}")
+
+  if export_path:
+    export_csv(export_path)
+    logger.info(f"Model registry exported to {export_path}")
+
   if list:
-    models = pd.read_csv(MODELS_CSV)
+    attributes = {'model_name': model, 'dataset': dataset}
+    models = get_models(**{column: value for column, value in attributes.items() if value is not None})
     pd.options.display.max_columns = len(models.columns)
     print(tabulate(models, headers="keys", tablefmt="fancy_grid"))
-  else:
+  elif not import_path and not export_path:
       print("""
           Usage: help.py [OPTIONS]
           Try 'help.py --help' for help.
       """)
 
 if __name__ == "__main__":
-    help()
\ No newline at end of file
+    help()
@@ -3,9 +3,12 @@ import os
 from time import strftime, gmtime
 import click
 from sklearn.metrics import f1_score
-from torch.utils.data import DataLoader
-from dataloaders.csv_data_loader import CSVDataLoader
+from torch.utils.data import DataLoader, Subset
+from dataloaders.virtual_crop_data_loader import get_csv_data_loader
+from dataloaders.cached_tensor_dataset import CachedTensorDataset
+from dataloaders.split_manifest import get_split_indices
 from models.model_factory import get_model_class
+from models.inception import InceptionOutputs
 from dotenv import load_dotenv
 import matplotlib.pyplot as plt
 from torchvision import transforms
@@ -175,7 +178,7 @@ def objective(trial, MODEL_NAME, NUM_CLASSES, N_EPOCHS, OPTIMIZER_SEARCH_SPACE,
                 target = target.eq(3).type(torch.int64) # For binary classification, transform labels to one-vs-rest
             total += data.shape[0]
             output = model(data)
-            if (len(output) == 2):
+            if isinstance(output, InceptionOutputs):
                 output = output.logits
             train_loss = loss_function(output, target)
             train_loss.backward()
@@ -389,13 +392,14 @@ def search_hyperparameters(model, no_of_epochs, early_stopping_counter, no_of_tr
         EARLYSTOPPING_PATIENCE = min(max(3, N_EPOCHS//7), 20) # By default early stopping patience (i.e. the number of consequtive epochs with no decrease in training loss) is one seventh (rounded down) of the number of epochs and max 20
 
     MODEL_NAME = model
+    IMAGE_SIZE = (299, 299) if MODEL_NAME == "inception_v3" else (256, 256)
     if augmentation:
         data_transform = transforms.Compose([
             transforms.ToPILImage(),
             transforms.Pad(50),
             transforms.RandomRotation(180),
             transforms.RandomAffine(translate=(0.1, 0.1), degrees=0),
-            transforms.Resize((299, 299)) if MODEL_NAME == "inception_v3" else transforms.Resize((256, 256)),
+            transforms.Resize(IMAGE_SIZE),
             transforms.ToTensor(),
             transforms.Normalize(mean=mean, std=std),
         ])
@@ -403,7 +407,7 @@ def search_hyperparameters(model, no_of_epochs, early_stopping_counter, no_of_tr
         data_transform = transforms.Compose([
             transforms.ToPILImage(),
             transforms.Pad(50),
-            transforms.Resize((299, 299)) if MODEL_NAME == "inception_v3" else transforms.Resize((256, 256)),
+            transforms.Resize(IMAGE_SIZE),
             transforms.ToTensor(),
             transforms.Normalize(mean=mean, std=std)
         ])
@@ -421,7 +425,7 @@ def search_hyperparameters(model, no_of_epochs, early_stopping_counter, no_of_tr
     if ("adagrad" in OPTIMIZERS):
         OPTIMIZER_SEARCH_SPACE.append("Adagrad")
 
-    plant_master_dataset = CSVDataLoader(
+    plant_master_dataset = get_csv_data_loader(
         csv_file=DATA_MASTER_PATH,
         root_dir=DATA_FOLDER_PATH,
         image_path_col="Split masked image path",
@@ -429,15 +433,15 @@ def search_hyperparameters(model, no_of_epochs, early_stopping_counter, no_of_tr
         transform=data_transform
     )
 
-    train_size = int(0.80 * len(plant_master_dataset))
-    val_size = (len(plant_master_dataset) - train_size)//2
-    test_size = len(plant_master_dataset) - train_size - val_size
-
-    # Use a given seed for the random split so that the test split data can be kept unseen during hyperparameter optimization, until the test is performed in train.py
-    train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(plant_master_dataset, [train_size, val_size, test_size], generator=torch.Generator().manual_seed(42))
+    # Use the persisted split manifest so that the test split data can be kept unseen during hyperparameter optimization, until the test is performed in train.py
+    split_indices = get_split_indices(plant_master_dataset.df, dataset)
+    train_dataset = Subset(plant_master_dataset, split_indices['train'])
+    val_dataset = Subset(plant_master_dataset, split_indices['val'])
 
     train_plant_dataloader = DataLoader(train_dataset, batch_size=BATCH_SIZE_TRAIN, shuffle=True, num_workers=0)
-    val_plant_dataloader = DataLoader(val_dataset, batch_size=BATCH_SIZE_VALID, shuffle=True, num_workers=0)
+    # Validation images are decoded once with a deterministic transform and reused in every epoch and trial
+    val_cached_dataset = CachedTensorDataset(plant_master_dataset, val_dataset.indices, IMAGE_SIZE, mean, std)
+    val_plant_dataloader = DataLoader(val_cached_dataset, batch_size=BATCH_SIZE_VALID, shuffle=False, num_workers=0)
 
     if torch.cuda.is_available():
         device = torch.device('cuda')
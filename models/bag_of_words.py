@@ -1,18 +1,39 @@
-import cv2
 import numpy as np
 import os
-from scipy.cluster.vq import kmeans, vq
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC, LinearSVC
 from sklearn.metrics import accuracy_score, f1_score, log_loss
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.calibration import CalibratedClassifierCV
+try:
+    # Since scikit-learn 1.6 a fitted classifier is calibrated as a frozen estimator, cv='prefit' was removed in 1.8
+    from sklearn.frozen import FrozenEstimator
+except ImportError:
+    FrozenEstimator = None
+from sklearn.model_selection import train_test_split
 import xgboost as xgb
 import logging
+from joblib import Parallel, delayed
+from models.descriptor_store import extract_descriptors, compute_descriptors, FEATURE_DETECTION_ALGORITHMS
+from models.vocabulary import build_vocabulary, build_histograms, compute_idf, normalize_histograms
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+def get_training_profile(bow_params):
+    """Training profile named by TRAINING_PROFILE in the bag_of_words parameters, an empty profile if it is null."""
+    training_profile = bow_params.get('TRAINING_PROFILE')
+
+    if training_profile is None:
+        return {}
+
+    profiles = bow_params.get('PROFILES', {})
+    if training_profile not in profiles:
+        raise ValueError(f"Unknown training profile {training_profile}, available profiles: {list(profiles)}")
+
+    return profiles[training_profile] or {}
+
 # TODO: Use this earlier in training and predicting scripts for all models
 def to_binary(original_label, binary_label):
     if original_label == binary_label: # VD or co-infected is 3 in both leaf and plant datasets
@@ -20,23 +41,32 @@ def to_binary(original_label, binary_label):
     else:
         return 0
 class BagOfWords:
-    def __init__(self, data_folder_path, num_classes, feature_detection = 'SIFT', classifier = 'XGBoost', name = None):
+    def __init__(self, data_folder_path, num_classes, feature_detection = 'SIFT', classifier = 'XGBoost', name = None, n_jobs = -1, histogram_normalization = None, sparse_histograms = False):
         self.NUM_CLASSES = num_classes
         self.feature_detection = feature_detection
         self.classifier = classifier
+        # None, 'l2' or 'tfidf', see models.vocabulary.normalize_histograms
+        self.histogram_normalization = histogram_normalization
+        self.sparse_histograms = sparse_histograms
+        # Inverse document frequencies of the words, fitted in detect_features when using tfidf
+        self.idf = None
         self.RANDOM_STATE = 1337
         self.DATA_FOLDER_PATH = data_folder_path
+        self.DESCRIPTOR_STORE_PATH = os.path.join(data_folder_path, 'descriptors')
+        # Number of processes used for descriptor extraction
+        self.n_jobs = n_jobs
         if name is not None:
             self.name = name
 
-    def detect_features(self, data, k = 200):
+    def get_descriptors(self, data):
+        image_paths = [os.path.join(self.DATA_FOLDER_PATH, path) for path in data['Split masked image path']]
+        descriptors = extract_descriptors(image_paths, self.feature_detection, self.DESCRIPTOR_STORE_PATH, n_jobs=self.n_jobs)
+        return zip(data.index, image_paths, descriptors)
+
+    def detect_features(self, data, k = 200, vocabulary_parameters={}):
         feature_detection_algorithm = self.feature_detection
 
-        if feature_detection_algorithm == 'SIFT':
-            detector = cv2.SIFT_create()
-        elif feature_detection_algorithm == 'ORB':
-            detector = cv2.ORB_create()
-        else:
+        if feature_detection_algorithm not in FEATURE_DETECTION_ALGORITHMS:
             raise ValueError("Unknown feature detection algorithm. Accepted values are 'ORB', 'SIFT'.")
 
         logger.info(f'Detecting features using {feature_detection_algorithm} algorithm.')
@@ -44,58 +74,64 @@ class BagOfWords:
         descriptor_list = []
         to_be_removed = []
 
-        for index, row in data.iterrows():
-            image_path = os.path.join(self.DATA_FOLDER_PATH, row['Split masked image path'])
-            img = cv2.imread(image_path)
-            if feature_detection_algorithm == 'SIFT':
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-            keypoints, descriptor = detector.detectAndCompute(img, None)
+        for index, image_path, descriptor in self.get_descriptors(data):
             if descriptor is None:
                 logger.info(f'Could not detect features for image {image_path}, excluding it from the training data.')
                 to_be_removed.append(index)
             else:
                 descriptor_list.append((image_path, descriptor))
 
-        descriptors = descriptor_list[0][1]
-
         if len(to_be_removed) > 0:
             logger.info(f"Train data length before excluding images that weren't usable for feature detection: {len(data)}")
             data.drop(to_be_removed, inplace=True)
             logger.info(f"Train data length after excluding images that weren't usable for feature detection: {len(data)}")
 
-        for image_path, descriptor in descriptor_list[1:]:
-            descriptors = np.vstack((descriptors, descriptor))
-
-        descriptors_float = descriptors.astype(float)
+        # Descriptors are stacked with a single copy and clustered in float32
+        voc = build_vocabulary([descriptor for image_path, descriptor in descriptor_list], k, vocabulary_parameters, random_state=self.RANDOM_STATE)
 
-        voc, variance = kmeans(descriptors_float, k, 1)
+        img_features = build_histograms([descriptor for image_path, descriptor in descriptor_list], voc, sparse=self.sparse_histograms)
 
-        img_features = np.zeros((len(data), k), "float32")
-        for i in range(len(data)):
-            words, distance = vq(descriptor_list[i][1], voc)
-            for w in words:
-                img_features[i][w] += 1
+        if self.histogram_normalization == 'tfidf':
+            self.idf = compute_idf(img_features)
+        img_features = normalize_histograms(img_features, self.histogram_normalization, self.idf)
 
-        stdslr = StandardScaler().fit(img_features)
+        # Centering would make sparse histograms dense
+        stdslr = StandardScaler(with_mean=not self.sparse_histograms).fit(img_features)
         img_features = stdslr.transform(img_features)
 
         # image features needed for training the classifier
-        # voc and fitted standard scaler needed for prediction
+        # voc (vocabulary with its quantisation index) and fitted standard scaler needed for prediction
         return (img_features, voc, stdslr)
 
-    def fit(self, data, img_features, binary_label, parameters={}):
+    def fit(self, data, img_features, binary_label, parameters={}, profile={}):
+        """
+        Train the classifier on the image features.
+
+        profile is a training profile from hyperparams.yaml (bag_of_words.PROFILES). An empty profile trains as before:
+            N_JOBS: Number of cores used by XGBoost and RandomForest.
+            XGB_TREE_METHOD: XGBoost tree method, e.g. 'hist'.
+            SVM_CALIBRATION_SIZE: Fraction of the training data held out to calibrate the SVM probabilities,
+                instead of the internal cross-validation of SVC(probability=True).
+        """
         if self.NUM_CLASSES == 2 and len(data['Label'].unique()) > 2:
             data['Label'] = data['Label'].apply(lambda x: to_binary(x, binary_label))
 
         classifier = self.classifier
+        labels = np.array(data['Label'])
 
         if classifier == 'RandomForest':
             logger.info('Using RandomForest classifier')
-            clf = RandomForestClassifier(n_estimators=parameters['N_ESTIMATORS'], criterion=parameters['CRITERION'], max_depth=parameters['MAX_DEPTH'], min_samples_split=parameters['MIN_SAMPLES_SPLIT'], random_state=self.RANDOM_STATE)
+            clf = RandomForestClassifier(n_estimators=parameters['N_ESTIMATORS'], criterion=parameters['CRITERION'], max_depth=parameters['MAX_DEPTH'], min_samples_split=parameters['MIN_SAMPLES_SPLIT'], random_state=self.RANDOM_STATE, n_jobs=profile.get('N_JOBS'))
         elif classifier == 'XGBoost':
             logger.info('Using XGBoost classifier')
-            clf = xgb.XGBClassifier(learning_rate=parameters['LR'], gamma=parameters['GAMMA'], max_depth=parameters['MAX_DEPTH'], min_child_weight=parameters['MIN_CHILD_WEIGHT'], random_state=self.RANDOM_STATE)
+            clf = xgb.XGBClassifier(learning_rate=parameters['LR'], gamma=parameters['GAMMA'], max_depth=parameters['MAX_DEPTH'], min_child_weight=parameters['MIN_CHILD_WEIGHT'], random_state=self.RANDOM_STATE, tree_method=profile.get('XGB_TREE_METHOD'), n_jobs=profile.get('N_JOBS'))
+        elif classifier == 'SVM' and profile.get('SVM_CALIBRATION_SIZE'):
+            logger.info('Using SVM classifier with probabilities calibrated on a held-out slice')
+            features_train, features_calibration, labels_train, labels_calibration = train_test_split(img_features, labels, test_size=profile['SVM_CALIBRATION_SIZE'], stratify=labels, random_state=self.RANDOM_STATE)
+            svm = SVC(C=parameters['C'], kernel=parameters['KERNEL'], gamma=parameters['GAMMA'], random_state=self.RANDOM_STATE).fit(features_train, labels_train)
+            if FrozenEstimator is not None:
+                return CalibratedClassifierCV(FrozenEstimator(svm), method='sigmoid').fit(features_calibration, labels_calibration)
+            return CalibratedClassifierCV(svm, method='sigmoid', cv='prefit').fit(features_calibration, labels_calibration)
         elif classifier == 'SVM':
             logger.info('Using SVM classifier')
             clf = SVC(C=parameters['C'], kernel=parameters['KERNEL'], gamma=parameters['GAMMA'], probability=True, random_state=self.RANDOM_STATE)
@@ -105,7 +141,7 @@ class BagOfWords:
         else:
             raise ValueError("Unknown classifier. Accepted values are 'SVM', 'RandomForest', 'XGBoost'.")
 
-        clf.fit(img_features, np.array(data['Label']))
+        clf.fit(img_features, labels)
 
         return clf
 
@@ -113,23 +149,13 @@ class BagOfWords:
         if self.NUM_CLASSES == 2 and len(data_test['Label'].unique()) > 2:
             data_test['Label'] = data_test['Label'].apply(lambda x: to_binary(x, binary_label))
 
-        feature_detection_algorithm = self.feature_detection
-        if feature_detection_algorithm == 'SIFT':
-            detector = cv2.SIFT_create()
-        elif feature_detection_algorithm == 'ORB':
-            detector = cv2.ORB_create()
-        else:
+        if self.feature_detection not in FEATURE_DETECTION_ALGORITHMS:
             raise ValueError("Unknown feature detection algorithm. Accepted values are 'ORB', 'SIFT'.")
 
         descriptor_list_test = []
         to_be_removed_test = []
 
-        for index, row in data_test.iterrows():
-            image_path = os.path.join(self.DATA_FOLDER_PATH, row['Split masked image path'])
-            img = cv2.imread(image_path)
-            if feature_detection_algorithm == 'SIFT':
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            keypoints_test, descriptor_test = detector.detectAndCompute(img, None)
+        for index, image_path, descriptor_test in self.get_descriptors(data_test):
             if descriptor_test is None:
                 to_be_removed_test.append(index)
             else:
@@ -140,12 +166,8 @@ class BagOfWords:
             data_test.drop(to_be_removed_test, inplace=True)
             logger.info(f"Test data length after excluding images that weren't usable for feature detection: {len(data_test)}")
 
-        test_features = np.zeros((len(data_test), k), "float32")
-        for i in range(len(data_test)):
-            words, distance = vq(descriptor_list_test[i][1], voc)
-            for w in words:
-                test_features[i][w]+= 1
-
+        test_features = build_histograms([descriptor for image_path, descriptor in descriptor_list_test], voc, sparse=self.sparse_histograms)
+        test_features = normalize_histograms(test_features, self.histogram_normalization, self.idf)
         test_features = stdslr.transform(test_features)
 
         data_test['pred'] = classifier.predict(test_features)
@@ -163,32 +185,63 @@ class BagOfWords:
         # data_test['pred'] are the predicted classes
         return (data_test['pred'], accuracy, f1, loss)
 
-    def predict_single_image(image, model, feature_detection, k, voc, stdslr):
-        if feature_detection == 'SIFT':
-            detector = cv2.SIFT_create()
-        else:
-            detector = cv2.ORB_create()
-
-        descriptor_list = []
+    @staticmethod
+    def predict_single_image(image, model, feature_detection, k, voc, stdslr, histogram_normalization=None, idf=None):
+        predictor = BagOfWordsPredictor(model, feature_detection, voc, stdslr, histogram_normalization, idf, n_jobs=1)
+        probabilities = predictor.predict_proba([image])[0]
 
-        if feature_detection == 'SIFT':
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        keypoints, descriptor = detector.detectAndCompute(image, None)
-        if descriptor is None:
+        if np.isnan(probabilities).any():
             logger.info('Could not detect features.')
             return None
-        else:
-            descriptor_list.append((image, descriptor))
 
-        features = np.zeros((1, k), "float32")
-        words, distance = vq(descriptor_list[0][1], voc)
-        for w in words:
-            features[0][w]+= 1
+        return probabilities
 
-        features = stdslr.transform(features)
 
-        probs = model.predict_proba(features)
+class BagOfWordsPredictor:
+    """Bag of words inference with the classifier, vocabulary and fitted scaler loaded once and reused for every batch."""
+
+    def __init__(self, classifier, feature_detection, voc, stdslr, histogram_normalization=None, idf=None, n_jobs=-1):
+        """
+        Args:
+            classifier: Fitted classifier with predict_proba.
+            feature_detection (str): 'SIFT' or 'ORB', the algorithm the model was trained with.
+            voc: Vocabulary index (or plain vocabulary array of older models).
+            stdslr: Fitted standard scaler.
+            histogram_normalization (str): Histogram normalization the model was trained with.
+            idf (array): Inverse document frequencies with tfidf normalization.
+            n_jobs (int): Number of threads used for descriptor extraction.
+        """
+        if feature_detection not in FEATURE_DETECTION_ALGORITHMS:
+            raise ValueError("Unknown feature detection algorithm. Accepted values are 'ORB', 'SIFT'.")
 
-        probabilities = probs[0]
+        self.classifier = classifier
+        self.feature_detection = feature_detection
+        self.voc = voc
+        self.stdslr = stdslr
+        self.histogram_normalization = histogram_normalization
+        self.idf = idf
+        self.n_jobs = n_jobs
+
+    def get_descriptors(self, images):
+        # OpenCV releases the GIL during detection, so threads avoid copying the images to worker processes
+        return Parallel(n_jobs=self.n_jobs, prefer='threads')(delayed(compute_descriptors)(image, self.feature_detection) for image in images)
+
+    def predict_proba(self, images) -> np.ndarray:
+        """
+        Class probabilities for a batch of BGR images (as read by cv2.imread).
+
+        Returns array of shape (number of images, number of classes). Rows of images where no features could be
+        detected are NaN.
+        """
+        descriptors = self.get_descriptors(images)
+        usable = [i for i, descriptor in enumerate(descriptors) if descriptor is not None]
+
+        probabilities = np.full((len(images), len(self.classifier.classes_)), np.nan)
+
+        if len(usable) > 0:
+            features = build_histograms([descriptors[i] for i in usable], self.voc)
+            features = normalize_histograms(features, self.histogram_normalization, self.idf)
+            features = self.stdslr.transform(features)
+            probabilities[usable] = self.classifier.predict_proba(features)
 
         return probabilities
@@ -0,0 +1,109 @@
+import os
+import hashlib
+import logging
+import threading
+from typing import List, Optional
+import cv2
+import numpy as np
+from joblib import Parallel, delayed
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FEATURE_DETECTION_ALGORITHMS = ['SIFT', 'ORB']
+
+# Detectors are created once per process and thread and reused for every image
+_DETECTORS = threading.local()
+
+
+def get_detector(feature_detection: str):
+    detectors = _DETECTORS.__dict__
+
+    if feature_detection not in detectors:
+        if feature_detection == 'SIFT':
+            detectors[feature_detection] = cv2.SIFT_create()
+        elif feature_detection == 'ORB':
+            detectors[feature_detection] = cv2.ORB_create()
+        else:
+            raise ValueError("Unknown feature detection algorithm. Accepted values are 'ORB', 'SIFT'.")
+
+    return detectors[feature_detection]
+
+
+def compute_descriptors(image: np.ndarray, feature_detection: str) -> Optional[np.ndarray]:
+    """Compute descriptors of a BGR image. Returns None if no features could be detected."""
+    if feature_detection == 'SIFT':
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    keypoints, descriptor = get_detector(feature_detection).detectAndCompute(image, None)
+    return descriptor
+
+
+class DescriptorStore:
+    """On-disk store of per-image descriptors keyed by image path, file modification time and size, and detector."""
+
+    def __init__(self, folder: str, feature_detection: str):
+        if feature_detection not in FEATURE_DETECTION_ALGORITHMS:
+            raise ValueError("Unknown feature detection algorithm. Accepted values are 'ORB', 'SIFT'.")
+
+        self.folder = os.path.join(folder, feature_detection)
+        self.feature_detection = feature_detection
+
+    def get_key(self, image_path: str) -> str:
+        stat = os.stat(image_path)
+        key = f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}|{self.feature_detection}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get_path(self, image_path: str) -> str:
+        key = self.get_key(image_path)
+        return os.path.join(self.folder, key[:2], f"{key}.npy")
+
+    def load(self, image_path: str) -> Optional[np.ndarray]:
+        """Returns the stored descriptors, an empty array if the image had no features, or None if not stored."""
+        path = self.get_path(image_path)
+        if not os.path.exists(path):
+            return None
+        return np.load(path)
+
+    def save(self, image_path: str, descriptor: Optional[np.ndarray]):
+        path = self.get_path(image_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Images without features are stored as empty arrays so they are not processed again
+        if descriptor is None:
+            descriptor = np.empty((0, 0), dtype=np.uint8)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, descriptor)
+        os.replace(tmp_path, path)
+
+
+def _extract_and_store(image_path: str, store: DescriptorStore) -> Optional[np.ndarray]:
+    image = cv2.imread(image_path)
+    descriptor = compute_descriptors(image, store.feature_detection)
+    store.save(image_path, descriptor)
+    return descriptor
+
+
+def extract_descriptors(image_paths: List[str], feature_detection: str, store_folder: str, n_jobs: int = -1) -> List[Optional[np.ndarray]]:
+    """
+    Descriptors for every image, None for images where no features were detected.
+
+    Descriptors found from the store are reused and the rest are computed in a process pool and added to the store.
+    """
+    store = DescriptorStore(store_folder, feature_detection)
+
+    descriptors = [store.load(image_path) for image_path in image_paths]
+    missing = [i for i, descriptor in enumerate(descriptors) if descriptor is None]
+
+    logger.info(f'Found {len(image_paths) - len(missing)}/{len(image_paths)} {feature_detection} descriptors from the store.')
+
+    if len(missing) > 0:
+        logger.info(f'Computing {feature_detection} descriptors for {len(missing)} images.')
+        computed = Parallel(n_jobs=n_jobs)(delayed(_extract_and_store)(image_paths[i], store) for i in missing)
+        for i, descriptor in zip(missing, computed):
+            descriptors[i] = descriptor
+
+    return [descriptor if descriptor is not None and len(descriptor) > 0 else None for descriptor in descriptors]
@@ -0,0 +1,66 @@
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from models.model_parts import ResNetBlock
+from models.resnet import ResNet
+from models.inception import Inception3, BasicConv2d
+
+
+def fold_batch_norms(model: nn.Module) -> int:
+    """
+    Fold the BatchNorm2d layers of a trained ResNet or Inception3 into the convolutions before them, in place.
+
+    The folded batch norms are replaced with nn.Identity, so the outputs of the model in eval mode don't change.
+    The model can't be trained or loaded from a state dict of the model class after folding.
+
+    Returns the number of folded batch norms.
+    """
+    if model.training:
+        raise ValueError("Batch norms can be folded only in eval mode, call model.eval() first")
+
+    folded = 0
+
+    for module in list(model.modules()):
+        if isinstance(module, ResNet):
+            module.conv1 = fuse_conv_bn_eval(module.conv1, module.bn1)
+            module.bn1 = nn.Identity()
+            # The features share the stem layers, the blocks are folded below
+            module.features[0] = module.conv1
+            module.features[1] = module.bn1
+            folded += 1
+        elif isinstance(module, ResNetBlock):
+            module.conv1 = fuse_conv_bn_eval(module.conv1, module.bn1)
+            module.bn1 = nn.Identity()
+            module.conv2 = fuse_conv_bn_eval(module.conv2, module.bn2)
+            module.bn2 = nn.Identity()
+            folded += 2
+            if module.downsample is not None:
+                module.downsample = nn.Sequential(fuse_conv_bn_eval(module.downsample[0], module.downsample[1]))
+                folded += 1
+        elif isinstance(module, BasicConv2d):
+            module.conv = fuse_conv_bn_eval(module.conv, module.bn)
+            module.bn = nn.Identity()
+            folded += 1
+
+    return folded
+
+
+def strip_aux_logits(model: Inception3) -> bool:
+    """Drop the auxiliary classifier of Inception3, which is only used in training. Returns whether there was one."""
+    had_aux_logits = model.AuxLogits is not None
+    model.AuxLogits = None
+    model.aux_logits = False
+    return had_aux_logits
+
+
+def optimize_for_inference(model: nn.Module) -> dict:
+    """
+    Fold the batch norms and strip the training-only branches of a trained model in eval mode, in place.
+
+    Returns a summary of the changes, stored with the exported model.
+    """
+    summary = {'folded_batch_norms': fold_batch_norms(model)}
+
+    if isinstance(model, Inception3):
+        summary['stripped_aux_logits'] = strip_aux_logits(model)
+
+    return summary
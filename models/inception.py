@@ -20,8 +20,8 @@ InceptionOutputs.__annotations__ = {'logits': Tensor, 'aux_logits': Optional[Ten
 _InceptionOutputs = InceptionOutputs
 
 
-def inception3(num_classes=4) -> nn.Module:
-    return Inception3(num_classes=num_classes, name="inception_v3")
+def inception3(num_classes=4, init_weights=None) -> nn.Module:
+    return Inception3(num_classes=num_classes, init_weights=init_weights, name="inception_v3")
 
 class Inception3(nn.Module):
 
@@ -1,63 +1,59 @@
 from typing import Union
 from torch import nn
-from models.bag_of_words import BagOfWords
+from models.bag_of_words import BagOfWords, BagOfWordsPredictor
+from models.predictor import TorchPredictor, FullyConvolutionalPredictor
+from models.fusion import fold_batch_norms
 from models.resnet import resnet18
 from models.inception import inception3
 from models.vision_transformer import VisionTransformer, vision_transformer
 from dotenv import load_dotenv
-from utils.model_utils import split_model_file_name, get_model_info, AVAILABLE_MODELS
-from utils.time_utils import datetime_to_str, str_to_datetime
+from utils.model_utils import get_model_info, get_model_path, get_other_json, restore_object, AVAILABLE_MODELS
+from utils.model_registry import get_artifact_files, get_artifact_path, find_artifact
+from utils.weight_store import WEIGHTS_EXTENSION, load_weights, assign_weights
 import os
-from datetime import datetime
+import threading
 import torch
-import pandas as pd
 from typing import Union
+from joblib import load
 
 load_dotenv()
 
 DATA_FOLDER = os.getenv("DATA_FOLDER_PATH")
 MODEL_FOLDER = os.path.join(DATA_FOLDER, "models")
-MODEL_DF = pd.read_csv(os.path.join(DATA_FOLDER, "models.csv"))
+
+# The quantized engine is process-wide, it is set by the first quantized model loaded in the process
+_quantized_engine = None
+_quantized_engine_lock = threading.Lock()
 
 def get_model_class(name: str, num_of_classes: int, **kwargs) -> Union[nn.Module, BagOfWords]:
 
   if name not in AVAILABLE_MODELS:
     raise ValueError(f"Model type not supported, available models: {AVAILABLE_MODELS}")
 
+  # Only Inception can skip its weight initialization, done when trained weights are loaded into the model
+  init_weights = kwargs.pop('init_weights', None)
+
   # Names are defined in the class constructor function in the model declarations
   if name == 'resnet18':
     return resnet18(num_classes=num_of_classes)
   elif name == 'vision_transformer':
     return vision_transformer(num_classes=num_of_classes, **kwargs)
   elif name == 'inception_v3':
-    return inception3(num_classes=num_of_classes)
+    return inception3(num_classes=num_of_classes, init_weights=init_weights)
   elif name == 'bag_of_words':
     return BagOfWords(DATA_FOLDER, num_classes=num_of_classes)
 
 
 def get_trained_model_by_id(id: str) -> nn.Module:
-  models = os.listdir(MODEL_FOLDER)
-
-  # Filter models that don't contain the id
-  filtered_models = [model for model in models if id in model]
+  # The files of the model from the artifact index, a model can have both the pickled and the memory-mapped weights
+  model_files = list(dict.fromkeys(os.path.splitext(model_file)[0] for model_file in get_artifact_files(id)))
 
-  if len(filtered_models) == 0:
+  if len(model_files) == 0:
     raise ValueError(f"Could not find model with id {id}")
-  elif len(filtered_models) > 1:
+  elif len(model_files) > 1:
     raise ValueError(f"Found multiple models with id {id}")
 
-  model_file_name = filtered_models[0]
-  id, model_name, timestamp = split_model_file_name(model_file_name)
-  model_weight_path = os.path.join(MODEL_FOLDER, model_file_name)
-
-  model_info = get_model_info(id)
-  num_classes = model_info['num_classes'].item()
-
-  model_class = get_model_class(model_name, num_of_classes=num_classes)
-  model_class.load_state_dict(torch.load(model_weight_path))
-  model_class.eval()
-
-  return model_class
+  return load_trained_model(id)
 
 
 def get_trained_model(name: str, latest: bool = True, timestamp: str = None) -> nn.Module:
@@ -68,50 +64,148 @@ def get_trained_model(name: str, latest: bool = True, timestamp: str = None) ->
   if not latest and not timestamp:
     raise ValueError("Either latest flag or timestamp must be passed as an argument")
 
-  models = os.listdir(MODEL_FOLDER)
+  # Timestamp in the format of the model file names, e.g. 191026_0645
+  artifact = find_artifact(name, None if latest else timestamp)
+
+  if artifact is None:
+    if latest:
+      raise ValueError(f"Could not find a model with name {name}")
+    raise ValueError(f"Could not find a model with name {name} and timestamp {timestamp}")
+
+  model_id, model_file_name = artifact
+
+  return load_trained_model(model_id)
+
 
-  # Filter models that don't contain the name
-  filtered_models = [model for model in models if name in models]
+def load_trained_model(id: str, device: str = None) -> nn.Module:
+  """
+  Trained PyTorch model in eval mode.
 
-  if len(filtered_models) == 0:
-    raise ValueError(f"Could not find a model with name {name}")
+  The weights are memory-mapped from the .weights file of the model if it has one, see utils.weight_store, and
+  unpickled from the .pt file otherwise. Models stored as TorchScript, e.g. by export.py and quantize.py, are loaded
+  with load_torchscript_model.
+  """
+  model_info = get_model_info(id)
+
+  if len(model_info) == 0:
+    raise ValueError(f"Could not find model with id {id}")
 
-  if latest:
-    # datetime.min is always smaller than any other datetime
-    model_id = None
-    latest_model, latest_timestamp = None, datetime.min
-    for model in filtered_models:
-      id, model_name, timestamp = split_model_file_name(model)
+  other_json = get_other_json(id)
 
-      if timestamp > latest_timestamp:
-        model_id = id
-        latest_model = model
-        latest_timestamp = timestamp
+  if other_json.get('ARTIFACT_FORMAT') == 'torchscript':
+    model = load_torchscript_model(id, other_json)
+    model.eval()
+    # Quantized models run only on the CPU
+    return model.to(device) if device and 'QUANTIZATION' not in other_json else model
 
-    model_weight_path = os.path.join(MODEL_FOLDER, latest_model)
+  # The random initialization would be overwritten by the trained weights, and takes seconds for Inception
+  model = get_model_class(model_info['model_name'].item(), num_of_classes=model_info['num_classes'].item(), init_weights=False)
 
+  weights_path = get_artifact_path(id, WEIGHTS_EXTENSION)
+  if weights_path is not None:
+    assign_weights(model, load_weights(weights_path))
   else:
+    model.load_state_dict(torch.load(get_model_path(id), map_location=device or 'cpu'))
+
+  model.eval()
+
+  return model.to(device) if device else model
+
+
+def get_bag_of_words_predictor(id: str, n_jobs: int = -1) -> BagOfWordsPredictor:
+  """Load the classifier, vocabulary and standard scaler of a trained bag of words model once for batch inference."""
+  model_info = get_model_info(id)
+
+  if model_info['model_name'].item() != 'bag_of_words':
+    raise ValueError(f"Model with id {id} is not a bag of words model")
+
+  other_json = get_other_json(id)
+  idf = restore_object(other_json['idf']) if 'idf' in other_json else None
+
+  return BagOfWordsPredictor(
+    classifier=load(get_model_path(id)),
+    feature_detection=other_json['feature_detection'],
+    voc=restore_object(other_json['voc']),
+    stdslr=restore_object(other_json['standard_scaler']),
+    histogram_normalization=other_json.get('histogram_normalization'),
+    idf=idf,
+    n_jobs=n_jobs
+  )
 
-    model_id = None
-    timestamp_model = None
 
-    for model in filtered_models:
-      id, model_name, timestamp_str = split_model_file_name(model, return_as_str=True)
-      if timestamp == timestamp_str:
-        model_id = id
-        timestamp_model = model
+def get_predictor(id: str, device: str = None, batch_size: int = 32, n_jobs: int = -1) -> Union[TorchPredictor, BagOfWordsPredictor]:
+  """
+  Load a trained model once for batch inference.
+
+  Both predictors have predict_proba, which takes a list of BGR images resized to the input size of the model.
+  """
+  model_info = get_model_info(id)
+
+  if len(model_info) == 0:
+    raise ValueError(f"Could not find model with id {id}")
+
+  model_name = model_info['model_name'].item()
+
+  if model_name == 'bag_of_words':
+    return get_bag_of_words_predictor(id, n_jobs=n_jobs)
+
+  device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+  other_json = get_other_json(id)
+
+  # Quantized models run only on the CPU
+  if 'QUANTIZATION' in other_json:
+    device = 'cpu'
+
+  return TorchPredictor(load_trained_model(id, device), device=device, batch_size=batch_size)
+
+
+def load_torchscript_model(id: str, other_json: dict = None) -> torch.jit.ScriptModule:
+  """Load a model stored as TorchScript, e.g. a quantized model from quantize.py."""
+  other_json = other_json or get_other_json(id)
+
+  if 'QUANTIZATION' in other_json:
+    # Quantized models run on the CPU with the quantized engine they were converted for
+    use_quantized_engine(other_json['QUANTIZATION']['backend'], id)
+    return torch.jit.load(get_model_path(id), map_location='cpu')
+
+  return torch.jit.load(get_model_path(id))
+
+
+def use_quantized_engine(engine: str, id: str = None):
+  """
+  Set the quantized engine of the process for a quantized model. Models quantized for different engines can't run
+  in the same process, switching the engine would break the models already loaded.
+  """
+  global _quantized_engine
+
+  with _quantized_engine_lock:
+    if _quantized_engine is None:
+      torch.backends.quantized.engine = engine
+      _quantized_engine = engine
+    elif _quantized_engine != engine:
+      raise ValueError(f"Model with id {id} is quantized for the {engine} engine, but the process already runs quantized models with the {_quantized_engine} engine")
+
+
+def get_fully_convolutional_predictor(id: str, device: str = None, scale: float = 1) -> FullyConvolutionalPredictor:
+  """Load a trained ResNet once for whole-tray inference, see FullyConvolutionalPredictor."""
+  model_info = get_model_info(id)
+
+  if len(model_info) == 0:
+    raise ValueError(f"Could not find model with id {id}")
 
+  model_name = model_info['model_name'].item()
 
-    if not timestamp_model:
-      raise ValueError(f"Could not find a model with name {name} and timestamp {timestamp}")
+  if model_name != 'resnet18':
+    raise ValueError(f"Fully convolutional inference is supported only for resnet18 models, model with id {id} is {model_name}")
 
-    model_weight_path = os.path.join(MODEL_FOLDER, timestamp_model)
+  if get_other_json(id).get('ARTIFACT_FORMAT') == 'torchscript':
+    raise ValueError(f"Fully convolutional inference needs the weights of the model, model with id {id} is stored as TorchScript")
 
-  model_info = get_model_info(model_id)
-  num_classes = model_info['num_classes'].item()
+  device = device or ("cuda" if torch.cuda.is_available() else "cpu")
 
-  model_class = get_model_class(name, num_of_classes=num_classes)
-  model_class.load_state_dict(torch.load(model_weight_path))
-  model_class.eval()
+  model = load_trained_model(id, device)
+  # Whole trays are large inputs, the folded batch norms save a pass over every feature map
+  fold_batch_norms(model)
 
-  return model_class
+  return FullyConvolutionalPredictor(model, device=device, scale=scale)
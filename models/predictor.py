@@ -0,0 +1,126 @@
+import logging
+from typing import List, Tuple
+import cv2
+import numpy as np
+import torch
+from torch import nn
+from models.resnet import ResNet, FullyConvolutionalResNet
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TorchPredictor:
+    """Inference of a trained PyTorch model, loaded once and reused for every batch of images."""
+
+    def __init__(self, model: nn.Module, device: str = None, batch_size: int = 32):
+        """
+        Args:
+            model (nn.Module): Model with the trained weights loaded.
+            device (str): Device to run the model on, by default cuda if it is available.
+            batch_size (int): Number of images run through the model at once.
+        """
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = model.to(self.device)
+        self.model.eval()
+        self.batch_size = batch_size
+
+    def preprocess(self, images: List[np.ndarray]) -> torch.Tensor:
+        """
+        Batch of BGR images (as read by cv2.imread) of the same size to a normalized RGB tensor of shape
+        (number of images, channels, height, width).
+
+        Each image is normalized with the mean and std of its own channels, as in predict.py.
+        """
+        # BGR to RGB and (height, width, channels) to (channels, height, width)
+        batch = torch.from_numpy(np.stack(images)[..., ::-1].copy()).to(self.device)
+        batch = batch.permute(0, 3, 1, 2).float() / 255.0
+
+        mean = batch.mean(dim=(2, 3), keepdim=True)
+        std = batch.std(dim=(2, 3), keepdim=True, unbiased=False)
+
+        return (batch - mean) / std
+
+    def predict_proba(self, images: List[np.ndarray]) -> np.ndarray:
+        """
+        Class probabilities for BGR images of the model's input size.
+
+        Returns array of shape (number of images, number of classes).
+        """
+        if len(images) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+
+        probabilities = []
+
+        with torch.inference_mode():
+            for start in range(0, len(images), self.batch_size):
+                logits = self.model(self.preprocess(images[start:start + self.batch_size]))
+                probabilities.append(torch.softmax(logits, dim=-1).cpu().numpy())
+
+        return np.concatenate(probabilities)
+
+
+class FullyConvolutionalPredictor(TorchPredictor):
+    """
+    Whole-tray inference of a trained ResNet: one pass over the tray image instead of one per plant crop.
+
+    The logit map of FullyConvolutionalResNet is averaged inside each plant contour, which is what the global
+    average pooling of the ResNet does over a crop, and the averaged logits are turned into probabilities.
+    """
+
+    def __init__(self, model: ResNet, device: str = None, scale: float = 1):
+        """
+        Args:
+            model (ResNet): ResNet with the trained weights loaded.
+            device (str): Device to run the model on, by default cuda if it is available.
+            scale (float): Factor the tray image is resized by before the pass, e.g. to bring the plants closer
+                to the size of the crops the model was trained on.
+        """
+        super().__init__(FullyConvolutionalResNet(model), device=device, batch_size=1)
+        self.scale = scale
+
+    def get_region_weights(self, regions: List[Tuple[Tuple[int, int, int, int], np.ndarray]], image_shape: Tuple[int, int], map_shape: Tuple[int, int]) -> torch.Tensor:
+        """Fraction of each cell of the logit map covered by each region, shape (number of regions, map height, map width)."""
+        stride = FullyConvolutionalResNet.output_stride
+        weights = []
+
+        for (x, y, w, h), contour in regions:
+            mask = np.zeros(image_shape, np.uint8)
+            contour = np.round((contour + [x, y]) * self.scale).astype(np.int32)
+            cv2.fillPoly(mask, pts=[contour], color=1)
+            # The image is padded to a multiple of the stride, so each cell is the area of stride x stride pixels
+            weights.append(mask.reshape(map_shape[0], stride, map_shape[1], stride).mean(axis=(1, 3), dtype=np.float32))
+
+        return torch.from_numpy(np.stack(weights)).to(self.device)
+
+    def predict_regions(self, image: np.ndarray, regions: List[Tuple[Tuple[int, int, int, int], np.ndarray]]) -> np.ndarray:
+        """
+        Class probabilities of regions of a BGR image.
+
+        Args:
+            image (array): Tray image as read by cv2.imread.
+            regions (list): (bounding rectangle, contour in the coordinates of the rectangle) of each plant,
+                see segmentation.separate_to_plants.get_plant_regions.
+
+        Returns array of shape (number of regions, number of classes).
+        """
+        if len(regions) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+
+        if self.scale != 1:
+            image = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+        stride = FullyConvolutionalResNet.output_stride
+        height, width = image.shape[:2]
+        padded_height, padded_width = -(-height // stride) * stride, -(-width // stride) * stride
+        image = cv2.copyMakeBorder(image, 0, padded_height - height, 0, padded_width - width, cv2.BORDER_CONSTANT, value=[0, 0, 0])
+
+        with torch.inference_mode():
+            logits = self.model(self.preprocess([image]))[0]
+
+        weights = self.get_region_weights(regions, (padded_height, padded_width), tuple(logits.shape[1:]))
+        # Regions smaller than a cell still cover a fraction of it, so the weights of a region never sum to zero
+        region_logits = torch.einsum('nhw,chw->nc', weights, logits) / weights.sum(dim=(1, 2)).unsqueeze(1)
+
+        return torch.softmax(region_logits, dim=-1).cpu().numpy()
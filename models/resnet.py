@@ -43,3 +43,28 @@ class ResNet(nn.Module):
 def resnet18(num_classes=4) -> ResNet:
     _resnet = ResNet(block=ResNetBlock, layers=[2, 2, 2, 2], num_classes=num_classes, name="resnet18")
     return _resnet
+
+
+class FullyConvolutionalResNet(nn.Module):
+    """
+    Inference copy of a trained ResNet that classifies every location of an image of any size in a single pass.
+
+    The global average pooling is left out and the linear classifier is turned into a 1x1 convolution with the same
+    weights. The output is a map of class logits with one cell per output_stride x output_stride pixels, and the
+    average of the map over an image equals the logits of the original model for that image.
+    """
+    output_stride = 32
+
+    def __init__(self, resnet: ResNet):
+        super(FullyConvolutionalResNet, self).__init__()
+
+        # The layers are shared with the trained model, the last one of its features is the global pooling
+        self.features = nn.Sequential(*list(resnet.features.children())[:-1])
+
+        linear = resnet.linear
+        self.classifier = nn.Conv2d(linear.in_features, linear.out_features, kernel_size=1)
+        self.classifier.weight.data.copy_(linear.weight.data.view(linear.out_features, linear.in_features, 1, 1))
+        self.classifier.bias.data.copy_(linear.bias.data)
+
+    def forward(self, x):
+        return self.classifier(self.features(x))
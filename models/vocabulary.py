@@ -0,0 +1,192 @@
+import logging
+from typing import List
+import numpy as np
+from scipy.cluster.vq import kmeans, vq
+from scipy.sparse import csr_matrix, issparse
+from scipy.spatial import cKDTree
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import normalize
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+VOCABULARY_BUILDERS = ['kmeans', 'minibatch_kmeans']
+
+DEFAULT_VOCABULARY_PARAMETERS = {
+    'BUILDER': 'kmeans',
+    'MAX_DESCRIPTORS_PER_IMAGE': None,
+    'MAX_ITER': 100,
+    'TOL': 1e-5,
+    'BATCH_SIZE': 4096,
+    'INDEX': 'matmul',
+}
+
+VOCABULARY_INDEXES = ['brute', 'matmul', 'kdtree']
+
+# Number of descriptors compared to the vocabulary at once with the matmul index
+QUANTISATION_CHUNK_SIZE = 16384
+
+
+def sample_descriptors(descriptor_list: List[np.ndarray], max_descriptors_per_image: int = None, random_state: int = None) -> np.ndarray:
+    """Stack the descriptors of all images as float32, randomly keeping at most max_descriptors_per_image of each image."""
+    if max_descriptors_per_image is None:
+        return np.concatenate(descriptor_list).astype(np.float32, copy=False)
+
+    rng = np.random.default_rng(random_state)
+
+    sampled = []
+    for descriptor in descriptor_list:
+        if len(descriptor) > max_descriptors_per_image:
+            descriptor = descriptor[rng.choice(len(descriptor), max_descriptors_per_image, replace=False)]
+        sampled.append(descriptor)
+
+    return np.concatenate(sampled).astype(np.float32, copy=False)
+
+
+class VocabularyIndex:
+    """Nearest visual word lookup over a vocabulary, built once when the vocabulary is fitted and stored with it."""
+
+    def __init__(self, voc: np.ndarray, index: str = 'matmul'):
+        """
+        Args:
+            voc (array): Vocabulary of shape (k, descriptor length).
+            index (str): 'brute' compares every descriptor to every word with scipy's vq,
+                'matmul' computes the same distances in chunks as a single BLAS matrix product per chunk
+                using precomputed word norms, and 'kdtree' queries a KD-tree built over the words.
+        """
+        if index not in VOCABULARY_INDEXES:
+            raise ValueError(f"Unknown vocabulary index. Accepted values are {VOCABULARY_INDEXES}.")
+
+        self.voc = voc.astype(np.float32, copy=False)
+        self.index = index
+        self.tree = cKDTree(self.voc) if index == 'kdtree' else None
+        self.voc_squared_norms = (self.voc ** 2).sum(axis=1) if index == 'matmul' else None
+
+    def __len__(self):
+        return len(self.voc)
+
+    def quantise(self, descriptors: np.ndarray) -> np.ndarray:
+        """Index of the nearest word for each descriptor."""
+        descriptors = descriptors.astype(np.float32, copy=False)
+
+        if self.index == 'kdtree':
+            distance, words = self.tree.query(descriptors, k=1, workers=-1)
+            return words
+
+        if self.index == 'matmul':
+            words = np.empty(len(descriptors), dtype=np.int64)
+            for start in range(0, len(descriptors), QUANTISATION_CHUNK_SIZE):
+                chunk = descriptors[start:start + QUANTISATION_CHUNK_SIZE]
+                # Squared distance without the per-descriptor constant |x|^2, which doesn't change the nearest word
+                distances = self.voc_squared_norms - 2 * (chunk @ self.voc.T)
+                words[start:start + len(chunk)] = np.argmin(distances, axis=1)
+            return words
+
+        words, distance = vq(descriptors, self.voc)
+        return words
+
+
+def get_vocabulary_index(voc) -> VocabularyIndex:
+    """Vocabularies of models stored before the index was introduced are plain arrays."""
+    if isinstance(voc, VocabularyIndex):
+        return voc
+    return VocabularyIndex(voc, index='brute')
+
+
+def build_vocabulary(descriptor_list: List[np.ndarray], k: int, parameters: dict = {}, random_state: int = None) -> VocabularyIndex:
+    """
+    Cluster the descriptors of the training images to a vocabulary of k visual words.
+
+    Parameters are given in the format of the VOCABULARY block of hyperparams.yaml:
+        BUILDER: 'kmeans' clusters with scipy using every descriptor until convergence,
+            'minibatch_kmeans' clusters with scikit-learn's MiniBatchKMeans.
+        MAX_DESCRIPTORS_PER_IMAGE: Number of randomly sampled descriptors used per image, None uses all.
+        MAX_ITER: Maximum number of passes over the descriptors (minibatch_kmeans).
+        TOL: Convergence threshold.
+        BATCH_SIZE: Number of descriptors per mini-batch (minibatch_kmeans).
+        INDEX: Lookup structure used for quantisation, see VocabularyIndex.
+
+    Returns the index over the cluster centroids.
+    """
+    parameters = {**DEFAULT_VOCABULARY_PARAMETERS, **(parameters or {})}
+    builder = parameters['BUILDER']
+
+    if builder not in VOCABULARY_BUILDERS:
+        raise ValueError(f"Unknown vocabulary builder. Accepted values are {VOCABULARY_BUILDERS}.")
+
+    descriptors = sample_descriptors(descriptor_list, parameters['MAX_DESCRIPTORS_PER_IMAGE'], random_state)
+
+    logger.info(f'Building vocabulary of {k} words from {len(descriptors)} descriptors using {builder}.')
+
+    if builder == 'kmeans':
+        voc, variance = kmeans(descriptors, k, 1, thresh=parameters['TOL'])
+    else:
+        clustering = MiniBatchKMeans(
+            n_clusters=k,
+            batch_size=parameters['BATCH_SIZE'],
+            max_iter=parameters['MAX_ITER'],
+            tol=parameters['TOL'],
+            n_init=1,
+            random_state=random_state
+        ).fit(descriptors)
+        voc = clustering.cluster_centers_
+
+    return VocabularyIndex(voc, index=parameters['INDEX'])
+
+
+HISTOGRAM_NORMALIZATIONS = [None, 'l2', 'tfidf']
+
+
+def build_histograms(descriptor_list: List[np.ndarray], voc, sparse: bool = False):
+    """
+    Visual word counts of all images, computed with a single quantisation and counting pass.
+
+    voc is a VocabularyIndex or a plain vocabulary array.
+    Returns float32 array, or CSR matrix if sparse is True, of shape (number of images, k).
+    """
+    vocabulary_index = get_vocabulary_index(voc)
+    num_images = len(descriptor_list)
+    k = len(vocabulary_index)
+
+    # Flat word array of all images, image_ids maps each word back to its image
+    lengths = np.array([len(descriptor) for descriptor in descriptor_list])
+    words = vocabulary_index.quantise(np.concatenate(descriptor_list))
+    image_ids = np.repeat(np.arange(num_images), lengths)
+
+    if sparse:
+        # Duplicate (image, word) entries are summed when the matrix is built
+        return csr_matrix((np.ones(len(words), dtype=np.float32), (image_ids, words)), shape=(num_images, k))
+
+    return np.bincount(image_ids * k + words, minlength=num_images * k).reshape(num_images, k).astype(np.float32)
+
+
+def compute_idf(histograms) -> np.ndarray:
+    """Smoothed inverse document frequency of each word, computed from the training histograms."""
+    num_images = histograms.shape[0]
+    document_frequency = np.asarray((histograms > 0).sum(axis=0)).ravel()
+    return (np.log((1 + num_images) / (1 + document_frequency)) + 1).astype(np.float32)
+
+
+def normalize_histograms(histograms, normalization: str = None, idf: np.ndarray = None):
+    """
+    Normalize a batch of histograms.
+
+    Args:
+        histograms (array or CSR matrix): Word counts from build_histograms.
+        normalization (str): None keeps raw word counts, 'l2' scales each histogram to unit length and
+            'tfidf' weights the counts with idf before scaling to unit length.
+        idf (array): Inverse document frequencies of the words, required with 'tfidf'.
+    """
+    if normalization not in HISTOGRAM_NORMALIZATIONS:
+        raise ValueError(f"Unknown histogram normalization. Accepted values are {HISTOGRAM_NORMALIZATIONS}.")
+
+    if normalization is None:
+        return histograms
+
+    if normalization == 'tfidf':
+        if idf is None:
+            raise ValueError("idf is required for tfidf normalization")
+        histograms = histograms.multiply(idf).tocsr() if issparse(histograms) else histograms * idf
+
+    return normalize(histograms, norm='l2', copy=False)
@@ -1,15 +1,19 @@
-import torch
 import click
-from utils.model_utils import AVAILABLE_MODELS, get_model_info, get_model_info_by_attributes, get_model_path, get_image_size, get_other_json, restore_object
-from models.bag_of_words import BagOfWords
-from models.model_factory import get_model_class
+from utils.model_utils import AVAILABLE_MODELS, get_model_info, get_model_id, get_image_size
+from models.model_factory import get_predictor
+from dataloaders.image_path_data_loader import ImagePathDataLoader
+from torch.utils.data import DataLoader
 import logging
 from dotenv import load_dotenv
 import os
+import sys
+import csv
+import glob
 import cv2
 import numpy as np
+import pandas as pd
 import json
-from joblib import load
+from tqdm import tqdm
 
 load_dotenv()
 DATA_FOLDER_PATH = os.getenv("DATA_FOLDER_PATH")
@@ -18,14 +22,20 @@ logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
 @click.command()
-@click.option('-i', '--input', required=True, type=str, help="Path to input image.")
+@click.option('-i', '--input', required=True, type=str, help="Path to input image, or a directory of images, a glob pattern (quoted, e.g. 'crops/**/*.png') or a CSV-file of image paths to predict many images.")
 @click.option('-id', '--identifier', type=str, help="Model id. You can print model info with help.py.")
 @click.option('-m', '--model', type=click.Choice(AVAILABLE_MODELS, case_sensitive=False), help='Model architechture.')
 @click.option('-n', '--num-classes', type=int, help='Number of classes (2 in binary case, 4 in multi-class case).')
 @click.option('-d', '--dataset', type=str, help='Name of the dataset model is trained on.')
+@click.option('-pc', '--path-column', type=str, show_default=True, default='Split masked image path', help='Column of the image paths when the input is a CSV-file. Relative paths are relative to the data folder.')
+@click.option('-o', '--output', type=str, help='File the predictions of many images are written to as they are computed, CSV or JSON lines by the file extension. JSON lines are printed if not given.')
+@click.option('-b', '--batch-size', type=int, show_default=True, default=64, help='Number of images predicted at once.')
+@click.option('-w', '--workers', type=int, show_default=True, default=4, help='Number of processes decoding the images.')
 @click.option('-v', '--verbose', is_flag=True, show_default=True, default=False, help='Print verbose logs.')
-def predict(input, identifier, model, num_classes, dataset, verbose):
+def predict(input, identifier, model, num_classes, dataset, path_column, output, batch_size, workers, verbose):
 
   if not any([input, identifier, model, num_classes, dataset, verbose]):
       print("""
@@ -41,83 +51,116 @@ def predict(input, identifier, model, num_classes, dataset, verbose):
 
   logger.info("Loading the model")
 
-  if identifier:
-    model_data = get_model_info(id=identifier)
-    model_name = model_data['model_name'].item()
-    num_classes = model_data['num_classes'].item()
-    model = get_model_class(name=model_name, num_of_classes=num_classes)
-    model_path = get_model_path(identifier)
-    model_id = identifier
-  else:
-    model_name = model
-    model_data = get_model_info_by_attributes(model_name=model, num_classes=num_classes, dataset=dataset)
-    if len(model_data) == 0:
-      raise ValueError(f"Could not find any model with attributes model name: {model}, num_classes: {num_classes}, dataset: {dataset}. Please check that model with these values exists in models.csv")
-    elif len(model_data) > 1:
-      best_model = model_data.nlargest(1, columns=['f1_score'])
-      model_id = best_model['id'].item()
-      model = get_model_class(name=model, num_of_classes=num_classes)
-      model_path = get_model_path(model_id)
-    else:
-      model_id = model_data['id'].item()
-      model = get_model_class(name=model, num_of_classes=num_classes)
-      model_path = get_model_path(model_id)
-
-    logger.debug(f"Using the model with id: {model_id}")
+  model_id = get_model_id(identifier, model, num_classes, dataset)
+  model_data = get_model_info(id=model_id)
+  model_name = model_data['model_name'].item()
+
+  logger.debug(f"Using the model with id: {model_id}")
+
+  LABELS = json.loads(model_data['other_json'].item())['LABELS']
+  CROP_SIZE = get_image_size(model_name)
 
+  # A single image without an output file is predicted and printed as before
+  if os.path.isfile(input) and not input.lower().endswith('.csv') and output is None:
+    return predict_image(input, get_predictor(model_id), LABELS, CROP_SIZE)
+
+  image_paths = get_input_paths(input, path_column)
+  logger.info(f"Predicting {len(image_paths)} images")
+
+  predictor = get_predictor(model_id, batch_size=batch_size)
+  return predict_images(predictor, image_paths, LABELS, CROP_SIZE, batch_size, workers, output)
+
+def predict_image(input, predictor, LABELS, CROP_SIZE):
   # Preprocess image
 
   logger.info("Preprocessing the image")
 
-  LABELS = json.loads(model_data['other_json'].item())['LABELS']
-  CROP_SIZE = get_image_size(model_name)
+  # Bag of words models are trained on BGR images as read by OpenCV, the PyTorch predictors convert them to RGB
+  bgr_image = cv2.resize(cv2.imread(input), CROP_SIZE)
 
-  image = cv2.imread(input)
-  image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-  image = cv2.resize(image, CROP_SIZE)
+  probabilities = predictor.predict_proba([bgr_image])[0]
 
-  if model_name == 'bag_of_words':
-    model = load(model_path)
-    other_json = get_other_json(model_id)
-    feature_detection = other_json['feature_detection']
-    k = other_json['k']
-    voc = restore_object(other_json['voc'])
-    stdslr = restore_object(other_json['standard_scaler'])
+  if np.isnan(probabilities).any():
+    raise ValueError(f"Could not detect features from image {input}, the model predicted NaN probabilities")
 
-    probabilities = BagOfWords.predict_single_image(image, model, feature_detection, k, voc, stdslr)
+  results = dict(zip(LABELS, probabilities.tolist()))
+  print(results)
+  return results
 
-    results = dict(zip(LABELS, probabilities))
+def get_input_paths(input, path_column='Split masked image path'):
+  """Image paths of a CSV-file, a directory (searched recursively), a single image or a glob pattern."""
+  if input.lower().endswith('.csv'):
+    paths = pd.read_csv(input)[path_column]
+    image_paths = [path if os.path.isabs(path) else os.path.join(DATA_FOLDER_PATH, path) for path in paths]
+  elif os.path.isdir(input):
+    image_paths = sorted(
+      os.path.join(root, file)
+      for root, dirs, files in os.walk(input)
+      for file in files
+      if file.lower().endswith(IMAGE_EXTENSIONS)
+    )
+  elif os.path.isfile(input):
+    image_paths = [input]
   else:
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    image_paths = sorted(path for path in glob.glob(input, recursive=True) if os.path.isfile(path))
 
-    model.load_state_dict(torch.load(model_path))
-    model = model.to(device)
-    model.eval()
+  if len(image_paths) == 0:
+    raise ValueError(f"Could not find any images from {input}")
 
-    # Convert pixel values to floats between 0 and 1
-    image = image.astype("float32") / 255.0
+  return image_paths
 
-    # Calculate values for mean and std for each channel for normalization
-    mean = np.mean(image, axis=(0,1))
-    std = np.std(image, axis=(0,1))
+def predict_images(predictor, image_paths, LABELS, CROP_SIZE, batch_size=64, workers=4, output=None):
+  """
+  Predict images in batches decoded by DataLoader workers, writing the predictions of each batch as soon as it is done.
 
-    image -= mean
-    image /= std
+  Images that can't be read, or where a bag of words model can't detect features, have no probabilities or prediction.
+  Returns the number of predicted images.
+  """
+  dataloader = DataLoader(ImagePathDataLoader(image_paths, CROP_SIZE), batch_size=batch_size, shuffle=False, num_workers=workers)
 
-    # Change numpy array from (width, height, channels) to (batch size, channels, width, height)
-    image = np.transpose(image, (2, 0, 1))
-    image = np.expand_dims(image, 0)
+  write_csv = output is not None and output.lower().endswith('.csv')
+  f = open(output, 'w', newline='') if output is not None else sys.stdout
 
-    image = torch.from_numpy(image)
+  try:
+    if write_csv:
+      writer = csv.writer(f)
+      writer.writerow(['Image path', *[f'Probability {label}' for label in LABELS], 'Prediction'])
 
-    image = image.to(device)
+    number_of_predicted = 0
 
-    logits = model(image)
-    probabilities = torch.nn.Softmax(dim=-1)(logits).tolist()[0]
+    for batch in tqdm(dataloader, disable=output is None):
+      images = batch['image'].numpy()
+      readable = batch['readable'].numpy()
 
-    results = dict(zip(LABELS, probabilities))
-  print(results)
-  return results
+      probabilities = np.full((len(images), len(LABELS)), np.nan)
+      if readable.any():
+        probabilities[readable] = predictor.predict_proba(images[readable])
+
+      for path, image_probabilities in zip(batch['path'], probabilities):
+        if np.isnan(image_probabilities).any():
+          results, prediction = None, None
+        else:
+          results = dict(zip(LABELS, image_probabilities.tolist()))
+          prediction = LABELS[int(np.argmax(image_probabilities))]
+          number_of_predicted += 1
+
+        if write_csv:
+          writer.writerow([path, *(results.values() if results else [''] * len(LABELS)), prediction or ''])
+        else:
+          f.write(json.dumps({'image_path': path, 'probabilities': results, 'prediction': prediction}) + '\n')
+
+      f.flush()
+  finally:
+    if output is not None:
+      f.close()
+
+  if number_of_predicted < len(image_paths):
+    logger.warning(f"Could not predict {len(image_paths) - number_of_predicted}/{len(image_paths)} images, they are unreadable or have no detectable features")
+
+  if output is not None:
+    logger.info(f"Predictions can be found from {output}")
+
+  return number_of_predicted
 
 if __name__ == "__main__":
     predict()
@@ -1,50 +1,15 @@
 # %%
-import json
-import os
-from dotenv import load_dotenv
-import pandas as pd
-import numpy as np
-from datetime import datetime
+from utils.model_registry import MODEL_REGISTRY_PATH, get_connection, get_models
 
 # %%
 
-load_dotenv()
+# The trained models are stored in the SQLite model registry (models.db) of the data folder, see utils.model_registry.
+# models.csv is only an import/export format now: an existing models.csv is imported when the registry is created,
+# and later changes to it are not read. Use help.py --import-csv and --export-csv for them.
+get_connection()
 
 # %%
 
-DATA_FOLDER_PATH = os.getenv("DATA_FOLDER_PATH")
-
-# %%
-
-columns = {
-  "id": pd.Series(dtype='str'), 
-  "model_name": pd.Series(dtype='str'), 
-  "timestamp": pd.Series(dtype='datetime64[ns]'), 
-  "description": pd.Series(dtype='str'), 
-  "dataset": pd.Series(dtype='str'),
-  "num_classes": pd.Series(dtype='int'),
-  "precision": pd.Series(dtype='float'),
-  "recall": pd.Series(dtype='float'),
-  "train_accuracy": pd.Series(dtype='float'),
-  "train_loss": pd.Series(dtype='float'),
-  "validation_accuracy": pd.Series(dtype='float'),
-  "validation_loss": pd.Series(dtype='float'),
-  "test_accuracy": pd.Series(dtype='float'), 
-  "test_loss": pd.Series(dtype='float'),
-  # F1 score should be macro weighted
-  "f1_score": pd.Series(dtype='float'), 
-  # Other should contain a json object dumped to a string
-  "other_json": pd.Series(dtype=str)
-}
-
-model_df = pd.DataFrame(columns=columns)
-
-# %%
-
-model_df
-
-# %%
-
-model_df.to_csv(os.path.join(DATA_FOLDER_PATH, "models.csv"), index = False)
+print(f"Model registry {MODEL_REGISTRY_PATH} has {len(get_models())} models")
 
 # %%
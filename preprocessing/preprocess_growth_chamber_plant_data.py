@@ -19,11 +19,10 @@ trial2_dataset3 = "Data/Trial_02/Dataset_03"
 DATA_FOLDER = os.getenv("DATA_FOLDER_PATH")
 
 # %%
-df_trial2_dataset3 = pd.DataFrame(columns = ['Trial', 'Dataset', 'Genotype', 'Condition', 'Image Type', 'File_index', 'Original image path', 'Masked image path'])
 trial2_dataset3_folder = os.path.join(DATA_FOLDER, trial2_dataset3)
 
 # %%
-df_trial2_dataset3 = df_trial2_dataset3.append(fetch_image_data_from_trial_folder(trial2_dataset3_folder, 2, 3), ignore_index = True)
+df_trial2_dataset3 = pd.DataFrame(fetch_image_data_from_trial_folder(trial2_dataset3_folder, 2, 3), columns = ['Trial', 'Dataset', 'Genotype', 'Condition', 'Image Type', 'File_index', 'Original image path', 'Masked image path'])
 
 # %%
 # Image type and file index were useful only when collecting images, we can remove them now
@@ -25,20 +25,18 @@ def process_and_segment_leaves():
     DATA_FOLDER = os.getenv("DATA_FOLDER_PATH")
 
     # %%
-    df_trial1_dataset2 = pd.DataFrame(columns = ['Trial', 'Dataset', 'Genotype', 'Condition', 'Image Type', 'File_index', 'Original image path', 'Masked image path'])
     trial1_dataset2_folder = os.path.join(DATA_FOLDER, trial1_dataset2)
 
     # %%
 
-    df_trial1_dataset2 = df_trial1_dataset2.append(fetch_image_data_from_trial_folder(trial1_dataset2_folder, 1, 2), ignore_index = True)
+    df_trial1_dataset2 = pd.DataFrame(fetch_image_data_from_trial_folder(trial1_dataset2_folder, 1, 2), columns = ['Trial', 'Dataset', 'Genotype', 'Condition', 'Image Type', 'File_index', 'Original image path', 'Masked image path'])
 
     # Image type and file index were useful only when collecting images, we can remove them now
     df_trial1_dataset2 = df_trial1_dataset2.drop(columns=["Image Type", "File_index"])
 
     # %%
-    df_trial2_dataset2 = pd.DataFrame(columns = ['Trial', 'Dataset', 'Genotype', 'Condition', 'Image Type', 'File_index', 'Original image path', 'Masked image path'])
     trial2_dataset2_folder = os.path.join(DATA_FOLDER, trial2_dataset2)
-    df_trial2_dataset2 = df_trial2_dataset2.append(fetch_image_data_from_trial_folder(trial2_dataset2_folder, 2, 2), ignore_index = True)
+    df_trial2_dataset2 = pd.DataFrame(fetch_image_data_from_trial_folder(trial2_dataset2_folder, 2, 2), columns = ['Trial', 'Dataset', 'Genotype', 'Condition', 'Image Type', 'File_index', 'Original image path', 'Masked image path'])
 
     # Image type and file index were useful only when collecting images, we can remove them now
     df_trial2_dataset2 = df_trial2_dataset2.drop(columns=["Image Type", "File_index"])
@@ -103,16 +101,10 @@ def process_and_segment_leaves():
 def preprocess_leaf_data(excel_path, output_path = None):
     DATA_FOLDER = os.getenv("DATA_FOLDER_PATH")
 
-    leaf_master = pd.DataFrame()
-
-    df = pd.DataFrame(columns = ['Genotype', 'Condition', 'Image Type', 'File_index', 'Original image path', 'Masked image path'])
-
-    df = df.append(fetch_image_data_from_folder(excel_path), ignore_index = True)
+    df = pd.DataFrame(fetch_image_data_from_folder(excel_path), columns = ['Genotype', 'Condition', 'Image Type', 'File_index', 'Original image path', 'Masked image path'])
 
     # Image type and file index were useful only when collecting images, we can remove them now
-    df = df.drop(columns=["Image Type", "File_index"])
-
-    leaf_master = pd.concat([leaf_master, df])
+    leaf_master = df.drop(columns=["Image Type", "File_index"])
 
     leaf_master = leaf_master.reset_index()
 
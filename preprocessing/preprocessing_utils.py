@@ -76,6 +76,8 @@ def extract_metadata_from_folder_names(parent_folder, current_folder):
 def fetch_image_data_from_trial_folder(trial_folder, trial, dataset) -> List:
 
     image_data = []
+    # The rows of image_data by their identifying values, to find the other format of an image in constant time
+    rows_by_key = {}
 
     for root, dirs, files in sorted(os.walk(trial_folder)):
 
@@ -98,26 +100,29 @@ def fetch_image_data_from_trial_folder(trial_folder, trial, dataset) -> List:
             image_path = os.path.relpath(os.path.join(root, file), DATA_FOLDER)
 
             # Check if array contains already the same image in different format (masked/original)
-            existing_row_filter = filter(lambda item: item_contains_keys(item, Trial=trial, Dataset=dataset, Genotype=genotype, Condition=condition, File_index=index), image_data)
+            key = (trial, dataset, genotype, condition, index)
+            existing_row = rows_by_key.get(key)
 
-            existing_row = list(existing_row_filter)
-
-            if len(existing_row) != 0:
+            if existing_row is not None:
                 if image_type == 'Original':
-                    existing_row[0]['Original image path'] = image_path
+                    existing_row['Original image path'] = image_path
                 if image_type == 'Masked':
-                    existing_row[0]['Masked image path'] = image_path
+                    existing_row['Masked image path'] = image_path
             else:
                 if image_type == "Original":
                     image_data.append({"Trial": trial, "Dataset": dataset, "Genotype": genotype, "Condition": condition, 'File_index': index, "Image Type": image_type, "Original image path": image_path})
                 if image_type == "Masked":
                     image_data.append({"Trial": trial, "Dataset": dataset, "Genotype": genotype, "Condition": condition, 'File_index': index, "Image Type": image_type, "Masked image path": image_path})
+                if image_type in ("Original", "Masked"):
+                    rows_by_key[key] = image_data[-1]
 
     return image_data
 
 def fetch_image_data_from_folder(data_path) -> List:
 
     image_data = []
+    # The rows of image_data by their identifying values, to find the other format of an image in constant time
+    rows_by_key = {}
 
     for root, dirs, files in sorted(os.walk(data_path)):
 
@@ -140,19 +145,20 @@ def fetch_image_data_from_folder(data_path) -> List:
             image_path = os.path.relpath(os.path.join(root, file), DATA_FOLDER)
 
             # Check if array contains already the same image in different format (masked/original)
-            existing_row_filter = filter(lambda item: item_contains_keys(item, Genotype=genotype, Condition=condition, File_index=index), image_data)
-
-            existing_row = list(existing_row_filter)
+            key = (genotype, condition, index)
+            existing_row = rows_by_key.get(key)
 
-            if len(existing_row) != 0:
+            if existing_row is not None:
                 if image_type == 'Original':
-                    existing_row[0]['Original image path'] = image_path
+                    existing_row['Original image path'] = image_path
                 if image_type == 'Masked':
-                    existing_row[0]['Masked image path'] = image_path
+                    existing_row['Masked image path'] = image_path
             else:
                 if image_type == "Original":
                     image_data.append({"Genotype": genotype, "Condition": condition, 'File_index': index, "Image Type": image_type, "Original image path": image_path})
                 if image_type == "Masked":
                     image_data.append({"Genotype": genotype, "Condition": condition, 'File_index': index, "Image Type": image_type, "Masked image path": image_path})
+                if image_type in ("Original", "Masked"):
+                    rows_by_key[key] = image_data[-1]
 
     return image_data
@@ -0,0 +1,163 @@
+import copy
+import inspect
+import click
+import logging
+import numpy as np
+import torch
+from torch import nn
+from tabulate import tabulate
+from torch.quantization import quantize_dynamic, get_default_qconfig
+from torch.quantization.quantize_fx import prepare_fx, convert_fx
+from models.model_factory import load_trained_model, use_quantized_engine
+from models.predictor import TorchPredictor
+from dataloaders.split_manifest import get_split_indices
+from utils.model_utils import get_model_info, get_other_json, get_image_size, store_model_and_add_info_to_df
+from utils.evaluation_utils import get_dataset_path, get_evaluation_dataset, predict_dataset, evaluate_probabilities
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+QUANTIZATION_METHODS = {
+    'vision_transformer': 'dynamic',
+    'resnet18': 'static',
+    'inception_v3': 'static',
+}
+
+@click.command()
+@click.option('-id', '--identifier', required=True, type=str, help="Id of the model to quantize. You can print model info with help.py.")
+@click.option('-csv', '--data-csv', type=str, help='Full file path to the dataset CSV-file the model was trained with. Needed if the model was not trained on an already available dataset (plant, plant_golden, leaf).')
+@click.option('-bl', '--binary-label', type=int, help='Binary label the binary model was trained with, when the dataset has more than two labels.')
+@click.option('-c', '--calibration-size', type=int, show_default=True, default=300, help='Number of training images used to calibrate the statically quantized models (resnet18, inception_v3).')
+@click.option('-bk', '--backend', type=click.Choice(['fbgemm', 'qnnpack'], case_sensitive=False), show_default=True, default='fbgemm', help='Quantized engine, fbgemm for x86 and qnnpack for ARM CPUs.')
+@click.option('-b', '--batch-size', type=int, show_default=True, default=64, help='Number of images predicted at once.')
+@click.option('-w', '--workers', type=int, show_default=True, default=4, help='Number of processes decoding the images.')
+@click.option('-s/-nos', '--save/--no-save', show_default=True, default=True, help='Save the quantized model and add it to the model dataframe as a new model.')
+@click.option('-v', '--verbose', is_flag=True, show_default=True, default=False, help='Print verbose logs.')
+def quantize(identifier, data_csv, binary_label, calibration_size, backend, batch_size, workers, save, verbose):
+    """
+    Quantize a trained PyTorch model to int8 for CPU inference and compare it to the original model on the test split.
+
+    Vision transformers are quantized dynamically. ResNet and Inception models are quantized statically, calibrated
+    on images of the training split. The quantized model is stored as TorchScript and can be used like any other
+    model with its new id.
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    model_info = get_model_info(identifier)
+
+    if len(model_info) == 0:
+        raise ValueError(f"Could not find model with id {identifier}")
+
+    model_name = model_info['model_name'].item()
+    num_classes = model_info['num_classes'].item()
+    dataset = model_info['dataset'].item()
+    other_json = get_other_json(identifier)
+
+    if model_name not in QUANTIZATION_METHODS:
+        raise ValueError(f"Quantization is supported for models {list(QUANTIZATION_METHODS)}, model with id {identifier} is {model_name}")
+
+    if 'ARTIFACT_FORMAT' in other_json:
+        raise ValueError(f"Model with id {identifier} is already compiled to {other_json['ARTIFACT_FORMAT']}, quantize the original model instead")
+
+    method = QUANTIZATION_METHODS[model_name]
+
+    logger.info("Loading the model and the data")
+
+    model = load_trained_model(identifier, device='cpu')
+
+    evaluation_dataset = get_evaluation_dataset(data_csv or get_dataset_path(dataset), get_image_size(model_name))
+    labels = evaluation_dataset.df['Label'].to_numpy()
+
+    # For binary models, transform labels to one-vs-rest as in training
+    if num_classes == 2 and len(np.unique(labels)) > 2:
+        if binary_label is None:
+            raise ValueError("The dataset has more than two labels, give the binary label (-bl) the binary model was trained with.")
+        evaluation_dataset.df['Label'] = (labels == binary_label).astype(int)
+
+    split_indices = get_split_indices(evaluation_dataset.df, dataset)
+
+    use_quantized_engine(backend, identifier)
+
+    if method == 'dynamic':
+        logger.info("Quantizing the linear layers dynamically")
+        quantized_model = quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+    else:
+        rng = np.random.default_rng(1337)
+        calibration_indices = rng.choice(split_indices['train'], min(calibration_size, len(split_indices['train'])), replace=False)
+        logger.info(f"Quantizing statically, calibrating on {len(calibration_indices)} training images")
+        quantized_model = quantize_static(model, evaluation_dataset, calibration_indices, backend, batch_size, workers)
+
+    example_input = TorchPredictor(model, device='cpu').preprocess([evaluation_dataset[int(split_indices['test'][0])]['image'].numpy()])
+    with torch.inference_mode():
+        quantized_model = torch.jit.freeze(torch.jit.trace(quantized_model, example_input))
+
+    logger.info(f"Evaluating the original and the quantized model on {len(split_indices['test'])} test images")
+
+    results = {}
+    for name, evaluated_model in [('fp32', model), ('int8', quantized_model)]:
+        probabilities, y_true, seconds = predict_dataset(TorchPredictor(evaluated_model, device='cpu', batch_size=batch_size), evaluation_dataset, split_indices['test'], batch_size, workers)
+        results[name] = evaluate_probabilities(y_true, probabilities, num_classes)
+        results[name]['images_per_second'] = len(y_true) / seconds
+
+    print(tabulate(
+        [[metric, results['fp32'][metric], results['int8'][metric], results['int8'][metric] - results['fp32'][metric]] for metric in results['fp32']],
+        headers=['', 'fp32', 'int8', 'delta'], tablefmt="fancy_grid"
+    ))
+
+    if save:
+        logger.info("Saving the quantized model")
+
+        quantized_json = {
+            **other_json,
+            'ARTIFACT_FORMAT': 'torchscript',
+            'QUANTIZATION': {
+                'method': method,
+                'backend': backend,
+                'calibration_size': len(calibration_indices) if method == 'static' else None,
+                'base_model_id': identifier,
+                'base_test_accuracy': results['fp32']['test_accuracy'],
+                'base_f1_score': results['fp32']['f1_score'],
+                'speedup': results['int8']['images_per_second'] / results['fp32']['images_per_second'],
+            },
+        }
+
+        model_id = store_model_and_add_info_to_df(
+            model = quantized_model,
+            model_name = model_name,
+            description = f"int8 {method} quantized {identifier}",
+            dataset = dataset,
+            num_classes = num_classes,
+            precision = results['int8']['precision'],
+            recall = results['int8']['recall'],
+            train_accuracy = None,
+            train_loss = None,
+            validation_accuracy = None,
+            validation_loss = None,
+            test_accuracy = results['int8']['test_accuracy'],
+            test_loss = results['int8']['test_loss'],
+            f1_score = results['int8']['f1_score'],
+            other_json = quantized_json,
+        )
+
+        logger.info(f"Quantized model saved with id {model_id}")
+
+def quantize_static(model: nn.Module, dataset, calibration_indices, backend: str = 'fbgemm', batch_size: int = 64, workers: int = 4) -> nn.Module:
+    """Post-training static quantization in FX graph mode, calibrated with the given rows of the evaluation dataset."""
+    qconfig_dict = {'': get_default_qconfig(backend)}
+
+    # Since torch 1.13 preparing needs example inputs for tracing the model
+    if 'example_inputs' in inspect.signature(prepare_fx).parameters:
+        example_inputs = (torch.zeros(1, 3, *dataset[0]['image'].shape[:2]),)
+        prepared_model = prepare_fx(copy.deepcopy(model), qconfig_dict, example_inputs)
+    else:
+        prepared_model = prepare_fx(copy.deepcopy(model), qconfig_dict)
+
+    # Running the prepared model records the ranges of the activations
+    predict_dataset(TorchPredictor(prepared_model, device='cpu', batch_size=batch_size), dataset, calibration_indices, batch_size, workers)
+
+    return convert_fx(prepared_model)
+
+if __name__ == '__main__':
+    quantize()
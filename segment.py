@@ -4,11 +4,16 @@ from dotenv import load_dotenv
 import click
 import logging
 import pandas as pd
+from functools import partial
+from joblib import Parallel, delayed
 from preprocessing.preprocess_split_data import condition_to_label
 from segmentation.separate_leaves import segment as segment_leaves
 from segmentation.separate_to_plants import segment_plant
 from preprocessing.preprocess_leaf_data import preprocess_leaf_data
 from segmentation.segmentation_utils import get_masked_image_filename, get_original_image_filename
+from segmentation.segmentation_manifest import SegmentationManifest
+from segmentation.region_index import index_plant, index_leaves
+from dataloaders.virtual_crop_data_loader import REGION_INDEX_PATH_COLUMN, REGION_INDEX_COLUMN
 from utils.path_utils import get_relative_path_to_data_folder
 from pprint import pprint
 
@@ -20,20 +25,30 @@ load_dotenv()
 DATA_FOLDER_PATH = os.getenv('DATA_FOLDER_PATH')
 DEFAULT_LEAF_OUTPUT_PATH = os.path.join(DATA_FOLDER_PATH, 'segmented_leaves')
 DEFAULT_PLANT_OUTPUT_PATH = os.path.join(DATA_FOLDER_PATH, 'segmented_plants')
+SEGMENTED_DATA_COLUMNS = ['Genotype', 'Condition', 'Split masked image path', 'Split original image path']
+# Extra columns of data segmented with --index-only, used by VirtualCropDataLoader to cut the crops
+REGION_INDEX_COLUMNS = [REGION_INDEX_PATH_COLUMN, REGION_INDEX_COLUMN]
+# Number of images segmented between writes to the segmentation manifest
+SEGMENTATION_CHUNK_SIZE = 64
 
 @click.command()
 @click.option('-e', '--excel-path', type=str, help='Full file path to the Excel-file.')
 @click.option('-t', '--type', required=True, type=click.Choice(['plant', 'leaf'], case_sensitive=False), help='Whether the given image data is images of plants or leaves.')
 @click.option('-o', '--output-path', type=str, help=f'Folder where the resulting csv and segmented images will be placed. By default they are placed in {DEFAULT_LEAF_OUTPUT_PATH} for leaves and in {DEFAULT_PLANT_OUTPUT_PATH} for plants')
+@click.option('-w', '--workers', type=int, show_default=True, default=1, help='Number of processes used to segment the images in parallel. -1 uses all cores.')
+@click.option('-ds', '--downscale', type=click.FloatRange(min=1), show_default=True, default=1, help='Find the plants from a copy of the tray image downscaled by this factor, e.g. 4. The plants are still cropped at full resolution. Only used with plant images.')
+@click.option('-sf', '--save-full-images', is_flag=True, show_default=True, default=False, help='Save also a copy of the full input images in the output folders of their leaves. Only used with leaf images.')
+@click.option('-io', '--index-only', is_flag=True, show_default=True, default=False, help='Write only the bounding boxes and contours of the plants or leaves of each image to a JSON index instead of the crops. The crops are cut from the input images when the data is loaded.')
+@click.option('-f', '--force', is_flag=True, show_default=True, default=False, help='Segment all images again, also the ones that are unchanged since they were last segmented to the output folder.')
 @click.option('-v', '--verbose', is_flag=True, show_default=True, default=False, help='Print verbose logs.')
-def segment(excel_path, type, output_path, verbose):
+def segment(excel_path, type, output_path, workers, downscale, save_full_images, index_only, force, verbose):
     if verbose:
         logger.setLevel(logging.DEBUG)
 
     if type == 'plant':
-        path_to_csv, path_to_images = segment_plant_data(excel_path, output_path)
+        path_to_csv, path_to_images = segment_plant_data(excel_path, output_path, workers, force, downscale, index_only)
     elif type == 'leaf':
-        path_to_csv, path_to_images = segment_leaf_data(excel_path, output_path)
+        path_to_csv, path_to_images = segment_leaf_data(excel_path, output_path, workers, force, save_full_images, index_only)
     else:
         raise ValueError('Unknown value for flag --type, accepted values are "plant" and "leaf".')
 
@@ -41,7 +56,54 @@ def segment(excel_path, type, output_path, verbose):
     logger.info(f'A csv of the segmented data can be found from {path_to_csv}')
     logger.info(f'Segmented images can be found from {path_to_images}')
 
-def segment_plant_data(excel_path, output_path):
+def segment_images(segment_function, image_paths, output_path, workers=1, manifest=None, force=False):
+    """
+    Segment each (masked image path, original image path) pair with segment_function in a process pool.
+
+    Pairs found unchanged from the manifest are not segmented again, unless force is set. The previous crops of
+    the other pairs are removed before they are segmented. Newly segmented pairs are added to the manifest after
+    every chunk, so an interrupted run continues from the last written chunk.
+
+    Returns dict from the pair to the (segmented masked paths, segmented original paths) of the pair,
+    followed by the region index path when segment_function writes an index instead of the crops.
+    """
+    results = {}
+    pending = []
+
+    for image_pair in image_paths:
+        result = manifest.get(*image_pair) if manifest is not None and not force else None
+        if result is None:
+            pending.append(image_pair)
+        else:
+            results[image_pair] = result
+
+    logger.info(f'Segmenting {len(pending)}/{len(image_paths)} images, the rest are unchanged since they were last segmented')
+
+    with Parallel(n_jobs=workers) as parallel:
+        for start in range(0, len(pending), SEGMENTATION_CHUNK_SIZE):
+            chunk = pending[start:start + SEGMENTATION_CHUNK_SIZE]
+
+            if manifest is not None:
+                for image_pair in chunk:
+                    manifest.remove_outputs(*image_pair)
+
+            chunk_results = parallel(
+                delayed(segment_function)(masked_image_path, original_image_path, output_path)
+                for masked_image_path, original_image_path in chunk
+            )
+
+            for image_pair, result in zip(chunk, chunk_results):
+                results[image_pair] = result
+
+            if manifest is not None:
+                manifest.add(list(zip(chunk, chunk_results)))
+
+    if manifest is not None:
+        manifest.save()
+
+    return {image_pair: results[image_pair] for image_pair in image_paths}
+
+def segment_plant_data(excel_path, output_path, workers=1, force=False, downscale=1, index_only=False):
 
     if output_path is None:
         output_path = DEFAULT_PLANT_OUTPUT_PATH
@@ -53,9 +115,12 @@ def segment_plant_data(excel_path, output_path):
     # To check if segmentation produces a right number of images
     segmented_image_value_counts = original_df['Masked image path'].value_counts()
 
-    logger.debug('Creating a dataframe for segmented image data')
+    # Position of each row among the rows of the same tray image, rows of a tray are consecutive in the sheet
+    plant_indices = original_df.groupby('Original image path').cumcount() + 1
 
-    segmented_df = pd.DataFrame(columns=['Genotype', 'Condition', 'Split masked image path', 'Split original image path'])
+    logger.debug('Collecting the segmented image data')
+
+    segmented_records = []
 
     logger.info('Segmenting plant images')
 
@@ -63,18 +128,29 @@ def segment_plant_data(excel_path, output_path):
     image_path_to_plant_number_map = {}
     falsely_segmented_images = []
 
+    # Each tray image is segmented once, together with the original image of its first row
+    unique_rows = original_df.drop_duplicates('Masked image path')
+    image_paths = [
+        (os.path.join(DATA_FOLDER_PATH, masked), os.path.join(DATA_FOLDER_PATH, original))
+        for masked, original in zip(unique_rows['Masked image path'], unique_rows['Original image path'])
+    ]
+    parameters = {'type': 'plant', 'downscale': downscale}
+    if index_only:
+        parameters['index_only'] = True
+    manifest = SegmentationManifest(output_path, parameters)
+    segment_function = partial(index_plant if index_only else segment_plant, downscale=downscale)
+    segmentation_results = {masked_image_path: result for (masked_image_path, _), result in segment_images(segment_function, image_paths, output_path, workers, manifest, force).items()}
+
     for index, row in original_df.iterrows():
-        original_image_path = os.path.join(DATA_FOLDER_PATH, row['Original image path'])        
+        original_image_path = os.path.join(DATA_FOLDER_PATH, row['Original image path'])
         masked_image_path = os.path.join(DATA_FOLDER_PATH, row['Masked image path'])
         genotype = row['Genotype']
         condition = row['Condition']
-        # Integer distance between the index + 1
-        plant_index = abs(index - original_df[original_df['Original image path'] == original_image_path].head(1).index.item()) + 1
+        plant_index = plant_indices[index]
 
-        # Segment images if they have not been segmented already
+        # Check the segmentation results of each image once
         if masked_image_path not in image_path_to_plant_number_map.keys():
-            logger.debug(f"Segmenting file {masked_image_path}")
-            segmented_masked_paths, segmented_original_paths = segment_plant(masked_image_path, original_image_path, output_path)
+            segmented_masked_paths = segmentation_results[masked_image_path][0]
 
             image_path_to_plant_number_map[masked_image_path] = len(segmented_masked_paths)
 
@@ -89,20 +165,28 @@ def segment_plant_data(excel_path, output_path):
         if image_path_to_plant_number_map[masked_image_path] == segmented_image_value_counts[row['Masked image path']]:
             masked_segmented_path = get_masked_image_filename(masked_image_path, output_path, plant_index)
             original_segmented_path = get_original_image_filename(original_image_path, output_path, plant_index)
+            region_index = plant_index - 1
         else:
             masked_segmented_path = get_masked_image_filename(masked_image_path, output_path)
             original_segmented_path = get_original_image_filename(original_image_path, output_path)
+            region_index = -1
 
-        new_row = pd.DataFrame(data = {
-                'Genotype': [genotype],
-                'Condition': [condition],
-                'Split masked image path': [masked_segmented_path],
-                'Split original image path': [original_segmented_path],
-        })
+        record = {
+            'Genotype': genotype,
+            'Condition': condition,
+            'Split masked image path': masked_segmented_path,
+            'Split original image path': original_segmented_path,
+        }
 
-        segmented_df = pd.concat([segmented_df, new_row], ignore_index=True)
+        # Paths of the crops are kept in the index-only CSV, the crops are identified by them in the data splits
+        if index_only:
+            record[REGION_INDEX_PATH_COLUMN] = get_relative_path_to_data_folder(segmentation_results[masked_image_path][2])
+            record[REGION_INDEX_COLUMN] = region_index
 
+        segmented_records.append(record)
 
+    columns = SEGMENTED_DATA_COLUMNS + REGION_INDEX_COLUMNS if index_only else SEGMENTED_DATA_COLUMNS
+    segmented_df = pd.DataFrame(segmented_records, columns=columns)
     segmented_df = condition_to_label(segmented_df)
 
     file_name = 'segmented_plants.csv'
@@ -115,7 +199,7 @@ def segment_plant_data(excel_path, output_path):
 
     return file_path, output_path
 
-def segment_leaf_data(excel_path, output_path):
+def segment_leaf_data(excel_path, output_path, workers=1, force=False, save_full_images=False, index_only=False):
 
     if output_path is None:
         output_path = DEFAULT_LEAF_OUTPUT_PATH
@@ -125,8 +209,8 @@ def segment_leaf_data(excel_path, output_path):
     # To check if segmentation produces a right number of images
     segmented_image_value_counts = original_df['Masked image path'].value_counts()
 
-    logger.debug('Creating a dataframe for segmented image data')
-    segmented_df = pd.DataFrame(columns=['Genotype', 'Condition', 'Split masked image path', 'Split original image path'])
+    logger.debug('Collecting the segmented image data')
+    segmented_records = []
 
     logger.info('Segmenting leaf images')
 
@@ -134,13 +218,24 @@ def segment_leaf_data(excel_path, output_path):
     image_path_to_plant_number_map = {}
     falsely_segmented_images = set()
 
+    # Rows with the same images would produce the same segments, so each pair of images is segmented once
+    image_paths = list(dict.fromkeys(
+        (os.path.join(DATA_FOLDER_PATH, masked), os.path.join(DATA_FOLDER_PATH, original))
+        for masked, original in zip(original_df['Masked image path'], original_df['Original image path'])
+    ))
+    parameters = {'type': 'leaf', 'save_full_images': save_full_images}
+    if index_only:
+        parameters['index_only'] = True
+    manifest = SegmentationManifest(output_path, parameters)
+    segment_function = index_leaves if index_only else partial(segment_leaves, save_full_image=save_full_images)
+    segmentation_results = segment_images(segment_function, image_paths, output_path, workers, manifest, force)
+
     for index, row in original_df.iterrows():
         original_image_path = os.path.join(DATA_FOLDER_PATH, row['Original image path'])
         masked_image_path = os.path.join(DATA_FOLDER_PATH, row['Masked image path'])
 
-        logger.debug(f"Segmenting file {masked_image_path}")
-
-        segmented_masked_paths, segmented_original_paths = segment_leaves(masked_image_path, original_image_path, output_path)
+        segmentation_result = segmentation_results[(masked_image_path, original_image_path)]
+        segmented_masked_paths, segmented_original_paths = segmentation_result[0], segmentation_result[1]
 
         if masked_image_path not in image_path_to_plant_number_map:
             image_path_to_plant_number_map[masked_image_path] = len(segmented_masked_paths)
@@ -149,14 +244,21 @@ def segment_leaf_data(excel_path, output_path):
             falsely_segmented_images.add(masked_image_path)
 
         for i in range(len(segmented_masked_paths)):
-            segmented_row = pd.DataFrame(data = {
-                'Genotype': [row['Genotype']],
-                'Condition': [row['Condition']],
-                'Split masked image path': [get_relative_path_to_data_folder(segmented_masked_paths[i])],
-                'Split original image path': [get_relative_path_to_data_folder(segmented_original_paths[i])],
-            })
-            segmented_df = pd.concat([segmented_df, segmented_row], ignore_index=True)
+            record = {
+                'Genotype': row['Genotype'],
+                'Condition': row['Condition'],
+                'Split masked image path': get_relative_path_to_data_folder(segmented_masked_paths[i]),
+                'Split original image path': get_relative_path_to_data_folder(segmented_original_paths[i]),
+            }
+
+            if index_only:
+                record[REGION_INDEX_PATH_COLUMN] = get_relative_path_to_data_folder(segmentation_result[2])
+                record[REGION_INDEX_COLUMN] = i
+
+            segmented_records.append(record)
 
+    columns = SEGMENTED_DATA_COLUMNS + REGION_INDEX_COLUMNS if index_only else SEGMENTED_DATA_COLUMNS
+    segmented_df = pd.DataFrame(segmented_records, columns=columns)
     segmented_df = condition_to_label(segmented_df)
 
     file_name = 'segmented_leaves.csv'
@@ -0,0 +1,114 @@
+import os
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+import cv2
+import numpy as np
+from segmentation.separate_to_plants import get_plant_regions, get_plant_crop_paths
+from segmentation.separate_leaves import find_leaf_regions, get_leaf_crop_paths
+from utils.path_utils import get_relative_path_to_data_folder
+
+REGION_INDEX_SUFFIX = '_regions.json'
+
+
+def get_region_index_path(masked_image_path: str, output_path: str) -> str:
+    return os.path.join(output_path, f"{Path(masked_image_path).stem}{REGION_INDEX_SUFFIX}")
+
+
+def write_region_index(masked_image_path: str, original_image_path: str, image_type: str, regions: List[Tuple[Tuple[int, int, int, int], np.ndarray]], output_path: str) -> str:
+    """
+    Write the bounding boxes and contours of the plants or leaves of an image pair instead of their crops.
+
+    Args:
+        image_type (str): 'plant' or 'leaf', decides how the crops are formed from the regions, see crop_region.
+        regions (list): (bounding box (x, y, w, h), contour) of each crop, the contour in the coordinates of the box.
+
+    Returns the path of the written index.
+    """
+    index = {
+        'type': image_type,
+        'masked_image_path': get_relative_path_to_data_folder(masked_image_path),
+        'original_image_path': get_relative_path_to_data_folder(original_image_path),
+        'regions': [
+            {'bbox': [int(value) for value in bounding_box], 'contour': contour.reshape(-1, 2).tolist()}
+            for bounding_box, contour in regions
+        ],
+    }
+
+    os.makedirs(output_path, exist_ok=True)
+
+    index_path = get_region_index_path(masked_image_path, output_path)
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    return index_path
+
+
+def load_region_index(index_path: str) -> Dict:
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+
+    for region in index['regions']:
+        region['contour'] = np.array(region['contour'], dtype=np.int32).reshape(-1, 1, 2)
+
+    return index
+
+
+def get_region_mask(region: Dict) -> np.ndarray:
+    x, y, w, h = region['bbox']
+    mask = np.zeros((h, w), np.uint8)
+    cv2.fillPoly(mask, pts=[region['contour']], color=255)
+    return mask
+
+
+def crop_region(image: np.ndarray, region: Dict, image_type: str, is_masked: bool = True) -> np.ndarray:
+    """
+    Crop of a region from a BGR image (as read by cv2.imread), the same as its crop written by the segmentation
+    and read with skimage.io.imread.
+
+    Plant crops are masked in both the masked and the original image. Leaf crops are masked only in the masked
+    image, and are returned in the channel order their crop files have been written in.
+    """
+    x, y, w, h = region['bbox']
+    crop = image[y:y+h, x:x+w]
+
+    if is_masked or image_type == 'plant':
+        crop = cv2.bitwise_and(crop, crop, mask=get_region_mask(region))
+
+    if image_type == 'plant':
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
+
+    return crop
+
+
+def index_plant(masked_image_path: str, original_image_path: str, output_path: str, downscale: float = 1) -> Tuple[List[str], List[str], str]:
+    """
+    Find the plants of a tray image and write their region index instead of the crops.
+
+    Returns the paths the crops would have been written to by segment_plant, and the path of the index.
+    """
+    regions = get_plant_regions(cv2.imread(masked_image_path), downscale)
+    index_path = write_region_index(masked_image_path, original_image_path, 'plant', regions, output_path)
+
+    masked_segmented_paths, original_segmented_paths = get_plant_crop_paths(masked_image_path, original_image_path, output_path, len(regions))
+
+    return masked_segmented_paths, original_segmented_paths, index_path
+
+
+def index_leaves(masked_image_path: str, original_image_path: str, output_path: str) -> Tuple[List[str], List[str], str]:
+    """
+    Find the leaves of an image and write their region index instead of the crops.
+
+    Returns the paths the crops would have been written to by separate_leaves.segment, and the path of the index.
+    """
+    img_masked = cv2.cvtColor(cv2.imread(masked_image_path), cv2.COLOR_BGR2RGB)
+
+    regions = [((x, y, w, h), contour - [x, y]) for (x, y, w, h), contour in find_leaf_regions(img_masked)]
+    index_path = write_region_index(masked_image_path, original_image_path, 'leaf', regions, output_path)
+
+    masked_segmented_paths = get_leaf_crop_paths(masked_image_path, output_path, len(regions))
+    original_segmented_paths = get_leaf_crop_paths(original_image_path, output_path, len(regions))
+
+    return masked_segmented_paths, original_segmented_paths, index_path
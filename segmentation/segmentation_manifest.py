@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MANIFEST_FILE_NAME = 'segmentation_manifest.jsonl'
+
+
+def hash_file(path: str) -> str:
+    """Hash of the file content."""
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_file_state(path: str) -> Dict:
+    stat = os.stat(path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+class SegmentationManifest:
+    """
+    Record of the segmented input images in the output folder, one JSON line per (masked, original) image pair.
+
+    Each entry stores the content hashes and file states of both inputs, the segmentation parameters and the
+    produced crop paths relative to the output folder, and the path of the region index when only the regions of
+    the crops were written. Entries are appended after each segmented chunk of images,
+    so an interrupted run can be resumed. Later lines override earlier lines of the same pair.
+    """
+
+    def __init__(self, output_path: str, parameters: Dict):
+        """
+        Args:
+            output_path (str): Folder of the segmented images where the manifest is kept.
+            parameters (dict): Everything that affects the segmentation result, e.g. the image type.
+                Images segmented with other parameters are segmented again.
+        """
+        self.output_path = output_path
+        self.path = os.path.join(output_path, MANIFEST_FILE_NAME)
+        self.parameters = parameters
+        # Whether the entries differ from the lines on disk, e.g. the file states of touched inputs were refreshed
+        self.changed = False
+        self.entries = self._load()
+
+        # Drop a partially written line before new entries are appended after it
+        self.save()
+
+    def _load(self) -> Dict[Tuple[str, str], Dict]:
+        entries = {}
+
+        if not os.path.exists(self.path):
+            return entries
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line of a run that was interrupted while writing
+                    logger.warning(f'Skipping unreadable line in {self.path}')
+                    self.changed = True
+                    continue
+                entries[(entry['masked_image_path'], entry['original_image_path'])] = entry
+
+        logger.info(f'Found {len(entries)} segmented images from {self.path}')
+        return entries
+
+    def _is_unchanged(self, entry: Dict, image_type: str) -> bool:
+        path = entry[f'{image_type}_image_path']
+        state = get_file_state(path)
+
+        # The content is hashed again only if the file has been touched since it was recorded
+        if state == entry[f'{image_type}_state']:
+            return True
+
+        if hash_file(path) != entry[f'{image_type}_hash']:
+            return False
+
+        entry[f'{image_type}_state'] = state
+        self.changed = True
+        return True
+
+    def get(self, masked_image_path: str, original_image_path: str) -> Optional[Tuple]:
+        """
+        Crop paths of the pair if it has been segmented with the same inputs and parameters, otherwise None.
+
+        The region index path is returned as a third element for pairs that were indexed instead of cropped.
+        """
+        entry = self.entries.get((masked_image_path, original_image_path))
+
+        if entry is None or entry['parameters'] != self.parameters:
+            return None
+
+        if not self._is_unchanged(entry, 'masked') or not self._is_unchanged(entry, 'original'):
+            return None
+
+        masked_paths = [os.path.join(self.output_path, path) for path in entry['segmented_masked_paths']]
+        original_paths = [os.path.join(self.output_path, path) for path in entry['segmented_original_paths']]
+
+        if entry.get('index_path') is not None:
+            # Crops of indexed pairs are never written, only the index has to exist
+            index_path = os.path.join(self.output_path, entry['index_path'])
+            if not os.path.exists(index_path):
+                return None
+            return masked_paths, original_paths, index_path
+
+        if not all(os.path.exists(path) for path in masked_paths + original_paths):
+            return None
+
+        return masked_paths, original_paths
+
+    def _create_entry(self, masked_image_path: str, original_image_path: str, masked_paths: List[str], original_paths: List[str], index_path: str = None) -> Dict:
+        entry = {
+            'masked_image_path': masked_image_path,
+            'original_image_path': original_image_path,
+            'masked_hash': hash_file(masked_image_path),
+            'original_hash': hash_file(original_image_path),
+            'masked_state': get_file_state(masked_image_path),
+            'original_state': get_file_state(original_image_path),
+            'parameters': self.parameters,
+            'segmented_masked_paths': [os.path.relpath(path, self.output_path) for path in masked_paths],
+            'segmented_original_paths': [os.path.relpath(path, self.output_path) for path in original_paths],
+        }
+
+        if index_path is not None:
+            entry['index_path'] = os.path.relpath(index_path, self.output_path)
+
+        return entry
+
+    def remove_outputs(self, masked_image_path: str, original_image_path: str):
+        """
+        Delete the crops and the region index recorded for the pair, before it is segmented again.
+
+        The inputs may now yield fewer crops, and the leftover crops of the previous run would otherwise stay in the
+        output folder among the new ones.
+        """
+        entry = self.entries.get((masked_image_path, original_image_path))
+
+        if entry is None:
+            return
+
+        paths = entry['segmented_masked_paths'] + entry['segmented_original_paths']
+        if entry.get('index_path') is not None:
+            paths.append(entry['index_path'])
+
+        for path in paths:
+            try:
+                os.remove(os.path.join(self.output_path, path))
+            except FileNotFoundError:
+                pass
+
+        logger.debug(f'Removed the previous outputs of {masked_image_path}')
+
+    def add(self, results: List[Tuple[Tuple[str, str], Tuple]]):
+        """
+        Record a chunk of segmented pairs and write them to disk immediately, with a single fsync.
+
+        Args:
+            results (list): ((masked image path, original image path), (masked paths, original paths[, index path]))
+                of each segmented pair.
+        """
+        entries = [self._create_entry(*image_pair, *result) for image_pair, result in results]
+
+        for entry in entries:
+            self.entries[(entry['masked_image_path'], entry['original_image_path'])] = entry
+        self.changed = True
+
+        os.makedirs(self.output_path, exist_ok=True)
+        with open(self.path, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def save(self):
+        """Rewrite the manifest with one line per pair, if it has changed since it was loaded."""
+        if not self.changed:
+            return
+
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.path)
+        self.changed = False
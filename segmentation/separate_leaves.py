@@ -17,6 +17,15 @@ def find_contours(img):
     return contours
 
 
+def get_leaf_mask(contour, bounding_box):
+    # Mask of the area inside the leaf contour, in the coordinates of the leaf's bounding box
+    x, y, w, h = bounding_box
+    mask = np.zeros((h, w), np.uint8)
+    cv2.fillPoly(mask, pts=[(contour - [x, y]).astype(np.int32)], color=255)
+
+    return mask
+
+
 def mask_leaf_parts(img):
     contours = find_contours(img)
 
@@ -33,33 +42,39 @@ def mask_leaf_parts(img):
 
 #%%
 
-def get_bounding_boxes(path_masked):
-    # assumes image is masked
-    img_orig = cv2.imread(path_masked)
-    # plt.imshow(img_orig)
-    img = cv2.cvtColor(img_orig, cv2.COLOR_BGR2RGB)
-    # plt.imshow(img)
-
+def find_leaf_regions(img):
+    # assumes image is masked, channels RGB
+    # returns the bounding box and contour of each leaf
     contours = find_contours(img)
-    # print(len(contours))
     contours = contours[1:]
 
-    boxes = []
+    regions = []
 
     for i, c in enumerate(contours[::-1]):
         if (cv2.contourArea(c) > 10000):
-            boxes.append(cv2.boundingRect(c))
+            regions.append((cv2.boundingRect(c), c))
+
+    return regions
 
-    return boxes
 
+def get_bounding_boxes(path_masked):
+    # assumes image is masked
+    img_orig = cv2.imread(path_masked)
+    img = cv2.cvtColor(img_orig, cv2.COLOR_BGR2RGB)
+
+    return [box for box, contour in find_leaf_regions(img)]
 
-def cut(img, bounding_boxes, is_masked=True):
+
+def cut(img, bounding_boxes, is_masked=True, masks=None):
+    # masks are the leaf masks of the bounding boxes, without them masked crops are masked by finding the leaf again
     segments = []
 
-    for x,y,w,h in bounding_boxes:
+    for i, (x,y,w,h) in enumerate(bounding_boxes):
         img_segmented = img[y:y+h, x:x+w]
 
-        if is_masked:
+        if masks is not None:
+            img_segmented = cv2.bitwise_and(img_segmented, img_segmented, mask=masks[i])
+        elif is_masked:
             img_segmented = mask_leaf_parts(img_segmented)
 
         segments.append(img_segmented)
@@ -67,43 +82,59 @@ def cut(img, bounding_boxes, is_masked=True):
     return segments
 
 
-def write(segments, path, img_original, output_path):
+def get_leaf_crop_paths(path, output_path, number_of_leaves):
+    filename = Path(path).stem
+    pathname = os.path.join(output_path, filename)
+
+    return [os.path.join(pathname, f"{filename}_{i}.png") for i in range(number_of_leaves)]
+
+
+def write(segments, path, img_original, output_path, save_full_image=True):
     filename = Path(path).stem
     pathname = os.path.join(output_path, filename)
 
     original_filetype = os.path.splitext(path)[1]
 
-    segmented_paths = []
+    segmented_paths = get_leaf_crop_paths(path, output_path, len(segments))
 
     if not os.path.exists(pathname):
         os.makedirs(pathname)
 
-    # for now, save the original image in the same location as the segments, just for easy checking that the segmentation has gone right
-    cv2.imwrite(os.path.join(pathname, f"{filename}{original_filetype}"), img_original)
+    # save the original image in the same location as the segments, for easy checking that the segmentation has gone right
+    if save_full_image:
+        cv2.imwrite(os.path.join(pathname, f"{filename}{original_filetype}"), img_original)
 
-    for i, segment in enumerate(segments):
-        segmented_path = os.path.join(pathname, f"{filename}_{i}.png")
-        segmented_paths.append(segmented_path)
+    for segmented_path, segment in zip(segmented_paths, segments):
         cv2.imwrite(segmented_path, segment)
 
     return segmented_paths
 
 
 
-def segment(path_masked, path_original, output_path):
+def crop_leaves(img_masked, img_original):
+    # channels assumed to be RGB, returns the masked and the un-masked crop of each leaf, the images segment writes
+    regions = find_leaf_regions(img_masked)
+    bounding_boxes = [box for box, contour in regions]
+    masks = [get_leaf_mask(contour, box) for box, contour in regions]
+
+    segments_masked = cut(img_masked, bounding_boxes, masks=masks)
+    segments_original = cut(img_original, bounding_boxes, is_masked=False)
+
+    return segments_masked, segments_original
+
+
+def segment(path_masked, path_original, output_path, save_full_image=False):
+    # each input is decoded once, and the leaf masks are drawn from the contours found from the whole image
     img_orig_masked = cv2.imread(path_masked)
     img_masked = cv2.cvtColor(img_orig_masked, cv2.COLOR_BGR2RGB)
 
     img_orig = cv2.imread(path_original)
     img_original = cv2.cvtColor(img_orig, cv2.COLOR_BGR2RGB)
 
-    bounding_boxes = get_bounding_boxes(path_masked)
-
-    segments_masked = cut(img_masked, bounding_boxes, is_masked=True)
-    segments_original = cut(img_original, bounding_boxes, is_masked=False)
+    segments_masked, segments_original = crop_leaves(img_masked, img_original)
 
     # TODO: if original image and masked image names will be the same (the separation is done on the folder level for example), the original image will overwrite the segmented masked image
-    segmented_paths_masked = write(segments_masked, path_masked, img_masked, output_path)
-    segmented_paths_original = write(segments_original, path_original, img_original, output_path)
+    segmented_paths_masked = write(segments_masked, path_masked, img_masked, output_path, save_full_image)
+    segmented_paths_original = write(segments_original, path_original, img_original, output_path, save_full_image)
 
     return segmented_paths_masked, segmented_paths_original
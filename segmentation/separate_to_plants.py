@@ -44,8 +44,9 @@ def mask_plant_parts(img, return_only_mask=False):
 
 # %%
 def contour_sort(a, b):
-    br_a = cv2.boundingRect(a)
-    br_b = cv2.boundingRect(b)
+    return bounding_rect_sort(cv2.boundingRect(a), cv2.boundingRect(b))
+
+def bounding_rect_sort(br_a, br_b):
     a_x, a_y, a_w, a_h = br_a[0], br_a[1], br_a[2], br_a[3]
     b_x, b_y, b_w, b_h = br_b[0], br_b[1], br_b[2], br_b[3]
 
@@ -56,25 +57,95 @@ def contour_sort(a, b):
         return a_x - b_x # On the same row
 
 # %%
-def find_contours(img):
+def find_contours(img, downscale: float = 1):
+    """
+    Contours of the plants in a masked image.
+
+    With downscale > 1 the thresholding and morphology are done on a copy of the image shrunk by that factor, with
+    the kernel and the area limit scaled accordingly, and the contours are scaled back to the original resolution.
+    """
+    height, width = img.shape[:2]
+
+    if downscale < 1:
+        raise ValueError(f"downscale must be at least 1, got {downscale}")
+
+    if downscale > 1:
+        img = cv2.resize(img, (max(1, round(width / downscale)), max(1, round(height / downscale))), interpolation=cv2.INTER_AREA)
+
+    scale_x, scale_y = width / img.shape[1], height / img.shape[0]
+    kernel_size = max(1, round(50 / downscale))
+
     # Threshold input image using otsu thresholding as mask and refine with morphology
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU + cv2.THRESH_BINARY)[1]
     # Use "close" morphological operation to close the gaps between contours
     # Find contours in thresh_gray after closing the gaps
-    closed_gaps_thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (50,50)))
+    closed_gaps_thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size)))
     cnts = cv2.findContours(closed_gaps_thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
     cnts = cnts[0] if len(cnts) == 2 else cnts[1]
 
-    result = tuple(c for c in cnts if cv2.contourArea(c) > 500) # Filter contours smaller than 500 pixels out
+    result = tuple(c for c in cnts if cv2.contourArea(c) > 500 / (scale_x * scale_y)) # Filter contours smaller than 500 pixels out
+
+    if downscale > 1:
+        result = tuple(np.round(c * [scale_x, scale_y]).astype(np.int32) for c in result)
+
     return result
 
 
+def find_plant_regions(img, downscale: float = 1) -> List[Tuple[int, int, int, int]]:
+    """
+    Bounding rectangles (x, y, w, h) of the plants in a masked image at its original resolution, in tray order
+    (row by row, left to right).
+
+    With downscale > 1 the contours are found from a downscaled copy, see find_contours. Their rectangles are
+    then padded by one downscaled pixel, so that the plants are fully contained in them.
+    """
+    bounding_rects = [cv2.boundingRect(c) for c in find_contours(img, downscale)]
+
+    if downscale > 1:
+        height, width = img.shape[:2]
+        padding = int(np.ceil(downscale))
+        padded_rects = []
+        for x, y, w, h in bounding_rects:
+            x0, y0 = max(0, x - padding), max(0, y - padding)
+            x1, y1 = min(width, x + w + padding), min(height, y + h + padding)
+            padded_rects.append((x0, y0, x1 - x0, y1 - y0))
+        bounding_rects = padded_rects
+
+    # The rectangles are computed once instead of in every comparison
+    return sorted(bounding_rects, key=cmp_to_key(bounding_rect_sort))
+
+
 # %%
 
 
-def segment_plant(masked_image_path: str, original_image_path: str, output_path: str) -> Tuple[List[str], List[str]]:
-    """Segment plant image to multiple segmented masked and segmented un-masked images"""
+def get_plant_regions(masked_image, downscale: float = 1) -> List[Tuple[Tuple[int, int, int, int], np.ndarray]]:
+    """
+    Bounding rectangle and contour of each plant in a masked image, in tray order.
+
+    The contour is in the coordinates of the rectangle and outlines the plant without the bits and pieces of other
+    plants inside the rectangle, see mask_plant_parts.
+    """
+    regions = []
+
+    for x, y, w, h in find_plant_regions(masked_image, downscale):
+        contours = find_contours(masked_image[y:y+h, x:x+w])
+        # longest contour usually corresponds to the whole plant (not necessarily always)
+        plant_contour = contours[np.argmax([len(c) for c in contours])]
+        regions.append(((x, y, w, h), plant_contour))
+
+    return regions
+
+
+def get_plant_mask(contour, bounding_rect):
+    x, y, w, h = bounding_rect
+    mask = np.zeros((h, w), np.uint8)
+    cv2.fillPoly(mask, pts=[contour], color=(255, 255, 255))
+    return mask
+
+
+def get_plant_crop_paths(masked_image_path: str, original_image_path: str, output_path: str, number_of_plants: int) -> Tuple[List[str], List[str]]:
+    """Paths of the segmented masked and un-masked images of a tray image"""
 
     masked_filename = Path(masked_image_path).stem
     original_filename = Path(original_image_path).stem
@@ -84,38 +155,70 @@ def segment_plant(masked_image_path: str, original_image_path: str, output_path:
 
     pathname = os.path.join(output_path, masked_filename)
 
-    logger.info(f"Segmenting file {masked_filename}")
+    masked_segmented_paths = [os.path.join(pathname, f"{masked_filename}_M{i+1}{masked_filetype}") for i in range(number_of_plants)]
+    original_segmented_paths = [os.path.join(pathname, f"{original_filename}_O{i+1}{original_filetype}") for i in range(number_of_plants)]
 
-    masked_segmented_paths = []
-    original_segmented_paths = []
+    return masked_segmented_paths, original_segmented_paths
 
-    if not os.path.exists(pathname):
-        os.makedirs(pathname)
 
-    masked_image = cv2.imread(masked_image_path)
-    original_image = cv2.imread(original_image_path)
+def crop_plants(masked_image, original_image, downscale: float = 1) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """
+    Crops of each plant from a masked tray image and its un-masked original image (BGR), in tray order.
+
+    Both crops of a plant are masked with the same plant mask. The crops are the images segment_plant writes.
+    """
+    masked_crops = []
+    original_crops = []
 
-    cnts = find_contours(masked_image)
-    sorted_cnts = sorted(cnts, key=cmp_to_key(contour_sort))
-    for contour_index, c in enumerate(sorted_cnts):
+    for (x, y, w, h), plant_contour in get_plant_regions(masked_image, downscale):
 
         # Use the same mask for both masked and non-masked images
 
-        x, y, w, h = cv2.boundingRect(c)
         ROI_masked = masked_image[y:y+h, x:x+w]
         ROI_original = original_image[y:y+h, x:x+w]
-        plant_mask = mask_plant_parts(ROI_masked, return_only_mask=True)
-        single_plant_masked = cv2.bitwise_and(ROI_masked, ROI_masked, mask=plant_mask).copy()
-        single_plant_original = cv2.bitwise_and(ROI_original, ROI_original, mask=plant_mask).copy()
+        plant_mask = get_plant_mask(plant_contour, (x, y, w, h))
+        masked_crops.append(cv2.bitwise_and(ROI_masked, ROI_masked, mask=plant_mask).copy())
+        original_crops.append(cv2.bitwise_and(ROI_original, ROI_original, mask=plant_mask).copy())
+
+    return masked_crops, original_crops
+
+
+# %%
+
+
+def segment_plant(masked_image_path: str, original_image_path: str, output_path: str, downscale: float = 1) -> Tuple[List[str], List[str]]:
+    """
+    Segment plant image to multiple segmented masked and segmented un-masked images
+
+    downscale > 1 finds the plants from a downscaled copy of the masked image, the plants are cropped and masked
+    from the full resolution images.
+    """
+
+    masked_filename = Path(masked_image_path).stem
+    original_filename = Path(original_image_path).stem
+
+    masked_filetype = os.path.splitext(masked_image_path)[1]
+    original_filetype = os.path.splitext(original_image_path)[1]
+
+    pathname = os.path.join(output_path, masked_filename)
+
+    logger.info(f"Segmenting file {masked_filename}")
+
+    if not os.path.exists(pathname):
+        os.makedirs(pathname)
+
+    masked_image = cv2.imread(masked_image_path)
+    original_image = cv2.imread(original_image_path)
+
+    masked_crops, original_crops = crop_plants(masked_image, original_image, downscale)
+    masked_segmented_paths, original_segmented_paths = get_plant_crop_paths(masked_image_path, original_image_path, output_path, len(masked_crops))
+
+    for masked_segmented_path, original_segmented_path, single_plant_masked, single_plant_original in zip(masked_segmented_paths, original_segmented_paths, masked_crops, original_crops):
 
         # Write masked single plant
-        masked_segmented_path = os.path.join(pathname, f"{masked_filename}_M{contour_index+1}{masked_filetype}")
-        masked_segmented_paths.append(masked_segmented_path)
         cv2.imwrite(masked_segmented_path, single_plant_masked)
 
         # Write non-masked single plant
-        original_segmented_path = os.path.join(pathname, f"{original_filename}_O{contour_index+1}{original_filetype}")
-        original_segmented_paths.append(original_segmented_path)
         cv2.imwrite(original_segmented_path, single_plant_original)
 
 
@@ -143,10 +246,7 @@ def test_segmentation():
             pathlib.Path(f'{output_path_for_separated_plants}/{subfolder_name}').mkdir(parents=True, exist_ok=True)
         cv2.imwrite(f'{output_path_for_separated_plants}/{subfolder_name}/' + file, img)
 
-        cnts = find_contours(img)
-        sorted_cnts = sorted(cnts, key=cmp_to_key(contour_sort))
-        for idx2, c in enumerate(sorted_cnts):
-            x, y, w, h = cv2.boundingRect(c)
+        for idx2, (x, y, w, h) in enumerate(find_plant_regions(img)):
             ROI = img[y:y+h, x:x+w]
             masked = mask_plant_parts(ROI)
             result = masked.copy()
@@ -171,7 +271,7 @@ def test_segmentation():
 
     regex_pattern_for_plant_info_gc = r"^([0-9]{6}) - ([0-9]{2}) - TV - (Hua|R3)-(H|FMV|CSV|VD) - ((?:[0-9]{2}-|)[0-9]{2}) - Mask.png$"
 
-    split_gc_df = pd.DataFrame(columns=['Trial', 'Dataset', 'Genotype', 'Condition', 'Original image path', 'Masked image path', 'Split masked image path'])
+    split_gc_records = []
 
     for index, row in gc_df.iterrows():
         filename = row['Masked image path']
@@ -187,10 +287,7 @@ def test_segmentation():
             pathlib.Path(f'{DATA_FOLDER_PATH}/{output_path_for_separated_plants_gc}/{subfolder_name}').mkdir(parents=True, exist_ok=True)
         cv2.imwrite(f'{DATA_FOLDER_PATH}/{output_path_for_separated_plants_gc}/{subfolder_name}/' + file, img)
 
-        cnts = find_contours(img)
-        sorted_cnts = sorted(cnts, key=cmp_to_key(contour_sort))
-        for idx2, c in enumerate(sorted_cnts):
-            x, y, w, h = cv2.boundingRect(c)
+        for idx2, (x, y, w, h) in enumerate(find_plant_regions(img)):
             ROI = img[y:y+h, x:x+w]
             masked = mask_plant_parts(ROI)
             result = masked.copy()
@@ -199,7 +296,7 @@ def test_segmentation():
             split_plant_img_path = f'{output_path_for_separated_plants_gc}/{subfolder_name}/plant_index_{idx2+1}.png'
             cv2.imwrite(f'{DATA_FOLDER_PATH}/{split_plant_img_path}', result)
 
-            # Add an entry for the split plant to the new dataframe
+            # Collect an entry for the split plant, the dataframe is created once after the loop
             split_plant_data = {
                 'Trial': row['Trial'],
                 'Dataset': row['Dataset'],
@@ -209,7 +306,9 @@ def test_segmentation():
                 'Masked image path': row['Masked image path'],
                 'Split masked image path': split_plant_img_path,
             }
-            split_gc_df = split_gc_df.append(split_plant_data, ignore_index=True)
+            split_gc_records.append(split_plant_data)
+
+    split_gc_df = pd.DataFrame(split_gc_records, columns=['Trial', 'Dataset', 'Genotype', 'Condition', 'Original image path', 'Masked image path', 'Split masked image path'])
 
     # %%
 
@@ -0,0 +1,263 @@
+import json
+import asyncio
+import click
+import logging
+import cv2
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from aiohttp import web
+from models.model_factory import get_predictor
+from utils.model_utils import get_model_info, get_image_size
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+@click.command()
+@click.option('-id', '--identifier', type=str, multiple=True, help='Id of a model to load when the server starts. Can be given multiple times. Other models are loaded on their first request.')
+@click.option('-H', '--host', type=str, show_default=True, default='127.0.0.1', help='Host the server listens on.')
+@click.option('-p', '--port', type=int, show_default=True, default=8000, help='Port the server listens on.')
+@click.option('-u', '--unix-socket', type=str, help='Path of a Unix socket to listen on instead of the host and port.')
+@click.option('-mb', '--max-batch-size', type=int, show_default=True, default=32, help='Maximum number of requests of a model predicted together.')
+@click.option('-mw', '--max-wait-ms', type=float, show_default=True, default=5, help='Maximum time in milliseconds a request waits for other requests to fill its batch.')
+@click.option('-c', '--cache-size', type=int, show_default=True, default=2, help='Number of models kept loaded. The least recently used model is unloaded when another one is needed.')
+@click.option('-t', '--threads', type=int, show_default=True, default=1, help='Number of threads running the models.')
+@click.option('-v', '--verbose', is_flag=True, show_default=True, default=False, help='Print verbose logs.')
+def serve(identifier, host, port, unix_socket, max_batch_size, max_wait_ms, cache_size, threads, verbose):
+    """
+    Serve predictions of trained models over HTTP.
+
+    \b
+    POST /predict/<model id>   Body is an encoded image (e.g. PNG), or JSON {"path": "<path of a local image>"}.
+                               Responds with the probabilities of the labels and the prediction, as predict.py.
+    GET  /models               Ids of the loaded models.
+    GET  /health               Responds when the server is up.
+    """
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+    app = create_app(identifier, max_batch_size, max_wait_ms / 1000, cache_size, threads)
+
+    if unix_socket:
+        web.run_app(app, path=unix_socket)
+    else:
+        web.run_app(app, host=host, port=port)
+
+class BatcherClosedError(RuntimeError):
+    """Raised for requests to a model that was unloaded after the request got it from the cache."""
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests of a model into batches: a batch is predicted when it has max_batch_size images or
+    its first image has waited max_wait seconds. Batches are predicted one at a time in the executor.
+    """
+
+    def __init__(self, predictor, executor: ThreadPoolExecutor, max_batch_size: int = 32, max_wait: float = 0.005):
+        self.predictor = predictor
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.closed = False
+        self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def predict(self, image: np.ndarray) -> np.ndarray:
+        """Probabilities of a BGR image resized to the input size of the model."""
+        # Nothing reads the queue after the stop sentinel, so a request queued after it would never get an answer
+        if self.closed:
+            raise BatcherClosedError('The model has been unloaded')
+
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def get_batch(self) -> List:
+        loop = asyncio.get_event_loop()
+
+        item = await self.queue.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                # Requests queued before close are still predicted
+                self.queue.put_nowait(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            batch = await self.get_batch()
+            if batch is None:
+                return
+
+            logger.debug(f'Predicting a batch of {len(batch)} images')
+
+            try:
+                probabilities = await loop.run_in_executor(self.executor, self.predictor.predict_proba, [image for image, future in batch])
+            except Exception as e:
+                for image, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (image, future), image_probabilities in zip(batch, probabilities):
+                if not future.done():
+                    future.set_result(image_probabilities)
+
+    def close(self):
+        """Stop after the already queued requests have been predicted."""
+        self.closed = True
+        self.queue.put_nowait(None)
+
+class ServedModel:
+    def __init__(self, model_id: str, predictor, labels: List[str], crop_size, batcher: MicroBatcher):
+        self.model_id = model_id
+        self.predictor = predictor
+        self.labels = labels
+        self.crop_size = crop_size
+        self.batcher = batcher
+
+def load_model(model_id: str):
+    model_info = get_model_info(model_id)
+
+    if len(model_info) == 0:
+        raise ValueError(f"Could not find model with id {model_id}")
+
+    labels = json.loads(model_info['other_json'].item())['LABELS']
+    crop_size = get_image_size(model_info['model_name'].item())
+
+    return get_predictor(model_id), labels, crop_size
+
+class ModelCache:
+    """Loaded models by id, the least recently used model is unloaded when more than size models are needed."""
+
+    def __init__(self, executor: ThreadPoolExecutor, size: int = 2, max_batch_size: int = 32, max_wait: float = 0.005):
+        self.executor = executor
+        self.size = size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.models = OrderedDict()
+        # Concurrent first requests of a model load it once, the lock of a model is dropped when it has been loaded
+        self.locks = {}
+
+    async def get(self, model_id: str) -> ServedModel:
+        if model_id in self.models:
+            self.models.move_to_end(model_id)
+            return self.models[model_id]
+
+        async with self.locks.setdefault(model_id, asyncio.Lock()):
+            if model_id in self.models:
+                self.models.move_to_end(model_id)
+                return self.models[model_id]
+
+            logger.info(f'Loading model {model_id}')
+            try:
+                predictor, labels, crop_size = await asyncio.get_event_loop().run_in_executor(self.executor, load_model, model_id)
+            finally:
+                # Requests waiting for the lock find the model in the cache, or try to load it again if loading failed,
+                # so unknown ids don't leave a lock behind
+                self.locks.pop(model_id, None)
+
+            batcher = MicroBatcher(predictor, self.executor, self.max_batch_size, self.max_wait)
+            self.models[model_id] = ServedModel(model_id, predictor, labels, crop_size, batcher)
+
+            while len(self.models) > self.size:
+                evicted_id, evicted = self.models.popitem(last=False)
+                logger.info(f'Unloading model {evicted_id}')
+                evicted.batcher.close()
+
+            return self.models[model_id]
+
+    def close(self):
+        for served_model in self.models.values():
+            served_model.batcher.close()
+
+def read_image(body: bytes, path: str = None) -> np.ndarray:
+    if path is not None:
+        return cv2.imread(path)
+    return cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+
+async def handle_predict(request: web.Request) -> web.Response:
+    model_id = request.match_info['model_id']
+
+    try:
+        served_model = await request.app['models'].get(model_id)
+    except ValueError as e:
+        raise web.HTTPNotFound(text=str(e))
+
+    if request.content_type == 'application/json':
+        path = (await request.json()).get('path')
+        if path is None:
+            raise web.HTTPBadRequest(text='JSON requests must have the path of the image')
+        image = await asyncio.get_event_loop().run_in_executor(None, read_image, None, path)
+    else:
+        image = await asyncio.get_event_loop().run_in_executor(None, read_image, await request.read())
+
+    if image is None:
+        raise web.HTTPBadRequest(text='Could not read the image')
+
+    while True:
+        try:
+            # Bag of words models are trained on BGR images as read by OpenCV, the PyTorch predictors convert them to RGB
+            probabilities = await served_model.batcher.predict(cv2.resize(image, served_model.crop_size))
+            break
+        except BatcherClosedError:
+            # The model was unloaded while the image was read, load it again
+            served_model = await request.app['models'].get(model_id)
+
+    if np.isnan(probabilities).any():
+        raise web.HTTPUnprocessableEntity(text='Could not detect features from the image')
+
+    return web.json_response({
+        'model_id': model_id,
+        'probabilities': dict(zip(served_model.labels, probabilities.tolist())),
+        'prediction': served_model.labels[int(np.argmax(probabilities))],
+    })
+
+async def handle_models(request: web.Request) -> web.Response:
+    return web.json_response({'models': list(request.app['models'].models.keys())})
+
+async def handle_health(request: web.Request) -> web.Response:
+    return web.json_response({'status': 'ok'})
+
+def create_app(identifiers: List[str] = (), max_batch_size: int = 32, max_wait: float = 0.005, cache_size: int = 2, threads: int = 1) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 ** 2)
+    app.router.add_post('/predict/{model_id}', handle_predict)
+    app.router.add_get('/models', handle_models)
+    app.router.add_get('/health', handle_health)
+
+    async def on_startup(app):
+        app['executor'] = ThreadPoolExecutor(max_workers=threads)
+        app['models'] = ModelCache(app['executor'], max(cache_size, len(identifiers)), max_batch_size, max_wait)
+        for model_id in identifiers:
+            await app['models'].get(model_id)
+        logger.info('Ready to serve predictions')
+
+    async def on_cleanup(app):
+        app['models'].close()
+        app['executor'].shutdown(wait=True)
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
+    return app
+
+if __name__ == '__main__':
+    serve()
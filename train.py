@@ -1,11 +1,12 @@
 # %%
 import os
-from torch.utils.data import DataLoader, Dataset, TensorDataset
+from torch.utils.data import DataLoader, Dataset, TensorDataset, Subset
 from pathlib import Path
-from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import binarize
 from torch.utils.data import DataLoader
-from dataloaders.csv_data_loader import CSVDataLoader
+from dataloaders.virtual_crop_data_loader import get_csv_data_loader
+from dataloaders.cached_tensor_dataset import CachedTensorDataset
+from dataloaders.split_manifest import get_split_indices
 from dataloaders.gaussian_noise import GaussianNoise
 from dotenv import load_dotenv
 import matplotlib.pyplot as plt
@@ -18,9 +19,10 @@ import pandas as pd
 import numpy as np
 import click
 import statistics
-from models.bag_of_words import BagOfWords
+from models.bag_of_words import BagOfWords, get_training_profile
 from models.model_factory import get_model_class
-from utils.model_utils import AVAILABLE_MODELS, load_dataset_of_torch_model, store_model_and_add_info_to_df, get_image_size, store_object
+from models.inception import InceptionOutputs
+from utils.model_utils import AVAILABLE_MODELS, store_model_and_add_info_to_df, get_image_size, store_object
 import logging
 from tqdm import tqdm
 import yaml
@@ -119,7 +121,7 @@ def train(model, dataset, data_csv, binary, binary_label, params_file, params_na
             transforms.Normalize(mean=mean, std=std)
         ])
 
-    master_dataset = CSVDataLoader(
+    master_dataset = get_csv_data_loader(
         csv_file=DATA_MASTER_PATH,
         root_dir=DATA_FOLDER_PATH,
         image_path_col="Split masked image path",
@@ -128,14 +130,14 @@ def train(model, dataset, data_csv, binary, binary_label, params_file, params_na
     )
 
     # %%
-    # With random_split use a seed that should be the same as that was used in hyperparameter search in order to
-    # make sure the test dataset is kept unseen and without data leakage during training and model selection.
-    train_size = int(0.80 * len(master_dataset))
-    val_size = (len(master_dataset) - train_size)//2
-    test_size = len(master_dataset) - train_size - val_size
+    # The split manifest is shared with the hyperparameter search in order to make sure the test dataset
+    # is kept unseen and without data leakage during training and model selection.
+    split_indices = get_split_indices(master_dataset.df, dataset)
+    train_indices = np.concatenate([split_indices['train'], split_indices['val']])
+    test_indices = split_indices['test']
 
     if model == 'bag_of_words':
-        model_class, y_true, y_pred, test_accuracy, test_loss, other_json = train_bow(master_dataset.df, test_size, NUM_CLASSES, params, save, binary_label)
+        model_class, y_true, y_pred, test_accuracy, test_loss, other_json = train_bow(master_dataset.df, train_indices, test_indices, NUM_CLASSES, params, save, binary_label)
         train_accuracy = None
         train_loss = None
 
@@ -158,12 +160,13 @@ def train(model, dataset, data_csv, binary, binary_label, params_file, params_na
         LR = float(params[params_name]['LR'])
         WEIGHT_DECAY = float(params[params_name]['WEIGHT_DECAY'])
         
-        train_dataset, test_dataset = torch.utils.data.random_split(dataset=master_dataset,
-                                    lengths=[train_size + val_size, test_size],
-                                    generator=torch.Generator().manual_seed(42))
+        train_dataset = Subset(master_dataset, train_indices)
+        test_dataset = Subset(master_dataset, test_indices)
 
         train_plant_dataloader = DataLoader(train_dataset, batch_size=BATCH_SIZE_TRAIN, shuffle=True, num_workers=0)
-        test_plant_dataloader = DataLoader(test_dataset, batch_size=BATCH_SIZE_TEST, shuffle=False, num_workers=0)
+        # Test images are evaluated without augmentation, decoded once into memory
+        test_cached_dataset = CachedTensorDataset(master_dataset, test_dataset.indices, image_size, mean, std)
+        test_plant_dataloader = DataLoader(test_cached_dataset, batch_size=BATCH_SIZE_TEST, shuffle=False, num_workers=0)
         
         model_class = get_model_class(model, num_of_classes=NUM_CLASSES, num_heads=params[params_name]['NUM_HEADS'], dropout=params[params_name]['DROPOUT']).to(device)
         parameter_grid = {}
@@ -213,7 +216,7 @@ def train(model, dataset, data_csv, binary, binary_label, params_file, params_na
 
                 output = model_class(data)
 
-                if len(output) == 2:
+                if isinstance(output, InceptionOutputs):
                     output = output.logits
 
                 train_loss = loss_function(output, target)
@@ -224,7 +227,7 @@ def train(model, dataset, data_csv, binary, binary_label, params_file, params_na
 
                 output = model_class(data)
 
-                if len(output) == 2:
+                if isinstance(output, InceptionOutputs):
                     output = output.logits
 
                 train_loss = loss_function(output, target)
@@ -287,7 +290,7 @@ def train(model, dataset, data_csv, binary, binary_label, params_file, params_na
 
                 output = model_class(data)
 
-                if len(output) == 2:
+                if isinstance(output, InceptionOutputs):
                     output = output.logits
 
                 test_loss += loss_function(output, target).item()
@@ -344,8 +347,9 @@ def train(model, dataset, data_csv, binary, binary_label, params_file, params_na
 
         logger.info(f"Model saved with id {model_id}")
 
-def train_bow(df, test_size, num_classes, params, save, binary_label):
-    train_df, test_df = train_test_split(df, test_size=test_size)
+def train_bow(df, train_indices, test_indices, num_classes, params, save, binary_label):
+    train_df = df.iloc[train_indices].copy()
+    test_df = df.iloc[test_indices].copy()
 
     # hyperparameters
     feature_detection = params['bag_of_words']['FEATURE_DETECTION']
@@ -356,11 +360,17 @@ def train_bow(df, test_size, num_classes, params, save, binary_label):
         num_classes_key = 'MULTICLASS'
     specific_params = params['bag_of_words'][num_classes_key][feature_detection][classifier]
     k = specific_params['K']
+    vocabulary_params = params['bag_of_words'].get('VOCABULARY', {})
+    histogram_params = params['bag_of_words'].get('HISTOGRAM', {})
+    histogram_normalization = histogram_params.get('NORMALIZATION')
+    training_profile = params['bag_of_words'].get('TRAINING_PROFILE')
+    profile_params = get_training_profile(params['bag_of_words'])
 
-    bow = BagOfWords(DATA_FOLDER_PATH, num_classes, feature_detection, classifier)
+    bow = BagOfWords(DATA_FOLDER_PATH, num_classes, feature_detection, classifier, histogram_normalization=histogram_normalization, sparse_histograms=histogram_params.get('SPARSE', False))
 
-    features, voc, standard_scaler = bow.detect_features(train_df, k)
-    clf = bow.fit(train_df, features, binary_label, specific_params)
+    features, voc, standard_scaler = bow.detect_features(train_df, k, vocabulary_params)
+    logger.info(f"Using {training_profile} training profile")
+    clf = bow.fit(train_df, features, binary_label, specific_params, profile_params)
 
     predicted_classes, accuracy, f1_score, loss = bow.predict(test_df, clf, k, voc, standard_scaler, binary_label)
 
@@ -372,10 +382,16 @@ def train_bow(df, test_size, num_classes, params, save, binary_label):
     other_json = {
         'feature_detection': feature_detection,
         'k': k,
+        'vocabulary': vocabulary_params,
         'voc': store_object(voc),
         'standard_scaler': store_object(standard_scaler),
+        'histogram_normalization': histogram_normalization,
+        'training_profile': training_profile,
     }
 
+    if bow.idf is not None:
+        other_json['idf'] = store_object(bow.idf)
+
     return (clf, y_true, y_pred, test_accuracy, test_loss, other_json)
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+import os
+import time
+from functools import partial
+from typing import Dict, Sequence, Tuple
+import cv2
+import numpy as np
+import torch
+from dotenv import load_dotenv
+from sklearn.metrics import accuracy_score, classification_report, log_loss
+from torch.utils.data import DataLoader, Subset
+from dataloaders.virtual_crop_data_loader import get_csv_data_loader
+
+load_dotenv()
+
+DATA_FOLDER_PATH = os.getenv("DATA_FOLDER_PATH")
+
+# Datasheets of the datasets that can be given by name to train.py
+DATASET_FILE_NAMES = {
+    "plant": "plant_data_split_master.csv",
+    "leaf": "leaves_segmented_master.csv",
+    "plant_golden": "plant_data_split_golden.csv",
+}
+
+
+def get_dataset_path(dataset: str) -> str:
+    if dataset not in DATASET_FILE_NAMES:
+        raise ValueError(f"Dataset {dataset} not defined. Accepted values: {', '.join(DATASET_FILE_NAMES)}. Give the path to the data-CSV of other datasets.")
+
+    return os.path.join(DATA_FOLDER_PATH, DATASET_FILE_NAMES[dataset])
+
+
+def to_model_input(image: np.ndarray, image_size: Tuple[int, int]) -> torch.Tensor:
+    """Image read by skimage.io.imread to a BGR uint8 tensor of the model input size, the same image predict.py reads."""
+    return torch.from_numpy(cv2.resize(np.ascontiguousarray(image[..., 2::-1]), image_size))
+
+
+def get_evaluation_dataset(data_csv: str, image_size: Tuple[int, int], image_path_col: str = "Split masked image path"):
+    """Dataset of the datasheet with images as the predictors take them, see models.predictor."""
+    return get_csv_data_loader(
+        csv_file=data_csv,
+        root_dir=DATA_FOLDER_PATH,
+        image_path_col=image_path_col,
+        label_col="Label",
+        transform=partial(to_model_input, image_size=image_size)
+    )
+
+
+def predict_dataset(predictor, dataset, indices: Sequence[int], batch_size: int = 64, num_workers: int = 4) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    Probabilities and labels of the given rows of an evaluation dataset.
+
+    Returns the probabilities, the labels and the seconds spent in the predictor, which leaves out the decoding.
+    """
+    dataloader = DataLoader(Subset(dataset, list(indices)), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    probabilities = []
+    labels = []
+    seconds = 0.0
+
+    for batch in dataloader:
+        start = time.perf_counter()
+        probabilities.append(predictor.predict_proba(batch['image'].numpy()))
+        seconds += time.perf_counter() - start
+        labels.append(batch['label'].numpy())
+
+    return np.concatenate(probabilities), np.concatenate(labels), seconds
+
+
+def evaluate_probabilities(y_true: np.ndarray, probabilities: np.ndarray, num_classes: int) -> Dict[str, float]:
+    """Test metrics in the form they are stored in the model registry, accuracy in percent as in train.py."""
+    y_pred = np.argmax(probabilities, axis=1)
+    report = classification_report(y_true, y_pred, labels=list(range(num_classes)), output_dict=True, zero_division=0)
+
+    return {
+        "test_accuracy": 100. * accuracy_score(y_true, y_pred),
+        "test_loss": log_loss(y_true, probabilities, labels=list(range(num_classes))),
+        "precision": report["weighted avg"]["precision"],
+        "recall": report["weighted avg"]["recall"],
+        "f1_score": report["weighted avg"]["f1-score"],
+    }
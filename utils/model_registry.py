@@ -0,0 +1,271 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from utils.time_utils import str_to_datetime
+
+load_dotenv()
+
+DATA_FOLDER = os.getenv("DATA_FOLDER_PATH")
+# The models.csv of the data folder is migrated to the registry when the registry is created
+MODELS_CSV = os.path.join(DATA_FOLDER, "models.csv")
+MODEL_REGISTRY_PATH = os.path.join(DATA_FOLDER, "models.db")
+MODEL_FOLDER = os.path.join(DATA_FOLDER, "models")
+
+# Columns of the registry, in the order of models.csv
+COLUMNS = {
+    "id": "TEXT PRIMARY KEY",
+    "model_name": "TEXT NOT NULL",
+    # Training time as "YYYY-MM-DD HH:MM:SS.ffffff", the format of models.csv
+    "timestamp": "TEXT NOT NULL",
+    "description": "TEXT",
+    "dataset": "TEXT",
+    "num_classes": "INTEGER",
+    "precision": "REAL",
+    "recall": "REAL",
+    "train_accuracy": "REAL",
+    "train_loss": "REAL",
+    "validation_accuracy": "REAL",
+    "validation_loss": "REAL",
+    "test_accuracy": "REAL",
+    "test_loss": "REAL",
+    "f1_score": "REAL",
+    # A JSON object dumped to a string
+    "other_json": "TEXT",
+}
+# Columns models are looked up by, the id is indexed as the primary key
+INDEXED_COLUMNS = ["model_name", "dataset", "num_classes"]
+SCHEMA_VERSION = 3
+# Model files are named <id>-<model_name>-<timestamp>.<extension>, see utils.model_utils.get_model_file_name
+ARTIFACT_FILE_NAME = re.compile(r"^(?P<id>[^-.]+)-(?P<model_name>[^-.]+)-(?P<timestamp>[^-.]+)(?P<extension>\.[^.]+)$")
+# A folder modified this close to its scan may have changed within the resolution of its modification time, as on
+# network mounts, so it is scanned again until the scan is this much newer than the modification
+RACY_SECONDS = 2
+# Seconds a write waits for the write lock of another process, e.g. another training run saving its model
+BUSY_TIMEOUT = 30
+
+_connections = threading.local()
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Connection to the registry of this thread, the registry is created and models.csv migrated on the first use.
+
+    The registry is in WAL mode, so reads don't wait for writes and concurrent writers queue for the lock.
+    """
+    connection = getattr(_connections, "connection", None)
+
+    if connection is None:
+        connection = sqlite3.connect(MODEL_REGISTRY_PATH, timeout=BUSY_TIMEOUT, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        _create_registry(connection)
+        _connections.connection = connection
+
+    return connection
+
+
+def _create_registry(connection: sqlite3.Connection):
+    if connection.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+        return
+
+    # Processes starting at the same time wait here, and only the first one creates or upgrades the registry
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+
+        if version < 1:
+            columns = ", ".join(f'"{column}" {definition}' for column, definition in COLUMNS.items())
+            connection.execute(f"CREATE TABLE IF NOT EXISTS models ({columns})")
+            for column in INDEXED_COLUMNS:
+                connection.execute(f'CREATE INDEX IF NOT EXISTS models_{column} ON models ("{column}")')
+
+            if os.path.exists(MODELS_CSV):
+                _insert_rows(connection, _read_csv(MODELS_CSV))
+
+        if version < 2:
+            # Files of the model folder by id with the ISO timestamps of their names, rebuilt from the folder when it has changed, see refresh_artifact_index
+            connection.execute("CREATE TABLE IF NOT EXISTS artifacts (file_name TEXT PRIMARY KEY, id TEXT NOT NULL, model_name TEXT NOT NULL, timestamp TEXT NOT NULL, extension TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS artifacts_id ON artifacts (id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS artifacts_model_name_timestamp ON artifacts (model_name, timestamp)")
+            connection.execute("CREATE TABLE IF NOT EXISTS artifact_folder (folder TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, scanned_at REAL NOT NULL)")
+
+        if version < 3:
+            # The timestamps of the artifacts were stored as in the file names, which don't sort in time order, the
+            # index is rebuilt with ISO timestamps on its next use
+            connection.execute("DELETE FROM artifacts")
+            connection.execute("DELETE FROM artifact_folder")
+
+        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def _to_sql_value(value: Any) -> Any:
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return str(value.to_pydatetime())
+    return value
+
+
+def _insert_rows(connection: sqlite3.Connection, rows: List[Dict[str, Any]], replace: bool = False) -> int:
+    columns = ", ".join(f'"{column}"' for column in COLUMNS)
+    placeholders = ", ".join("?" for _ in COLUMNS)
+    # Models that are already in the registry are left as they are unless replaced
+    conflict = "REPLACE" if replace else "IGNORE"
+
+    cursor = connection.executemany(
+        f"INSERT OR {conflict} INTO models ({columns}) VALUES ({placeholders})",
+        [[_to_sql_value(row.get(column)) for column in COLUMNS] for row in rows]
+    )
+    return cursor.rowcount
+
+
+def _read_csv(csv_path: str) -> List[Dict[str, Any]]:
+    df = pd.read_csv(csv_path, dtype={"id": str, "timestamp": str})
+
+    missing = [column for column in COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"{csv_path} is missing the model columns {missing}")
+
+    return df.to_dict("records")
+
+
+def _query(where: str = "", params=()) -> pd.DataFrame:
+    df = pd.read_sql_query(f"SELECT * FROM models {where} ORDER BY timestamp", get_connection(), params=params)
+    # Missing values are NaN as they were in the DataFrame of models.csv
+    return df.fillna(value=np.nan)
+
+
+def add_model(**row):
+    """Add a model to the registry in its own transaction, fails if a model with the same id exists."""
+    unknown = [column for column in row if column not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown model columns {unknown}, the registry has columns {list(COLUMNS)}")
+
+    columns = ", ".join(f'"{column}"' for column in row)
+    placeholders = ", ".join("?" for _ in row)
+
+    with get_connection() as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute(f"INSERT INTO models ({columns}) VALUES ({placeholders})", [_to_sql_value(value) for value in row.values()])
+
+
+def get_models(**attributes) -> pd.DataFrame:
+    """Models whose columns equal the given values, e.g. get_models(model_name="resnet18", dataset="plant"), or all models."""
+    unknown = [column for column in attributes if column not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown model columns {unknown}, the registry has columns {list(COLUMNS)}")
+
+    if not attributes:
+        return _query()
+
+    where = "WHERE " + " AND ".join(f'"{column}" = ?' for column in attributes)
+    return _query(where, [_to_sql_value(value) for value in attributes.values()])
+
+
+def import_csv(csv_path: str = MODELS_CSV, replace: bool = False) -> int:
+    """Add the models of a models.csv file to the registry in one transaction. Returns the number of added models."""
+    rows = _read_csv(csv_path)
+
+    with get_connection() as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        return _insert_rows(connection, rows, replace)
+
+
+def export_csv(csv_path: str = MODELS_CSV):
+    """Write the registry to a CSV file in the format of models.csv."""
+    get_models().to_csv(csv_path, index=False)
+
+
+def _is_artifact_index_current(connection: sqlite3.Connection, mtime_ns: int) -> bool:
+    state = connection.execute("SELECT mtime_ns, scanned_at FROM artifact_folder WHERE folder = ?", (MODEL_FOLDER,)).fetchone()
+    return state is not None and state[0] == mtime_ns and state[1] - mtime_ns / 1e9 > RACY_SECONDS
+
+
+def _artifact_timestamp(timestamp: str) -> Optional[str]:
+    """ISO timestamp of the timestamp of a model file name (e.g. "191026_0645"), which sorts in time order unlike the file names."""
+    try:
+        return str_to_datetime(timestamp).isoformat()
+    except ValueError:
+        return None
+
+
+def refresh_artifact_index(force: bool = False) -> bool:
+    """
+    Rebuild the index of the model files if the model folder has been modified since it was built, e.g. by saving a
+    model or copying files into the folder. Checking costs a stat of the folder, rebuilding a listing of it.
+
+    Returns whether the index was rebuilt.
+    """
+    connection = get_connection()
+    mtime_ns = os.stat(MODEL_FOLDER).st_mtime_ns
+
+    if not force and _is_artifact_index_current(connection, mtime_ns):
+        return False
+
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+
+        # Another process may have rebuilt the index while this one waited for the lock
+        if not force and _is_artifact_index_current(connection, mtime_ns):
+            return False
+
+        scanned_at = time.time()
+        artifacts = []
+        for match in map(ARTIFACT_FILE_NAME.match, os.listdir(MODEL_FOLDER)):
+            timestamp = _artifact_timestamp(match.group("timestamp")) if match is not None else None
+            if timestamp is not None:
+                artifacts.append((match.group(0), match.group("id"), match.group("model_name"), timestamp, match.group("extension")))
+
+        connection.execute("DELETE FROM artifacts")
+        connection.executemany("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)", artifacts)
+        connection.execute("INSERT OR REPLACE INTO artifact_folder VALUES (?, ?, ?)", (MODEL_FOLDER, mtime_ns, scanned_at))
+
+    return True
+
+
+def get_artifact_files(id: str) -> List[str]:
+    """Names of the files of the model in the model folder, e.g. its .pt and .weights files."""
+    refresh_artifact_index()
+    rows = get_connection().execute("SELECT file_name FROM artifacts WHERE id = ? ORDER BY file_name", (id,)).fetchall()
+    return [file_name for file_name, in rows]
+
+
+def get_artifact_path(id: str, extension: str) -> Optional[str]:
+    """Path of the file of the model with the extension, e.g. ".weights", or None if the model has no such file."""
+    refresh_artifact_index()
+    row = get_connection().execute("SELECT file_name FROM artifacts WHERE id = ? AND extension = ?", (id, extension)).fetchone()
+    return os.path.join(MODEL_FOLDER, row[0]) if row is not None else None
+
+
+def find_artifact(model_name: str, timestamp: str = None) -> Optional[Tuple[str, str]]:
+    """
+    Id and file name of the latest model file of the architecture, or of the one with the timestamp of the file
+    names (e.g. "191026_0645") if given. None if there is no such file.
+    """
+    refresh_artifact_index()
+
+    if timestamp is None:
+        row = get_connection().execute(
+            "SELECT id, file_name FROM artifacts WHERE model_name = ? ORDER BY timestamp DESC LIMIT 1", (model_name,)
+        ).fetchone()
+    else:
+        iso_timestamp = _artifact_timestamp(timestamp)
+        if iso_timestamp is None:
+            raise ValueError(f"Invalid model timestamp {timestamp}, expected the format of the model file names, e.g. 191026_0645")
+
+        row = get_connection().execute(
+            "SELECT id, file_name FROM artifacts WHERE model_name = ? AND timestamp = ? LIMIT 1", (model_name, iso_timestamp)
+        ).fetchone()
+
+    return tuple(row) if row is not None else None
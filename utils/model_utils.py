@@ -2,6 +2,7 @@ from dotenv import load_dotenv
 import os
 import time
 from models.bag_of_words import BagOfWords
+from utils.model_registry import add_model, get_models
 from utils.time_utils import now_to_str, str_to_datetime, datetime_to_str
 from torch import nn
 from pathlib import Path
@@ -12,10 +13,6 @@ import json
 from typing import Tuple, Union
 from datetime import datetime
 import torch
-from functools import reduce
-from operator import and_
-from torch.utils.data import DataLoader
-import numpy as np
 from joblib import dump, load
 
 load_dotenv()
@@ -24,8 +21,6 @@ DATA_FOLDER = os.getenv("DATA_FOLDER_PATH")
 MODEL_FOLDER = os.path.join(DATA_FOLDER, "models")
 OBJECTS_FOLDER = os.path.join(MODEL_FOLDER, "objects")
 
-MODEL_DF = pd.read_csv(os.path.join(DATA_FOLDER, "models.csv"))
-
 AVAILABLE_MODELS = ["resnet18", "inception_v3", "vision_transformer", "bag_of_words"]
 
 CLASS_TO_MODEL_NAME_MAPPING = {
@@ -62,14 +57,6 @@ def get_model_file_name(id: str, model_name: str, timestamp: str) -> str:
 
 	return model_file_name
 
-def get_dataset_file_name(id: str, model_name: str, timestamp: str, suffix: str) -> str:
-	if type(model_name) != str:
-		raise ValueError("Model name must be string")
-
-	model_file_name = f"{id}-{model_name}-{timestamp}-{suffix}.npy"
-	return model_file_name
-
-
 def create_model_id_and_timestamp() -> Tuple[str, datetime]:
 	id = "".join(
 		random.choice(string.ascii_lowercase + string.digits) for i in range(8)
@@ -121,28 +108,18 @@ def save_torch_model(model: nn.Module) -> Tuple[str, str, datetime]:
 
 	return id, model_name, timestamp
 
-def save_dataset_of_torch_model(model: nn.Module, dataset: DataLoader, prefix: str) -> Tuple[str, str, datetime]:
-	# If custom name attribute has been given, use it
-	if hasattr(model, "name"):
-		model_name = model.name
-	# Find class name and determine the model name
-	else:
-		model_name = type(model).__name__
-		model_name = CLASS_TO_MODEL_NAME_MAPPING[model_name]
-
+def save_torchscript_model(model: torch.jit.ScriptModule, model_name: str) -> Tuple[str, str, datetime]:
+	# Compiled models, e.g. quantized ones, can't be restored from a state dict of the model class
 	id, timestamp = create_model_id_and_timestamp()
 	timestamp_str = datetime_to_str(timestamp)
 
-	dataset_file_name = get_dataset_file_name(
-		id=id, model_name=model_name, timestamp=timestamp_str, prefix="test_dataset")
-
-	dataset_file_path = os.path.join(MODEL_FOLDER, dataset_file_name)
-	np.save(dataset_file_path, dataset, allow_pickle = True)
-
-	return id, model_name, timestamp_str
+	model_file_name = get_model_file_name(
+		id=id, model_name=model_name, timestamp=timestamp_str
+	)
+	model_file_path = os.path.join(MODEL_FOLDER, model_file_name)
+	torch.jit.save(model, model_file_path)
 
-def load_dataset_of_torch_model(hyperparam_search_id: str, prefix: str) -> Tuple[str, str, datetime]:
-	return np.load(os.path.join(MODEL_FOLDER, f"{hyperparam_search_id}-{prefix}.npy"), allow_pickle=True)
+	return id, model_name, timestamp
 
 def save_sklearn_model(model) -> Tuple[str, str, datetime]:
 	model_name = "bag_of_words"
@@ -193,35 +170,36 @@ def add_model_info_to_df(
 	if not test_accuracy or not test_loss or not f1_score:
 		raise ValueError("Model should be stored with test results")
 
-	other = json.dumps(other_json)
-
-	pandas_row = [
-		id,
-		model_name,
-		timestamp,
-		description,
-		dataset,
-		num_classes,
-		precision,
-		recall,
-		train_accuracy,
-		train_loss,
-		validation_accuracy,
-		validation_loss,
-		test_accuracy,
-		test_loss,
-		f1_score,
-		other,
-	]
-
-	MODEL_DF.loc[len(MODEL_DF.index)] = pandas_row
-	MODEL_DF.to_csv(os.path.join(DATA_FOLDER, "models.csv"), index=False)
+	# Inserted in a transaction of its own, so models saved by parallel training runs don't overwrite each other
+	add_model(
+		id=id,
+		model_name=model_name,
+		timestamp=str(timestamp),
+		description=description,
+		dataset=dataset,
+		num_classes=num_classes,
+		precision=precision,
+		recall=recall,
+		train_accuracy=train_accuracy,
+		train_loss=train_loss,
+		validation_accuracy=validation_accuracy,
+		validation_loss=validation_loss,
+		test_accuracy=test_accuracy,
+		test_loss=test_loss,
+		f1_score=f1_score,
+		other_json=json.dumps(other_json),
+	)
 
 
 # Helper function to store the model by just passing the model to the function and add relevant results to df
-def store_model_and_add_info_to_df(model, **kwargs):
+# TorchScript models are stored as they are and need the name of the model architecture, model_name
+def store_model_and_add_info_to_df(model, model_name: str = None, **kwargs):
+	if isinstance(model, torch.jit.ScriptModule):
+		if model_name is None:
+			raise ValueError("Need to specify the model architecture of TorchScript models")
+		id, model_name, timestamp = save_torchscript_model(model, model_name)
 	# Check if the model class inherits PyTorch nn.Module-class so we know if it's PyTorch classifier
-	if issubclass(type(model), nn.Module):
+	elif issubclass(type(model), nn.Module):
 		id, model_name, timestamp = save_torch_model(model)
 	else:
 		id, model_name, timestamp = save_sklearn_model(model)
@@ -231,30 +209,32 @@ def store_model_and_add_info_to_df(model, **kwargs):
 	return id
 
 def get_model_info(id: str) -> pd.Series:
-	row = MODEL_DF.loc[MODEL_DF["id"] == id]
+	row = get_models(id=id)
 	return row
 
 
 def get_model_info_by_name(name: str, timestamp: datetime) -> pd.Series:
-	row = MODEL_DF.loc[
-		(MODEL_DF["name"] == name) & (MODEL_DF["timestamp"] == timestamp)
-	]
+	row = get_models(model_name=name, timestamp=str(timestamp))
 	return row
 
 
 # You can pass key=value arguments to the function and it returns dataframe row where all conditions are true
 def get_model_info_by_attributes(**kwargs) -> pd.Series:
-	pandas_filters = []
+	row = get_models(**kwargs)
+	return row
 
-	# Create all filtered series
-	for key, val in kwargs.items():
-		filter = MODEL_DF[key] == val
-		pandas_filters.append(filter)
 
-	joined_filters = reduce(and_, pandas_filters)
+def get_model_id(identifier=None, model=None, num_classes=None, dataset=None) -> str:
+	"""Id of the given model, or of the model with the best f1 score among the models with the given attributes."""
+	if identifier:
+		return identifier
 
-	row = MODEL_DF.loc[joined_filters]
-	return row
+	model_data = get_model_info_by_attributes(model_name=model, num_classes=num_classes, dataset=dataset)
+	if len(model_data) == 0:
+		raise ValueError(f"Could not find any model with attributes model name: {model}, num_classes: {num_classes}, dataset: {dataset}. Please check that model with these values exists in the model registry, see help.py --list")
+
+	best_model = model_data.nlargest(1, columns=['f1_score'])
+	return best_model['id'].item()
 
 
 def get_model_path(id: str) -> str:
@@ -280,7 +260,7 @@ def get_image_size(model_name: str) -> int:
 	return MODEL_INFO[model_name]['image_size']
 
 def get_other_json(id):
-	row = MODEL_DF.loc[MODEL_DF['id'] == id]
+	row = get_model_info(id)
 	other_json = json.loads(row['other_json'].item())
 	return other_json
 
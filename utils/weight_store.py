@@ -0,0 +1,134 @@
+"""
+Layout of a .weights file:
+
+    8 bytes            length of the header, little-endian unsigned integer
+    header             JSON {"version": 1, "tensors": {<state dict key>: {"dtype", "shape", "offset"}}}
+    padding            up to the first multiple of ALIGNMENT
+    data               the raw bytes of each tensor in C order, offsets are from the start of the data
+
+Tensors that share their memory in the state dict, like the layers ResNet registers twice, are stored once and the
+other keys get {"alias": <key>} headers.
+"""
+import os
+import json
+import struct
+from collections import OrderedDict
+from typing import Dict, Tuple
+import numpy as np
+import torch
+from torch import nn
+
+# Weights of the PyTorch models in the memory-mapped format, next to the pickled .pt files of the same name
+WEIGHTS_EXTENSION = ".weights"
+WEIGHTS_FORMAT_VERSION = 1
+# Tensors start at multiples of this many bytes, so the mapped arrays are aligned for vectorized reads
+ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_weights(state_dict: Dict[str, torch.Tensor], path: str):
+    """Write a state dict to path in the memory-mapped weight format."""
+    tensors = OrderedDict()
+    arrays = []
+    stored = {}
+    size = 0
+
+    for key, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        storage_key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+
+        if tensor.numel() > 0 and storage_key in stored:
+            tensors[key] = {"alias": stored[storage_key]}
+            continue
+
+        array = tensor.contiguous().numpy()
+        tensors[key] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": size}
+        arrays.append(array)
+        stored[storage_key] = key
+        size = _align(size + array.nbytes)
+
+    header_bytes = json.dumps({"version": WEIGHTS_FORMAT_VERSION, "tensors": tensors}).encode("utf-8")
+    data_start = _align(8 + len(header_bytes))
+
+    # Written next to the final file and renamed, so a reader never maps a partly written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for entry, array in zip((entry for entry in tensors.values() if "offset" in entry), arrays):
+            f.write(b"\0" * (data_start + entry["offset"] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_weights_header(path: str) -> Tuple[dict, int]:
+    """Header of a .weights file and the offset of its data from the start of the file."""
+    with open(path, "rb") as f:
+        header_length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length))
+
+    if header.get("version") != WEIGHTS_FORMAT_VERSION:
+        raise ValueError(f"Unsupported weights format version {header.get('version')} in {path}")
+
+    return header, _align(8 + header_length)
+
+
+def load_weights(path: str) -> Dict[str, torch.Tensor]:
+    """
+    State dict of a .weights file without reading or copying the tensors.
+
+    The tensors are views of a copy-on-write memory map of the file: the pages are read from the page cache when
+    first used, processes loading the same file share them, and writes to a tensor only change that process's copy.
+    """
+    header, data_start = read_weights_header(path)
+    mapped = np.memmap(path, dtype=np.uint8, mode="c")
+
+    state_dict = OrderedDict()
+    for key, entry in header["tensors"].items():
+        if "alias" in entry:
+            state_dict[key] = state_dict[entry["alias"]]
+            continue
+
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        start = data_start + entry["offset"]
+        array = mapped[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+        state_dict[key] = torch.from_numpy(array)
+
+    return state_dict
+
+
+def assign_weights(model: nn.Module, state_dict: Dict[str, torch.Tensor]):
+    """
+    Set the parameters and buffers of the model to the tensors of the state dict, with the same checks as
+    load_state_dict(strict=True). Unlike load_state_dict, the tensors aren't copied into the existing parameters,
+    so the model keeps using the memory-mapped tensors of load_weights.
+    """
+    expected = model.state_dict()
+
+    missing = [key for key in expected if key not in state_dict]
+    unexpected = [key for key in state_dict if key not in expected]
+    if missing or unexpected:
+        raise RuntimeError(f"Error(s) in assigning weights to {type(model).__name__}: missing keys {missing}, unexpected keys {unexpected}")
+
+    for key, tensor in state_dict.items():
+        if tensor.shape != expected[key].shape:
+            raise RuntimeError(f"Size mismatch for {key}: the weights have shape {tuple(tensor.shape)}, the model {tuple(expected[key].shape)}")
+
+        module_name, _, name = key.rpartition(".")
+        module = model.get_submodule(module_name)
+
+        if name in module._parameters:
+            module._parameters[name] = nn.Parameter(tensor, requires_grad=module._parameters[name].requires_grad)
+        else:
+            module._buffers[name] = tensor
+
+
+def convert_to_weights(model_path: str) -> str:
+    """Write the weights of a pickled state dict (.pt) to a .weights file next to it. Returns the path of the new file."""
+    weights_path = os.path.splitext(model_path)[0] + WEIGHTS_EXTENSION
+    save_weights(torch.load(model_path, map_location="cpu"), weights_path)
+    return weights_path